@@ -1,19 +1,544 @@
 #!/usr/bin/env python3
 import sys
+import argparse
 import gi
 gi.require_version('Gtk', '4.0')
 gi.require_version('Gst', '1.0')
 from gi.repository import Gtk, GLib, Gst
 import numpy as np
 import librosa
-import queue
 import threading
-from scipy.signal import find_peaks
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import butter, sosfilt
 from collections import deque
 import time
 
+class RingBuffer:
+    """Preallocated circular sample buffer for one writer and one reader.
+
+    The writer copies each chunk in place and only then advances `written` (total samples
+    ever written), so a reader that looks at `written` first never sees a half-written chunk
+    and no lock is needed between the GStreamer thread and the analysis.
+    """
+
+    def __init__(self, capacity, dtype=np.float32):
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.written = 0
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def write(self, samples):
+        count = len(samples)
+        if count > self.capacity:
+            samples = samples[-self.capacity:]
+        start = (self.written + count - len(samples)) % self.capacity
+        first = min(len(samples), self.capacity - start)
+        self.data[start:start + first] = samples[:first]
+        self.data[:len(samples) - first] = samples[first:]
+        self.written += count
+
+    def latest(self, count=None):
+        """Last `count` samples in time order: a view if contiguous, otherwise one copy."""
+        count = len(self) if count is None else min(count, len(self))
+        end = self.written % self.capacity
+        if end == 0 and count:
+            end = self.capacity
+        start = end - count
+        if start >= 0:
+            return self.data[start:end]
+        return np.concatenate((self.data[start:], self.data[:end]))
+
+    def read(self, start, stop):
+        """Samples [start, stop) by absolute position; they must still be in the buffer."""
+        if start < self.written - self.capacity or stop > self.written:
+            raise IndexError(f"samples {start}:{stop} not in buffer (written {self.written})")
+        first = start % self.capacity
+        last = first + (stop - start)
+        if last <= self.capacity:
+            return self.data[first:last]
+        return np.concatenate((self.data[first:], self.data[:last - self.capacity]))
+
+    def snapshot(self, since=0):
+        """Read-only copy of the samples written after absolute position `since`: (start, samples).
+
+        Starts at the oldest sample still held if `since` has already been overwritten.
+        """
+        written = self.written
+        start = max(since, written - self.capacity)
+        samples = np.array(self.read(start, written))
+        samples.flags.writeable = False
+        return start, samples
+
+
+class IncrementalAnalyzer:
+    """Sliding-window tempo, meter and key analysis that only processes newly arrived hops.
+
+    STFT frames (and the onset envelope derived from them) and chroma frames are computed once
+    per hop as audio arrives; the onset envelope of the last `window` seconds is kept in a ring.
+    Tempo and key are running statistics with exponential decay, so a change in the music
+    shows up within a few seconds without recomputing the whole window.
+
+    Tempo and meter come from a decayed autocorrelation of the onset envelope; each update
+    adds only the lag products of the new frames, computed with one FFT cross-correlation.
+
+    `chroma` selects the key detection front end: 'cqt' runs librosa's constant-Q chroma at
+    the full sample rate; 'stft' decimates the input by `decimation` and takes chroma from
+    the onset STFT itself, so key detection costs one matrix product per frame. Its frames
+    last twice as long as at the full rate (93 ms by default, as librosa's chroma_stft) for
+    `decimation / 2` times finer frequency resolution while onsets stay sharp.
+    """
+
+    key_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+    min_bpm, max_bpm = 50.0, 200.0
+    meters = (3, 4)  # beats per measure told apart by the accent period
+    # Krumhansl-Kessler key profiles, tonic first
+    major_profile = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+    minor_profile = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+    def __init__(self, sample_rate=44100, hop_length=512, n_fft=2048, window=10, n_mels=128,
+                 tempo_half_life=5.0, meter_half_life=10.0, key_half_life=8.0, chroma_margin=0.5,
+                 chroma='cqt', decimation=4, prior_bpm=120.0, prior_octaves=1.0):
+        if chroma not in ('cqt', 'stft'):
+            raise ValueError(f"Unknown chroma method: {chroma}")
+        self.chroma = chroma
+        self.decimation = decimation if chroma == 'stft' else 1
+        self.sample_rate = sample_rate // self.decimation
+        self.hop_length = hop_length // self.decimation
+        self.n_fft = n_fft * 2 // self.decimation if self.decimation > 1 else n_fft
+        self.window = window
+        self.tempo_half_life = tempo_half_life
+        self.meter_half_life = meter_half_life
+        self.key_half_life = key_half_life
+        self.prior_bpm = prior_bpm
+        self.prior_octaves = prior_octaves
+        self.fft_window = librosa.filters.get_window('hann', self.n_fft)
+        self.mel_basis = librosa.filters.mel(sr=self.sample_rate, n_fft=self.n_fft, n_mels=n_mels)
+        if chroma == 'stft':
+            self.chroma_basis = librosa.filters.chroma(sr=self.sample_rate, n_fft=self.n_fft, tuning=0.0)
+            # Anti-aliasing filter for the decimation; its state carries across snapshots
+            self.decimation_filter = butter(8, 0.8 / self.decimation, output='sos')
+            self.filter_state = np.zeros((len(self.decimation_filter), 2))
+            self.input_position = 0
+            self.chroma_margin = 0
+        else:
+            # Half the longest constant-Q filter: chroma frames closer than this to the newest
+            # sample would be computed against zero padding, so they wait for the next update
+            self.chroma_margin = hop_length * int(np.ceil(chroma_margin * sample_rate / hop_length))
+
+        # 24 zero-mean, unit-norm key profiles (12 major, then 12 minor) for one matrix product
+        profiles = np.array([np.roll(profile, tonic)
+                             for profile in (self.major_profile, self.minor_profile)
+                             for tonic in range(12)])
+        profiles -= profiles.mean(axis=1, keepdims=True)
+        self.key_profiles = profiles / np.linalg.norm(profiles, axis=1, keepdims=True)
+
+        self.onset_env = RingBuffer(int(window * sample_rate / hop_length))
+        self.pending = np.zeros(0, dtype=np.float32)  # samples still needed by the next frames
+        self.pending_start = 0
+        self.position = 0  # start of the next STFT frame (absolute sample)
+        self.chroma_position = self.chroma_margin  # centre of the next chroma frame
+        self.previous_db = None
+        # Autocorrelation up to the longest measure: max(meters) beats at the slowest tempo
+        self.frame_rate = self.sample_rate / self.hop_length
+        self.max_lag = int(np.ceil(max(self.meters) * 60.0 / self.min_bpm * self.frame_rate))
+        self.lag_sum = np.zeros(self.max_lag + 1)
+        self.pair_weight = np.zeros(self.max_lag + 1)
+        self.autocorrelation = np.zeros(self.max_lag + 1)  # lag_sum per unit pair weight
+        # The same lag products with a longer memory: a change of meter is rarer than a tempo
+        # drift, and a few more measures of accents separate 3/4 from 4/4 at slow tempi
+        self.meter_sum = np.zeros(self.max_lag + 1)
+        self.meter_weight = np.zeros(self.max_lag + 1)
+        self.chroma_sum = np.zeros(12)
+
+    @property
+    def seconds(self):
+        """Audio analysed so far (for the onset envelope)."""
+        return self.onset_env.written * self.hop_length / self.sample_rate
+
+    def update(self, start, samples):
+        """Analyse a snapshot of `samples` beginning at absolute sample `start`; return the result.
+
+        Snapshots are expected back to back; after a gap (audio dropped by a slow reader)
+        analysis continues from `start`.
+        """
+        if self.decimation > 1:
+            start, samples = self.decimate(start, samples)
+        end = self.pending_start + len(self.pending)
+        if start > end:
+            self.pending = samples
+            self.pending_start = self.position = start
+            self.chroma_position = start + self.chroma_margin
+            self.previous_db = None
+        else:
+            self.pending = np.concatenate((self.pending, samples[end - start:]))
+        written = self.pending_start + len(self.pending)
+
+        self.update_onsets(written)
+        if self.chroma == 'cqt':
+            self.update_chroma(written)
+
+        keep = min(self.position, self.chroma_position - self.chroma_margin)
+        self.pending = self.pending[keep - self.pending_start:]
+        self.pending_start = keep
+        return self.result()
+
+    def read(self, start, stop):
+        return self.pending[start - self.pending_start:stop - self.pending_start]
+
+    def decimate(self, start, samples):
+        """Low-pass and downsample a snapshot; returns (start, samples) at the analysis rate."""
+        if start != self.input_position:
+            self.filter_state[:] = 0.0
+        self.input_position = start + len(samples)
+        filtered, self.filter_state = sosfilt(self.decimation_filter, samples, zi=self.filter_state)
+        offset = -start % self.decimation
+        return (start + offset) // self.decimation, filtered[offset::self.decimation].astype(np.float32)
+
+    def update_onsets(self, written):
+        hop = self.hop_length
+        count = (written - self.position - self.n_fft) // hop + 1
+        if count <= 0:
+            return
+        samples = self.read(self.position, self.position + (count - 1) * hop + self.n_fft)
+        frames = sliding_window_view(samples, self.n_fft)[::hop] * self.fft_window
+        power = np.abs(np.fft.rfft(frames, axis=1)) ** 2
+        mel_db = 10 * np.log10(np.maximum(power @ self.mel_basis.T, 1e-10))
+
+        # Spectral flux like librosa.onset.onset_strength(aggregate=np.median), carried across calls
+        previous = mel_db[:1] if self.previous_db is None else self.previous_db
+        flux = np.maximum(0.0, np.diff(np.vstack([previous, mel_db]), axis=0))
+        self.previous_db = mel_db[-1:]
+        self.onset_env.write(np.median(flux, axis=1).astype(np.float32))
+        self.position += count * hop
+        self.update_tempo(count)
+        if self.chroma == 'stft':
+            chroma = self.chroma_basis @ power.T
+            chroma /= np.maximum(chroma.max(axis=0), 1e-10)  # per-frame max normalisation like chroma_stft
+            self.accumulate_chroma(chroma)
+
+    def update_tempo(self, new_frames):
+        """Add the lag products x[n] * x[n - k], k <= max_lag, of the newest onset frames."""
+        lag = self.max_lag
+        # A click's flux is split between neighbouring frames according to where it falls between
+        # hops; summing over ~46 ms keeps its full height (a fixed time, not the FFT length, so the
+        # long windows of the decimated path do not blur the envelope further)
+        span = max(int(round(0.046 * self.frame_rate)), 1)
+        # Frames older than the ring minus one lag span are dropped (only after a long stall)
+        new_frames = min(new_frames, self.onset_env.capacity - lag - span)
+        env = self.onset_env.latest(new_frames + lag + span - 1)
+        env = np.convolve(env, np.ones(span), mode='valid')
+        env = env - env.mean()  # without the DC component every lag would correlate
+        valid = np.ones(len(env))
+        if len(env) < new_frames + lag:
+            padding = np.zeros(new_frames + lag - len(env))
+            env = np.concatenate((padding, env))
+            valid = np.concatenate((padding, valid))
+
+        size = 1 << int(np.ceil(np.log2(len(env) + new_frames)))
+        env_spectrum = np.fft.rfft(env, size)
+        valid_spectrum = np.fft.rfft(valid, size)
+
+        def lag_products(x, spectrum, weights):
+            correlation = np.fft.irfft(np.conj(np.fft.rfft(x[lag:] * weights, size)) * spectrum, size)
+            return correlation[lag::-1]
+
+        def accumulate(total, x, spectrum, half_life):
+            # Weight each new frame by its age so the sum decays per frame, newest weighted 1
+            decay = 0.5 ** (1.0 / self.frame_rate / half_life)
+            weights = decay ** np.arange(new_frames - 1, -1, -1)
+            return total * decay ** new_frames + lag_products(x, spectrum, weights)
+
+        # Pair weights count how much of each lag's sum is real audio rather than padding from
+        # before the first frame; dividing by them keeps long lags from being penalised early on
+        self.lag_sum = accumulate(self.lag_sum, env, env_spectrum, self.tempo_half_life)
+        self.pair_weight = accumulate(self.pair_weight, valid, valid_spectrum, self.tempo_half_life)
+        self.autocorrelation = self.lag_sum / np.maximum(self.pair_weight, 1e-9)
+        self.meter_sum = accumulate(self.meter_sum, env, env_spectrum, self.meter_half_life)
+        self.meter_weight = accumulate(self.meter_weight, valid, valid_spectrum, self.meter_half_life)
+
+    @staticmethod
+    def parabolic_peak(values, index):
+        """Vertex of the parabola through values[index - 1:index + 2]: (offset from index, height)."""
+        left, centre, right = values[index - 1:index + 2]
+        curvature = left - 2 * centre + right
+        if curvature >= 0:
+            return 0.0, float(centre)
+        offset = float(np.clip(0.5 * (left - right) / curvature, -0.5, 0.5))
+        return offset, float(centre - 0.25 * (left - right) * offset)
+
+    def peak_near(self, values, lag):
+        """Interpolated height of the peak of `values` (indexed by lag) within a frame of `lag`."""
+        low = int(np.clip(np.floor(lag) - 1, 1, self.max_lag - 1))
+        high = int(np.clip(np.ceil(lag) + 1, 1, self.max_lag - 1))
+        index = low + int(np.argmax(values[low:high + 1]))
+        return self.parabolic_peak(values, index)[1]
+
+    def beat_lag(self):
+        """Beat period in frames: prior-weighted autocorrelation peak, refined to a fraction of
+        a frame by a parabola through its neighbours; None without a clear periodicity."""
+        energy = self.autocorrelation[0]
+        if energy <= 0:
+            return None
+        lags = np.arange(int(60.0 / self.max_bpm * self.frame_rate),
+                         int(np.ceil(60.0 / self.min_bpm * self.frame_rate)) + 1)
+        bpms = 60.0 * self.frame_rate / lags
+        # Log-normal tempo prior around prior_bpm resolves the octave between T and 2T
+        prior = np.exp(-0.5 * (np.log2(bpms / self.prior_bpm) / self.prior_octaves) ** 2)
+        scores = self.autocorrelation[lags] / energy
+        best = int(np.argmax(scores * prior))
+        if scores[best] < 0.1:
+            return None
+
+        return lags[best] + self.parabolic_peak(self.autocorrelation, lags[best])[0]
+
+    def estimate_bpm(self):
+        lag = self.beat_lag()
+        return None if lag is None else float(60.0 * self.frame_rate / lag)
+
+    def update_chroma(self, written):
+        hop = self.hop_length
+        count = (written - self.chroma_margin - self.chroma_position) // hop + 1
+        if count < self.sample_rate // hop:  # constant-Q transform in blocks of about a second
+            return
+        margin = self.chroma_margin
+        segment = self.read(self.chroma_position - margin, self.chroma_position + (count - 1) * hop + margin)
+        chroma = librosa.feature.chroma_cqt(y=segment, sr=self.sample_rate, hop_length=hop, tuning=0.0)
+        self.accumulate_chroma(chroma[:, margin // hop:margin // hop + count])
+        self.chroma_position += count * hop
+
+    def accumulate_chroma(self, chroma):
+        """Exponentially decayed sum of chroma frames, newest frame weighted 1."""
+        count = chroma.shape[1]
+        decay = 0.5 ** (self.hop_length / self.sample_rate / self.key_half_life)
+        weights = decay ** np.arange(count - 1, -1, -1)
+        self.chroma_sum = self.chroma_sum * decay ** count + chroma @ weights
+
+    def meter_strengths(self, lag):
+        """{beats per measure: autocorrelation at that many beat periods} for the candidate meters.
+
+        Accent strength is compared on the longer-memory autocorrelation (meter_half_life),
+        smoothed over one STFT window (the autocorrelation of a window-long box), where a
+        click's height no longer depends on its position between hops; tempo keeps the
+        sharper peaks.
+        """
+        width = max(self.n_fft // self.hop_length, 1)
+        kernel = np.convolve(np.ones(width), np.ones(width))
+        autocorrelation = self.meter_sum / np.maximum(self.meter_weight, 1e-9)
+        mirrored = np.concatenate((autocorrelation[:0:-1], autocorrelation))
+        smoothed = np.convolve(mirrored, kernel / kernel.sum(), mode='same')[self.max_lag:]
+        return {meter: self.peak_near(smoothed, meter * lag)
+                for meter in self.meters if meter * lag <= self.max_lag}
+
+    def detect_time_signature(self):
+        """Beats per measure: the multiple of the beat period where accents recur most strongly."""
+        lag = self.beat_lag()
+        if lag is None:
+            return 4
+        strengths = self.meter_strengths(lag)
+        if not strengths:
+            return 4
+        return max(strengths, key=strengths.get)
+
+    def estimate_key(self):
+        """Best of the 24 major/minor keys by correlation of the chroma with the key profiles."""
+        chroma = self.chroma_sum - self.chroma_sum.mean()
+        norm = np.linalg.norm(chroma)
+        if norm == 0:
+            return None
+        correlations = self.key_profiles @ (chroma / norm)
+        best = int(np.argmax(correlations))
+        return f"{self.key_names[best % 12]} {'major' if best < 12 else 'minor'}"
+
+    def result(self):
+        return {
+            'seconds': self.seconds,
+            'bpm': self.estimate_bpm(),
+            'beats_in_measure': self.detect_time_signature(),
+            'key': self.estimate_key(),
+        }
+
+
+def synthetic_tone(midi_notes, seconds, sample_rate=44100, harmonics=4):
+    """Harmonic tones (1/k partial amplitudes, decaying envelope) for the given MIDI notes, mixed."""
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    envelope = np.exp(-t * 1.5)
+    mix = np.zeros_like(t)
+    for note in midi_notes:
+        frequency = 440.0 * 2 ** ((note - 69) / 12)
+        for k in range(1, harmonics + 1):
+            if k * frequency < sample_rate / 2:
+                mix += np.sin(2 * np.pi * k * frequency * t) / k
+    return (0.2 * mix * envelope / max(len(midi_notes), 1)).astype(np.float32)
+
+
+def benchmark_key_detection(sample_rate=44100, seconds_per_chord=1.5, methods=('cqt', 'stft')):
+    """Accuracy and CPU time of the chroma paths on synthetic tones and chord progressions.
+
+    Tones: each of the 12 pitch classes alone (strongest chroma bin must match).
+    Progressions: I-IV-V-I in all 12 major keys and i-iv-V-i in all 12 minor keys,
+    with a bass note under each triad (estimated key must match).
+    """
+    tones = [(pitch, synthetic_tone([60 + pitch], 3.0, sample_rate)) for pitch in range(12)]
+    major = [(0, 4, 7), (5, 9, 12), (7, 11, 14), (0, 4, 7)]
+    minor = [(0, 3, 7), (5, 8, 12), (7, 11, 14), (0, 3, 7)]
+    progressions = []
+    for mode, chords in (('major', major), ('minor', minor)):
+        for tonic in range(12):
+            song = np.concatenate([
+                synthetic_tone([48 + tonic + chord[0]] + [60 + tonic + n for n in chord],
+                               seconds_per_chord, sample_rate)
+                for chord in chords])
+            progressions.append((f"{IncrementalAnalyzer.key_names[tonic]} {mode}", song))
+
+    def run(method, audio):
+        analyzer = IncrementalAnalyzer(sample_rate, chroma=method)
+        started = time.process_time()
+        for start in range(0, len(audio), sample_rate):  # one-second snapshots, as in the widget
+            analyzer.update(start, audio[start:start + sample_rate])
+        return analyzer, time.process_time() - started
+
+    results = {}
+    for method in methods:
+        cpu = 0.0
+        audio_seconds = 0.0
+        tone_hits = key_hits = 0
+        for pitch, audio in tones:
+            analyzer, elapsed = run(method, audio)
+            tone_hits += int(np.argmax(analyzer.chroma_sum)) == pitch
+            cpu += elapsed
+            audio_seconds += len(audio) / sample_rate
+        misses = []
+        for key, audio in progressions:
+            analyzer, elapsed = run(method, audio)
+            estimate = analyzer.estimate_key()
+            if estimate == key:
+                key_hits += 1
+            else:
+                misses.append(f"{key} -> {estimate}")
+            cpu += elapsed
+            audio_seconds += len(audio) / sample_rate
+        results[method] = {
+            'tone_accuracy': tone_hits / len(tones),
+            'key_accuracy': key_hits / len(progressions),
+            'cpu_per_audio_second': cpu / audio_seconds,
+            'misses': misses,
+        }
+        print(f"{method}: tones {tone_hits}/{len(tones)}, keys {key_hits}/{len(progressions)}, "
+              f"{cpu / audio_seconds * 1000:.1f} ms CPU per second of audio")
+        for miss in misses:
+            print(f"  {miss}")
+    return results
+
+
+def click_track(bpm, beats_in_measure, seconds, sample_rate=44100, noise=0.01, seed=0, lead_in=0.25):
+    """Decaying 1 kHz clicks on every beat, the first beat of each measure twice as loud.
+
+    A faint noise floor stands in for the room: on digital silence the log-spectral flux
+    depends on where a click falls within the frame more than on how loud it is. The first
+    click comes after `lead_in` seconds, as a click in the very first frame has no flux.
+    """
+    rng = np.random.default_rng(seed)
+    audio = (noise * rng.standard_normal(int(seconds * sample_rate))).astype(np.float32)
+    t = np.arange(int(0.03 * sample_rate)) / sample_rate
+    click = (np.sin(2 * np.pi * 1000 * t) * np.exp(-t * 150)).astype(np.float32)
+    period = 60.0 / bpm * sample_rate
+    for beat in range(int(len(audio) / period) + 1):
+        start = int(round(lead_in * sample_rate + beat * period))
+        if start >= len(audio):
+            break
+        amplitude = 1.0 if beat % beats_in_measure == 0 else 0.5
+        piece = click[:len(audio) - start]
+        audio[start:start + len(piece)] += amplitude * piece
+    return audio
+
+
+def check_tempo_detection(sample_rate=44100, seconds=12, tolerance=1.0, chroma='stft',
+                          bpms=(72, 90, 100, 117, 120, 128, 140, 160), meters=(3, 4),
+                          steps=((120, 140), (100, 128), (140, 120)), settle_bound=8):
+    """Regression set: synthetic click tracks at known tempi and meters.
+
+    Each track is fed in one-second snapshots as in the widget; the final BPM must be within
+    `tolerance` and the meter exact. Step changes play `seconds` of one tempo and then 16
+    seconds of another; from at most `settle_bound` seconds after the change on, every
+    estimate must be within `tolerance` of the new tempo. Returns the list of failures
+    (empty when all pass).
+    """
+    failures = []
+    costs = []
+
+    def run(audio):
+        analyzer = IncrementalAnalyzer(sample_rate, chroma=chroma)
+        results = []
+        for start in range(0, len(audio), sample_rate):
+            started = time.perf_counter()
+            results.append(analyzer.update(start, audio[start:start + sample_rate]))
+            costs.append(time.perf_counter() - started)
+        return results
+
+    for bpm in bpms:
+        for meter in meters:
+            result = run(click_track(bpm, meter, seconds, sample_rate))[-1]
+            estimate = result['bpm']
+            ok = (estimate is not None and abs(estimate - bpm) <= tolerance
+                  and result['beats_in_measure'] == meter)
+            shown = '--' if estimate is None else f"{estimate:.2f}"
+            print(f"{bpm:5.1f} BPM {meter}/4: {shown} BPM {result['beats_in_measure']}/4"
+                  f"{'' if ok else '  FAIL'}")
+            if not ok:
+                failures.append((bpm, meter, estimate, result['beats_in_measure']))
+    for before, after in steps:
+        audio = np.concatenate((click_track(before, 4, seconds, sample_rate),
+                                click_track(after, 4, 16, sample_rate, seed=1)))
+        estimates = [result['bpm'] for result in run(audio)[seconds:]]
+        # Seconds after the change until the estimate stays within tolerance of the new tempo
+        settle = len(estimates)
+        while (settle > 0 and estimates[settle - 1] is not None
+               and abs(estimates[settle - 1] - after) <= tolerance):
+            settle -= 1
+        ok = settle <= settle_bound
+        print(f"{before:5.1f} -> {after:5.1f} BPM: settled after {settle} s{'' if ok else '  FAIL'}")
+        if not ok:
+            failures.append((before, after, settle))
+    print(f"{len(failures)} failures, {np.mean(costs) * 1000:.1f} ms per one-second update")
+    return failures
+
+
+class MainLoopProbe:
+    """Frame-time probe: how late a periodic main-loop timer fires, i.e. how long the loop stalled.
+
+    Prints max / 99th percentile / total stall every `report_every` seconds.
+    """
+
+    def __init__(self, interval_ms=10, report_every=5.0, label="main loop"):
+        self.interval = interval_ms / 1000
+        self.report_every = report_every
+        self.label = label
+        self.stalls = []
+        self.last = None
+        self.report_start = time.perf_counter()
+        GLib.timeout_add(interval_ms, self.tick)
+
+    def tick(self):
+        now = time.perf_counter()
+        if self.last is not None:
+            self.stalls.append(max(0.0, now - self.last - self.interval))
+        self.last = now
+        if now - self.report_start >= self.report_every and self.stalls:
+            self.report()
+            self.report_start = now
+        return True
+
+    def report(self):
+        stalls = np.array(self.stalls) * 1000
+        print(f"{self.label}: {len(stalls)} ticks, max stall {stalls.max():.1f} ms, "
+              f"p99 {np.percentile(stalls, 99):.1f} ms, total {stalls.sum():.0f} ms")
+        self.stalls = []
+
+
 class AudioAnalyzerWidget(Gtk.ApplicationWindow):
-    def __init__(self, app):
+    def __init__(self, app, analysis_mode="worker", probe=False, chroma="cqt"):
         super().__init__(application=app)
         self.set_title("Audio Analyzer")
         self.set_default_size(300, 150)
@@ -22,12 +547,17 @@ class AudioAnalyzerWidget(Gtk.ApplicationWindow):
         Gst.init(None)
 
         # Audio processing variables
-        self.audio_queue = queue.Queue()
         self.sample_rate = 44100
         self.buffer_duration = 10  # Exactly 10 seconds buffer
-        self.buffer = np.zeros(self.sample_rate * self.buffer_duration)
-        self.buffer_filled = False
-        self.last_analysis_time = time.time()
+        self.buffer = RingBuffer(self.sample_rate * self.buffer_duration)
+        self.analyzer = IncrementalAnalyzer(self.sample_rate, window=self.buffer_duration, chroma=chroma)
+        self.publish_interval = 1.0  # seconds between analysis updates
+        self.min_seconds = 3.0  # show results once this much audio has been analysed
+        self.analysis_mode = analysis_mode
+        self.analyzed_position = 0
+        self.stop_event = threading.Event()
+        self.result_lock = threading.Lock()
+        self.pending_result = None
 
         # Create layout
         self.box = Gtk.Box()
@@ -59,9 +589,15 @@ class AudioAnalyzerWidget(Gtk.ApplicationWindow):
         # Setup GStreamer pipeline
         self.setup_gst_pipeline()
 
-        # Update timer - process queue frequently but analyze every 10s
-        GLib.timeout_add(100, self.process_queue)
-        GLib.timeout_add(10000, self.trigger_analysis)
+        # Samples go straight into the ring buffer from on_new_sample; a worker analyses
+        # snapshots of the new audio once a second and posts results to the main loop.
+        # "main" runs the same analysis on the GTK thread, for comparison with --probe
+        if analysis_mode == "main":
+            GLib.timeout_add(int(self.publish_interval * 1000), self.analyze_on_main_loop)
+        else:
+            self.analysis_thread = threading.Thread(target=self.analysis_loop, daemon=True)
+            self.analysis_thread.start()
+        self.probe = MainLoopProbe(label=f"main loop ({analysis_mode} analysis)") if probe else None
 
     def setup_gst_pipeline(self):
         pipeline_desc = (
@@ -83,167 +619,102 @@ class AudioAnalyzerWidget(Gtk.ApplicationWindow):
 
         success, map_info = buffer.map(Gst.MapFlags.READ)
         if success:
-            data = np.frombuffer(map_info.data, dtype=np.float32)
-            self.audio_queue.put(data)
+            # Copied into the ring before unmap, so the mapped memory is not kept
+            self.buffer.write(np.frombuffer(map_info.data, dtype=np.float32))
             buffer.unmap(map_info)
 
         return Gst.FlowReturn.OK
 
-    def detect_time_signature(self, onset_env):
-        peaks, _ = find_peaks(onset_env, distance=20)
-        if len(peaks) < 2:
-            return 4
-
-        peak_distances = np.diff(peaks)
-        if len(peak_distances) == 0:
-            return 4
-
-        median_distance = np.median(peak_distances)
-        beats_estimate = round(median_distance / (self.sample_rate / 120))
-
-        if beats_estimate <= 3:
-            return 3
-        elif beats_estimate <= 4:
-            return 4
-        elif beats_estimate <= 6:
-            return 6
-        else:
-            return 4
-
-    def estimate_bpm(self, onset_env):
-        # Find peaks in onset envelope
-        peaks, _ = find_peaks(
-            onset_env,
-            distance=int(0.2 * self.sample_rate / 512),  # Minimum 0.2s between peaks
-            prominence=0.5
-        )
-
-        if len(peaks) < 2:
-            return None
-
-        # Calculate average time between peaks
-        peak_times = peaks * 512 / self.sample_rate  # Convert to seconds
-        intervals = np.diff(peak_times)
+    def analyze_new_audio(self):
+        start, samples = self.buffer.snapshot(self.analyzed_position)
+        self.analyzed_position = start + len(samples)
+        return self.analyzer.update(start, samples)
 
-        # Convert intervals to BPM
-        bpms = 60.0 / intervals
+    def analysis_loop(self):
+        """Worker thread: incremental analysis of newly arrived audio every publish_interval.
 
-        # Filter out unreasonable BPM values
-        valid_bpms = bpms[(bpms >= 50) & (bpms <= 200)]
-
-        if len(valid_bpms) == 0:
-            return None
-
-        # Use median for stability
-        return float(np.median(valid_bpms))
+        A slow run is not queued up: the next snapshot simply covers everything since.
+        """
+        elapsed = 0.0
+        while not self.stop_event.wait(max(0.0, self.publish_interval - elapsed)):
+            started = time.perf_counter()
+            try:
+                self.post_result(self.analyze_new_audio())
+            except Exception as e:
+                print(f"Analysis error: {e}")
+            elapsed = time.perf_counter() - started
 
-    def analyze_audio(self):
+    def analyze_on_main_loop(self):
         try:
-            if not self.buffer_filled:
-                if np.count_nonzero(self.buffer) < self.buffer.size * 0.8:
-                    return None, 4, "Buffering..."
-                self.buffer_filled = True
-
-            audio_normalized = librosa.util.normalize(self.buffer)
-
-            # Onset and tempo detection
-            onset_env = librosa.onset.onset_strength(
-                y=audio_normalized,
-                sr=self.sample_rate,
-                hop_length=512,
-                aggregate=np.median
-            )
-
-            # BPM estimation
-            bpm = self.estimate_bpm(onset_env)
-            if bpm is None:
-                bpm = 0.0
-
-            # Time signature detection
-            beats_in_measure = self.detect_time_signature(onset_env)
-
-            # Key detection
-            chroma = librosa.feature.chroma_cqt(
-                y=audio_normalized,
-                sr=self.sample_rate,
-                hop_length=512
-            )
-
-            key_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-            chroma_mean = np.mean(chroma, axis=1)
-            key_idx = int(np.argmax(chroma_mean))
-            key = key_names[key_idx]
-
-            minor_template = np.roll([1, 0, 1, 1, 0, 1, 0, 1, 1, 0, 1, 0], key_idx)
-            major_template = np.roll([1, 0, 1, 0, 1, 1, 0, 1, 0, 1, 0, 1], key_idx)
-
-            minor_correlation = float(np.correlate(chroma_mean, minor_template)[0])
-            major_correlation = float(np.correlate(chroma_mean, major_template)[0])
-
-            is_major = major_correlation > minor_correlation
-            key = f"{key} {'major' if is_major else 'minor'}"
-
-            return bpm, beats_in_measure, key
-
+            self.update_labels(self.analyze_new_audio())
         except Exception as e:
             print(f"Analysis error: {e}")
-            return None, 4, "Analysis error"
-
-    def process_queue(self):
-        """Process incoming audio data and update buffer"""
-        while not self.audio_queue.empty():
-            try:
-                audio_data = self.audio_queue.get_nowait()
-                data_len = len(audio_data)
-                self.buffer = np.roll(self.buffer, -data_len)
-                self.buffer[-data_len:] = audio_data
-            except queue.Empty:
-                break
-            except Exception as e:
-                print(f"Buffer update error: {e}")
-
-        return True
-
-    def trigger_analysis(self):
-        """Trigger analysis every 10 seconds"""
-        current_time = time.time()
-        if current_time - self.last_analysis_time >= 10:
-            bpm, time_sig, key = self.analyze_audio()
-
-            def update_labels():
-                if not self.buffer_filled:
-                    self.status_label.set_text("Status: Buffering...")
-                else:
-                    self.status_label.set_text(f"Status: Analyzing {self.buffer_duration}s window")
-
-                if bpm is not None:
-                    self.bpm_label.set_text(f"BPM: {bpm:.1f}")
-                    self.time_sig_label.set_text(f"Time Signature: {time_sig}/4")
-                    self.key_label.set_text(f"Key: {key}")
-                return False
-
-            GLib.idle_add(update_labels)
-            self.last_analysis_time = current_time
-
-        return True
+        return not self.stop_event.is_set()
+
+    def post_result(self, result):
+        """Hand the newest result to the main loop; at most one label update is ever queued."""
+        with self.result_lock:
+            queued = self.pending_result is not None
+            self.pending_result = result
+        if not queued:
+            GLib.idle_add(self.apply_result)
+
+    def apply_result(self):
+        with self.result_lock:
+            result, self.pending_result = self.pending_result, None
+        self.update_labels(result)
+        return False
+
+    def update_labels(self, result):
+        if result['seconds'] < self.min_seconds:
+            self.status_label.set_text("Status: Buffering...")
+            return False
+
+        self.status_label.set_text(f"Status: Analyzing {self.buffer_duration}s window")
+        if result['bpm'] is not None:
+            self.bpm_label.set_text(f"BPM: {result['bpm']:.1f}")
+        self.time_sig_label.set_text(f"Time Signature: {result['beats_in_measure']}/4")
+        if result['key'] is not None:
+            self.key_label.set_text(f"Key: {result['key']}")
+        return False
 
     def do_destroy(self):
+        self.stop_event.set()
         self.pipeline.set_state(Gst.State.NULL)
         Gtk.Window.do_destroy(self)
 
 class AudioAnalyzerApp(Gtk.Application):
-    def __init__(self):
+    def __init__(self, analysis_mode="worker", probe=False, chroma="cqt"):
         super().__init__(application_id="com.example.audioanalyzer")
         self.window = None
+        self.analysis_mode = analysis_mode
+        self.probe = probe
+        self.chroma = chroma
 
     def do_activate(self):
         if not self.window:
-            self.window = AudioAnalyzerWidget(self)
+            self.window = AudioAnalyzerWidget(self, self.analysis_mode, self.probe, self.chroma)
         self.window.present()
 
 def main():
-    app = AudioAnalyzerApp()
-    return app.run(sys.argv)
+    parser = argparse.ArgumentParser(description="Audio Analyzer")
+    parser.add_argument("--analysis", choices=["worker", "main"], default="worker",
+                        help="Run analysis on a worker thread (default) or on the GTK main loop")
+    parser.add_argument("--probe", action="store_true", help="Print main-loop stall times every 5 s")
+    parser.add_argument("--chroma", choices=["cqt", "stft"], default="cqt",
+                        help="Key detection front end: constant-Q (default) or fast decimated STFT")
+    parser.add_argument("--benchmark-key", action="store_true",
+                        help="Compare accuracy and CPU time of both chroma paths on synthetic audio, then exit")
+    parser.add_argument("--check-tempo", action="store_true",
+                        help="Run tempo/meter detection on synthetic click tracks, then exit")
+    args, gtk_args = parser.parse_known_args()
+    if args.benchmark_key:
+        benchmark_key_detection()
+        return 0
+    if args.check_tempo:
+        return 1 if check_tempo_detection(chroma=args.chroma) else 0
+    app = AudioAnalyzerApp(args.analysis, args.probe, args.chroma)
+    return app.run(sys.argv[:1] + gtk_args)
 
 if __name__ == "__main__":
     main()
@@ -1,23 +1,2181 @@
-import gi
-import random
 import time
 import threading
 import pygame
 import json
 import os
+import heapq
+import sys
+import argparse
+import glob
+import hashlib
+import io
+import traceback
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, wraps
 from midiutil import MIDIFile
 from pydub import AudioSegment
 from pydub.effects import normalize
 import numpy as np
-gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, GLib, Gdk
+try:
+    import gi
+    gi.require_version('Gtk', '3.0')
+    from gi.repository import Gtk, GLib, Gdk
+except (ImportError, ValueError):
+    # Komendy bez wyświetlacza (render, batch-enhance, bulk-midi...) nie potrzebują GTK
+    Gtk = GLib = Gdk = None
 import warnings
 warnings.filterwarnings("ignore", category=SyntaxWarning)
 import sqlite3
 import librosa
 import soundfile as sf
+from scipy.signal import fftconvolve, oaconvolve
+
+
+INSTRUMENTS = ['Talerz', 'Stopa', 'Werbel', 'TomTom']
+RHYTHM_TYPES = {
+    'single': {'notes': 1, 'speed': 1.0, 'swing': 0.0},  # Pojedyncza nuta
+    'double': {'notes': 2, 'speed': 0.5, 'swing': 0.0},  # Dwie nuty w kroku
+    'burst': {'notes': 3, 'speed': 0.25, 'swing': 0.0},  # Szybki burst (trzy nuty)
+    'swing': {'notes': 2, 'speed': 0.5, 'swing': 0.2},   # Dwie nuty ze swingiem
+    'accent': {'notes': 1, 'speed': 1.0, 'swing': 0.0}   # Pojedyncza nuta z akcentem
+}
+NOMINAL_ADSR = {
+    'Talerz': {'attack': 0.01, 'decay': 0.1, 'sustain': 0.8, 'release': 0.6},
+    'Stopa': {'attack': 0.01, 'decay': 0.2, 'sustain': 0.3, 'release': 0.1},
+    'Werbel': {'attack': 0.02, 'decay': 0.2, 'sustain': 0.4, 'release': 0.3},
+    'TomTom': {'attack': 0.03, 'decay': 0.3, 'sustain': 0.5, 'release': 0.4}
+}
+STEPS_PER_BPM = 4
+ACCENT_GAIN = 1.2
+RHYTHM_NAMES = list(RHYTHM_TYPES)
+RHYTHM_CODES = {name: code for code, name in enumerate(RHYTHM_NAMES)}
+RHYTHM_NOTES = np.array([RHYTHM_TYPES[name]['notes'] for name in RHYTHM_NAMES], dtype=np.int64)
+
+
+class PatternStep:
+    """Widok jednego kroku jak dawny słownik {'active': bool, 'rhythm_type': str}."""
+
+    __slots__ = ('pattern', 'row', 'step')
+    KEYS = ('active', 'rhythm_type', 'velocity', 'timing')
+
+    def __init__(self, pattern, row, step):
+        self.pattern = pattern
+        self.row = row
+        self.step = step
+
+    def __getitem__(self, key):
+        p, r, s = self.pattern, self.row, self.step
+        if key == 'active':
+            return bool(p.active[r, s])
+        if key == 'rhythm_type':
+            return RHYTHM_NAMES[p.rhythm[r, s]]
+        if key == 'velocity':
+            return float(p.velocity[r, s])
+        if key == 'timing':
+            return float(p.timing[r, s])
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        p, r, s = self.pattern, self.row, self.step
+        if key == 'active':
+            p.active[r, s] = bool(value)
+        elif key == 'rhythm_type':
+            p.rhythm[r, s] = RHYTHM_CODES[value]
+        elif key == 'velocity':
+            p.velocity[r, s] = value
+        elif key == 'timing':
+            p.timing[r, s] = value
+        else:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.KEYS
+
+    def copy(self):
+        return {key: self[key] for key in self.KEYS}
+
+    def __eq__(self, other):
+        if isinstance(other, (PatternStep, dict)):
+            return all(self[key] == other.get(key, default) for key, default in
+                       (('active', False), ('rhythm_type', 'single'), ('velocity', 1.0), ('timing', 0.0)))
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+class PatternRow:
+    """Widok kroków jednego instrumentu (sekwencja PatternStep)."""
+
+    __slots__ = ('pattern', 'row')
+
+    def __init__(self, pattern, row):
+        self.pattern = pattern
+        self.row = row
+
+    def __len__(self):
+        return self.pattern.length
+
+    def __getitem__(self, step):
+        if isinstance(step, slice):
+            return [self[i] for i in range(*step.indices(len(self)))]
+        if step < 0:
+            step += len(self)
+        if not 0 <= step < len(self):
+            raise IndexError(step)
+        return PatternStep(self.pattern, self.row, step)
+
+    def __setitem__(self, step, value):
+        self.pattern.set_step(self.row, step, value)
+
+    def __iter__(self):
+        return (PatternStep(self.pattern, self.row, i) for i in range(len(self)))
+
+
+class Pattern:
+    """Wzorzec sekwencera na tablicach NumPy: instrumenty x kroki.
+
+    `active` (bool), `rhythm` (kod typu rytmu, int8), `velocity` (mnożnik głośności) i
+    `timing` (mikroprzesunięcie w ułamku kroku). Indeksowanie `pattern[inst][step]['active']`
+    zachowuje API dawnego słownika list słowników. Tryb prosty sekwencera to widok tych samych
+    danych: liczy się tylko `active`, każdy krok gra jak 'single'.
+    """
+
+    def __init__(self, instruments=INSTRUMENTS, length=16, active=None, rhythm=None, velocity=None, timing=None):
+        self.instruments = list(instruments)
+        self._index = {inst: i for i, inst in enumerate(self.instruments)}
+        shape = (len(self.instruments), length)
+        self.active = np.zeros(shape, dtype=bool) if active is None else np.asarray(active, dtype=bool)
+        self.rhythm = np.zeros(shape, dtype=np.int8) if rhythm is None else np.asarray(rhythm, dtype=np.int8)
+        self.velocity = np.ones(shape, dtype=np.float32) if velocity is None else np.asarray(velocity, dtype=np.float32)
+        self.timing = np.zeros(shape, dtype=np.float32) if timing is None else np.asarray(timing, dtype=np.float32)
+
+    @classmethod
+    def from_dict(cls, data, instruments=None):
+        """Z zapisu projektu: listy słowników (tryb zaawansowany) albo list 0/1."""
+        instruments = list(instruments or data.keys())
+        length = max((len(data.get(inst, [])) for inst in instruments), default=0)
+        pattern = cls(instruments, length)
+        for inst in instruments:
+            for step, value in enumerate(data.get(inst, [])):
+                pattern.set_step(pattern.index(inst), step, value)
+        return pattern
+
+    @classmethod
+    def from_project(cls, project, instruments=INSTRUMENTS):
+        """Wzorzec z projektu .drsmp: nowy klucz "pattern" albo starsze osobne modele trybów."""
+        advanced = project.get("advanced_sequencer_mode", False)
+        for key in ("pattern", "advanced_patterns" if advanced else "simple_patterns", "patterns",
+                    "simple_patterns", "advanced_patterns"):
+            if key in project:
+                pattern = cls.from_dict(project[key], instruments)
+                if pattern.length:
+                    return pattern
+        return cls(instruments, 16)
+
+    def to_simple(self):
+        """Widok trybu prostego jako listy 0/1 (dla starszych wersji programu)."""
+        return {inst: self.active[i].astype(int).tolist() for i, inst in enumerate(self.instruments)}
+
+    def to_dict(self):
+        """Format zapisu projektu (zgodny ze starszymi wersjami)."""
+        names = np.array(RHYTHM_NAMES)[self.rhythm]
+        return {inst: [{'active': bool(a), 'rhythm_type': str(r)} for a, r in zip(self.active[i], names[i])]
+                for i, inst in enumerate(self.instruments)}
+
+    @property
+    def length(self):
+        return self.active.shape[1]
+
+    def index(self, inst):
+        return self._index[inst]
+
+    def __getitem__(self, inst):
+        return PatternRow(self, self._index[inst])
+
+    def __setitem__(self, inst, steps):
+        row = self._index[inst]
+        self.clear_row(inst)
+        for step, value in enumerate(steps[:self.length]):
+            self.set_step(row, step, value)
+
+    def __contains__(self, inst):
+        return inst in self._index
+
+    def __iter__(self):
+        return iter(self.instruments)
+
+    def keys(self):
+        return list(self.instruments)
+
+    def items(self):
+        return [(inst, self[inst]) for inst in self.instruments]
+
+    def set_step(self, row, step, value):
+        if isinstance(value, (PatternStep, dict)):
+            self.active[row, step] = bool(value.get('active', False))
+            self.rhythm[row, step] = RHYTHM_CODES[value.get('rhythm_type', 'single')]
+            self.velocity[row, step] = value.get('velocity', 1.0)
+            self.timing[row, step] = value.get('timing', 0.0)
+        else:
+            self.active[row, step] = bool(value)
+            self.rhythm[row, step] = 0
+
+    def set_row(self, inst, mask, rhythm_type='single', start=0):
+        """Ustawia aktywność kroków [start, start+len(mask)) i typ rytmu wszędzie, jak presety."""
+        row = self._index[inst]
+        mask = np.asarray(mask, dtype=bool)
+        end = min(self.length, start + len(mask))
+        self.active[row, start:end] = mask[:end - start]
+        self.rhythm[row, start:end] = RHYTHM_CODES[rhythm_type] if isinstance(rhythm_type, str) else \
+            np.asarray(rhythm_type)[:end - start]
+
+    def clear_row(self, inst):
+        row = self._index[inst]
+        self.active[row] = False
+        self.rhythm[row] = 0
+        self.velocity[row] = 1.0
+        self.timing[row] = 0.0
+
+    def swap(self, inst1, inst2, step):
+        a, b = self._index[inst1], self._index[inst2]
+        for array in (self.active, self.rhythm, self.velocity, self.timing):
+            array[[a, b], step] = array[[b, a], step]
+
+    def _arrays(self):
+        return self.active, self.rhythm, self.velocity, self.timing
+
+    def _replace(self, arrays):
+        self.active, self.rhythm, self.velocity, self.timing = arrays
+
+    def assign(self, other):
+        """Przejmuje kroki innego wzorca w miejscu (odtwarzanie trzyma referencję do tego obiektu)."""
+        self._replace([array.copy() for array in other._arrays()])
+
+    def resize(self, length):
+        """Zmienia długość w miejscu: obcina albo dopełnia pustymi krokami."""
+        if length <= self.length:
+            self._replace([array[:, :length].copy() for array in self._arrays()])
+        else:
+            extra = length - self.length
+            fill = Pattern(self.instruments, extra)
+            self._replace([np.concatenate([a, b], axis=1) for a, b in zip(self._arrays(), fill._arrays())])
+
+    def steps(self, start, stop=None):
+        """Kopia fragmentu kroków [start, stop)."""
+        return Pattern(self.instruments, 0, *(array[:, start:stop].copy() for array in self._arrays()))
+
+    def tile(self, length):
+        """Nowy wzorzec o długości `length`, powtarzający ten cyklicznie."""
+        index = np.arange(length) % max(self.length, 1)
+        return Pattern(self.instruments, 0, *(array[:, index] for array in self._arrays()))
+
+    def copy(self):
+        return Pattern(self.instruments, 0, *(array.copy() for array in self._arrays()))
+
+    @classmethod
+    def concat(cls, patterns):
+        """Wzorce sklejone w czasie (te same instrumenty)."""
+        patterns = list(patterns)
+        arrays = zip(*(p._arrays() for p in patterns))
+        return cls(patterns[0].instruments, 0, *(np.concatenate(a, axis=1) for a in arrays))
+
+    def fingerprint(self):
+        """Skrót zawartości; zmienia się przy każdej edycji kroków."""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr(self.instruments).encode())
+        for array in self._arrays():
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    def note_counts(self):
+        """Liczba nut w każdym kroku (0 dla nieaktywnych), I x N."""
+        return np.where(self.active, RHYTHM_NOTES[self.rhythm], 0)
+
+    def __repr__(self):
+        return f"Pattern({self.instruments}, length={self.length}, active={int(self.active.sum())})"
+
+
+def new_seed():
+    """Świeże losowe ziarno (uint32), do zapisania obok wyniku."""
+    return int(np.random.SeedSequence().generate_state(1)[0])
+
+
+def spawn_seed(seed_sequence):
+    """Kolejne ziarno potomne; ciąg ziaren zależy tylko od ziarna głównego."""
+    return int(seed_sequence.spawn(1)[0].generate_state(1)[0])
+
+
+def as_rng(rng=None):
+    """Generator NumPy z ziarna; gotowy Generator przechodzi bez zmian, None daje świeże ziarno."""
+    if isinstance(rng, np.random.Generator):
+        return rng
+    return np.random.default_rng(rng)
+
+
+def memoized_generator(func):
+    """Zapamiętuje wynik generatora po (parametry, seed) i zwraca kopie, bo wzorce są mutowalne."""
+    cached = lru_cache(maxsize=64)(func)
+
+    @wraps(func)
+    def generator(*args, seed, **kwargs):
+        return cached(*args, seed=int(seed), **kwargs).copy()
+
+    generator.cache_info = cached.cache_info
+    generator.cache_clear = cached.cache_clear
+    return generator
+
+
+# Reguła kroków: włącza kroki, dla których krok % every jest w `at`, z prawdopodobieństwem `chance`.
+# Typ rytmu: nazwa, krotka nazw (losowanie równomierne) albo słownik {nazwa: waga}.
+StepRule = namedtuple('StepRule', ['every', 'at', 'rhythm', 'chance'], defaults=(1.0,))
+
+PRESET_RULES = {
+    "Basic Techno": {
+        'Stopa': [StepRule(4, 0, 'single')],
+        'Werbel': [StepRule(8, 4, 'swing')],
+        'Talerz': [StepRule(4, 2, 'burst')],
+        'TomTom': [StepRule(16, 14, 'accent')],
+    },
+    "Minimal Techno": {
+        'Stopa': [StepRule(4, 0, 'single'), StepRule(16, 14, 'single')],
+        'Werbel': [StepRule(8, 4, 'swing')],
+        'Talerz': [StepRule(2, 0, 'double')],
+        'TomTom': [StepRule(16, 10, 'accent')],
+    },
+    "Hard Techno": {
+        'Stopa': [StepRule(2, 0, 'burst')],
+        'Werbel': [StepRule(8, (4, 6), 'swing')],
+        'Talerz': [StepRule(4, 0, 'double')],
+        'TomTom': [StepRule(8, 7, 'accent')],
+    },
+}
+
+# Kroki wzorca perkusji piosenki strukturalnej (generate_drum_pattern); krok = takt sekcji
+DRUM_STYLE_RULES = {
+    "Techno": {
+        'Stopa': [StepRule(4, 0, 'single')],
+        'Werbel': [StepRule(8, 4, 'swing')],
+        'Talerz': [StepRule(4, 2, 'burst', 0.3)],
+        'TomTom': [StepRule(16, 14, 'accent', 0.3)],
+    },
+    "House": {
+        'Stopa': [StepRule(4, (0, 2), 'double')],
+        'Werbel': [StepRule(8, 4, 'single')],
+        'Talerz': [StepRule(8, 4, 'swing', 0.25)],
+        'TomTom': [StepRule(16, 12, 'single')],
+    },
+}
+
+RANDOM_PATTERN_RULES = {
+    'Stopa': [StepRule(4, 0, {'single': 0.5, 'double': 0.5}, 0.5)],
+    'Werbel': [StepRule(4, 2, {'single': 0.7, 'swing': 0.3})],
+    'Talerz': [StepRule(2, 0, {'single': 0.5, 'burst': 0.5}, 0.5)],
+    'TomTom': [StepRule(8, 7, 'accent', 0.5)],
+}
+
+CUSTOM_RHYTHM_STYLES = {
+    "Techno": {'Stopa': ['single'], 'Werbel': ['swing'], 'Talerz': ['burst'], 'TomTom': ['accent']},
+    "House": {'Stopa': ['double'], 'Werbel': ['single'], 'Talerz': ['swing'], 'TomTom': ['single']},
+    "Drum and Bass": {'Stopa': ['burst'], 'Werbel': ['swing'], 'Talerz': ['double'], 'TomTom': ['accent']},
+    "Ambient": {'Stopa': ['single'], 'Werbel': ['double'], 'Talerz': ['swing'], 'TomTom': ['single']},
+    "Trap": {'Stopa': ['double'], 'Werbel': ['burst'], 'Talerz': ['single'], 'TomTom': ['accent']},
+    "Dubstep": {'Stopa': ['single'], 'Werbel': ['swing'], 'Talerz': ['burst'], 'TomTom': ['double']},
+    "Jazz": {'Stopa': ['swing'], 'Werbel': ['double'], 'Talerz': ['single'], 'TomTom': ['accent']},
+    "Breakbeat": {'Stopa': ['burst'], 'Werbel': ['swing'], 'Talerz': ['double'], 'TomTom': ['single']}
+}
+DEFAULT_RHYTHM_RULES = {'Stopa': ['single'], 'Werbel': ['single'], 'Talerz': ['single'], 'TomTom': ['single']}
+
+# Progresja Custom Pattern: mnożnik intensywności i czy kroki tylko na siatce co length // occurrences
+CUSTOM_PROGRESSIONS = {
+    "Linear": {'chance': 1.0, 'grid': True},
+    "Dense": {'chance': 0.8, 'grid': False},
+    "Sparse": {'chance': 0.3, 'grid': False},
+    "Random": {'chance': 1.0, 'grid': False},
+}
+# Modyfikacja Custom Pattern: 'keep' usuwa część kroków, 'add' dokłada kroki z mnożnikiem intensywności
+CUSTOM_MODIFICATIONS = {
+    "Simplify": {'keep': 0.5},
+    "More Complex": {'add': 0.2},
+}
+
+
+def _rhythm_choices(rhythm):
+    """Kody i wagi (None: równe) typów rytmu reguły."""
+    if isinstance(rhythm, str):
+        return np.array([RHYTHM_CODES[rhythm]], dtype=np.int8), None
+    names = list(rhythm)
+    weights = None
+    if isinstance(rhythm, dict):
+        weights = np.array([rhythm[name] for name in names], dtype=np.float64)
+        weights /= weights.sum()
+    return np.array([RHYTHM_CODES[name] for name in names], dtype=np.int8), weights
+
+
+def evaluate_rules(rules, length, instruments=INSTRUMENTS, rng=None, count=None):
+    """Maski aktywności i kody rytmu z tabeli reguł, liczone naraz dla całego wzorca.
+
+    Zwraca tablice I x N, a z `count` count x I x N (tyle wariantów jednym przebiegiem).
+    Reguły instrumentu nakładają się: krok włącza każda pasująca, typ rytmu ustala ostatnia;
+    kroki, których nie włączyła żadna reguła, mają typ 'single'.
+    """
+    rng = as_rng(rng)
+    shape = ((count,) if count is not None else ()) + (length,)
+    steps = np.arange(length)
+    active = np.zeros(shape[:-1] + (len(instruments), length), dtype=bool)
+    rhythm = np.full(active.shape, RHYTHM_CODES['single'], dtype=np.int8)
+    for row, inst in enumerate(instruments):
+        inst_rules = rules.get(inst, ())
+        if not inst_rules:
+            continue
+        row_active = np.zeros(shape, dtype=bool)
+        row_rhythm = np.full(shape, RHYTHM_CODES['single'], dtype=np.int8)
+        for rule in inst_rules:
+            mask = np.broadcast_to(np.isin(steps % rule.every, rule.at), shape)
+            if rule.chance < 1:
+                mask = mask & (rng.random(shape) < rule.chance)
+            codes, weights = _rhythm_choices(rule.rhythm)
+            code = codes[0] if len(codes) == 1 else rng.choice(codes, size=shape, p=weights)
+            row_rhythm = np.where(mask, code, row_rhythm)
+            row_active |= mask
+        active[..., row, :] = row_active
+        rhythm[..., row, :] = row_rhythm
+    return active, rhythm
+
+
+def pattern_from_rules(rules, length, instruments=INSTRUMENTS, rng=None):
+    active, rhythm = evaluate_rules(rules, length, instruments, rng)
+    return Pattern(instruments, length, active, rhythm)
+
+
+def custom_pattern_rules(genre, progression, occurrences, intensity, length):
+    """Tabela reguł Custom Pattern: progresja daje kroki, gatunek typy rytmu."""
+    styles = CUSTOM_RHYTHM_STYLES.get(genre, DEFAULT_RHYTHM_RULES)
+    spec = CUSTOM_PROGRESSIONS.get(progression)
+    if spec is None:
+        return {}
+    every = max(1, length // occurrences) if spec['grid'] else 1
+    return {inst: [StepRule(every, 0, tuple(names), intensity * spec['chance'])] for inst, names in styles.items()}
+
+
+@memoized_generator
+def generate_custom_pattern(genre, progression, occurrences, intensity, modification, length,
+                            instruments=tuple(INSTRUMENTS), *, seed):
+    """Wzorzec z reguł gatunku, progresji i modyfikacji (Custom Pattern)."""
+    rng = np.random.default_rng(seed)
+    rules = custom_pattern_rules(genre, progression, occurrences, intensity, length)
+    modification = CUSTOM_MODIFICATIONS.get(modification, {})
+    if 'add' in modification:
+        styles = CUSTOM_RHYTHM_STYLES.get(genre, DEFAULT_RHYTHM_RULES)
+        for inst, names in styles.items():
+            rules.setdefault(inst, []).append(StepRule(1, 0, tuple(names), intensity * modification['add']))
+    pattern = pattern_from_rules(rules, length, instruments, rng)
+    if 'keep' in modification:
+        pattern.active &= rng.random(pattern.active.shape) < modification['keep']
+    return pattern
+
+
+def shuffle_instruments(pattern, probability, rng=None, length=None):
+    """Z prawdopodobieństwem `probability` na krok zamienia miejscami losową parę instrumentów."""
+    rng = as_rng(rng)
+    length = pattern.length if length is None else length
+    count = len(pattern.instruments)
+    if count < 2:
+        return pattern
+    steps = np.flatnonzero(rng.random(length) < probability)
+    first = rng.integers(0, count, size=len(steps))
+    second = (first + rng.integers(1, count, size=len(steps))) % count
+    for step, a, b in zip(steps, first, second):
+        pattern.swap(pattern.instruments[a], pattern.instruments[b], step)
+    return pattern
+
+
+@memoized_generator
+def generate_random_pattern(length, swap_probability=0.0, instruments=tuple(INSTRUMENTS), *, seed):
+    """Losowy groove na siatce dla każdego instrumentu, potem losowe zamiany instrumentów."""
+    rng = np.random.default_rng(seed)
+    pattern = pattern_from_rules(RANDOM_PATTERN_RULES, length, instruments, rng)
+    return shuffle_instruments(pattern, swap_probability, rng)
+
+
+def autofill_pattern(pattern, genre, rng=None, length=None):
+    """Dopełnia puste kroki (30% szans) typami rytmu gatunku; zmienia wzorzec w miejscu."""
+    rng = as_rng(rng)
+    length = pattern.length if length is None else length
+    rules = CUSTOM_RHYTHM_STYLES.get(genre, DEFAULT_RHYTHM_RULES)
+
+    fill = ~pattern.active[:, :length] & (rng.random((len(pattern.instruments), length)) < 0.3)
+    for row, inst in enumerate(pattern.instruments):
+        steps = np.flatnonzero(fill[row])
+        codes = [RHYTHM_CODES[name] for name in rules.get(inst, ['single'])]
+        pattern.active[row, steps] = True
+        pattern.rhythm[row, steps] = rng.choice(codes, size=len(steps))
+    return pattern
+
+
+PATTERN_GENERATORS = {'custom': generate_custom_pattern, 'random': generate_random_pattern}
+
+
+def regenerate_pattern(generation, instruments=INSTRUMENTS):
+    """Odtwarza wzorzec bit w bit z zapisu {'generator', 'params', 'seed'} (np. z projektu)."""
+    generator = PATTERN_GENERATORS[generation['generator']]
+    return generator(**generation['params'], instruments=tuple(instruments), seed=generation['seed'])
+
+
+def check_generation(project, instruments=INSTRUMENTS):
+    """Odtwarza wzorzec z zapisu "generation" projektu i porównuje go z zapisanymi krokami.
+
+    'match': kroki projektu to dokładnie odtworzony wzorzec; 'edited': odtworzenie zgodne z odciskiem
+    z chwili generowania, ale kroki zmieniono później; 'mismatch': generator z tym ziarnem daje dziś
+    inny wzorzec; 'unverified': kroki się różnią, a zapis (starszy) nie ma odcisku; None bez zapisu.
+    """
+    generation = project.get("generation")
+    if not generation:
+        return None
+    rebuilt = regenerate_pattern(generation, instruments)
+    recorded = generation.get('fingerprint')
+    if recorded is not None and rebuilt.fingerprint() != recorded:
+        return 'mismatch'
+    stored = Pattern.from_project(project, instruments)
+    if (stored.length == rebuilt.length and np.array_equal(stored.active, rebuilt.active)
+            and np.array_equal(stored.rhythm, rebuilt.rhythm)):
+        return 'match'
+    return 'edited' if recorded is not None else 'unverified'
+
+
+class VoiceCache:
+    """Cache gotowych do odtworzenia głosów (sample + ADSR + efekty); typ rytmu nie zmienia brzmienia.
+
+    Głos jest renderowany z samego klucza (`render(key)`). Nowe ustawienia renderuje wątek
+    pomocniczy i podmienia głos pod blokadą; do tego czasu `get` zwraca poprzedni głos, więc
+    wątek harmonogramu renderuje tylko instrument, który nie ma jeszcze żadnego głosu.
+    """
 
-class DrumSamplerApp(Gtk.Window):
+    def __init__(self):
+        self._voices = {}
+        self._pending = {}  # slot -> (key, render) czekające na wątek pomocniczy
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="voice-render")
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.renders = 0
+
+    def get(self, instrument, key, render, stale=True):
+        """Głos dla `key`; przy zmienionym kluczu poprzedni głos (i render w tle), chyba że `stale=False`."""
+        # Jeden wpis na (instrument, wariant); zmiana klucza oznacza ponowny render
+        slot = (instrument, key[-1])
+        with self._lock:
+            entry = self._voices.get(slot)
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                return entry[1]
+            if entry is not None and stale:
+                self.stale += 1
+                if self._pending.get(slot, (None,))[0] != key:
+                    self._submit(slot, key, render)
+                return entry[1]
+            self.misses += 1
+        sound = render(key)
+        with self._lock:
+            self._voices[slot] = (key, sound)
+        return sound
+
+    def refresh(self, instrument, key, render):
+        """Renderuje głos od nowa w tle (także przy tym samym kluczu, np. nadpisany plik sampla)."""
+        with self._lock:
+            self._submit((instrument, key[-1]), key, render)
+
+    def _submit(self, slot, key, render):
+        # Kolejne zmiany suwaka nadpisują oczekujący klucz; wątek renderuje tylko najnowszy
+        if slot not in self._pending:
+            self._executor.submit(self._render, slot)
+        self._pending[slot] = (key, render)
+
+    def _render(self, slot):
+        with self._lock:
+            key, render = self._pending.pop(slot)
+        try:
+            sound = render(key)
+        except Exception:
+            traceback.print_exc()
+            return
+        with self._lock:
+            self._voices[slot] = (key, sound)
+            self.renders += 1
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.stale = 0
+            self.renders = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'stale': self.stale, 'renders': self.renders,
+                    'voices': len(self._voices)}
+
+
+class StepScheduler:
+    """Harmonogram z wyprzedzeniem: liczy absolutne czasy zdarzeń i wysyła je z osobnego wątku.
+
+    `plan(n)` zwraca (długość kroku w sekundach, [(offset, payload), ...]) dla n-tego kroku,
+    `dispatch(payloads, due_time)` dostaje wszystkie zdarzenia przypadające na tę samą chwilę
+    razem z ich planowanym czasem (time.perf_counter), żeby mikser mógł je ułożyć co do próbki.
+    """
+
+    def __init__(self, plan, dispatch, lookahead=0.1, steps_per_cycle=16, history=256):
+        self.plan = plan
+        self.dispatch = dispatch
+        self.lookahead = lookahead
+        self.steps_per_cycle = steps_per_cycle
+        self.history = history
+        self.running = False
+        self.thread = None
+        self._queue = []
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._jitter = {}
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def _run(self):
+        clock = time.perf_counter
+        start = clock() + self.lookahead
+        next_step_time = start
+        step = 0
+        self._queue = []
+        while self.running:
+            now = clock()
+            # Planujemy kroki do końca okna wyprzedzenia; czas liczony od startu, więc bez dryfu
+            while next_step_time < now + self.lookahead:
+                duration, events = self.plan(step)
+                for offset, payload in events:
+                    heapq.heappush(self._queue, (next_step_time + offset, self._seq, step, payload))
+                    self._seq += 1
+                next_step_time += duration
+                step += 1
+
+            if self._queue and self._queue[0][0] <= now:
+                due_time = self._queue[0][0]
+                payloads = []
+                steps = set()
+                while self._queue and self._queue[0][0] <= due_time + 0.0005:
+                    _, _, event_step, payload = heapq.heappop(self._queue)
+                    payloads.append(payload)
+                    steps.add(event_step)
+                self.dispatch(payloads, due_time)
+                late_ms = (clock() - due_time) * 1000
+                for event_step in steps:
+                    self._record_jitter(event_step % self.steps_per_cycle, late_ms)
+                continue
+
+            wake = min(self._queue[0][0] if self._queue else next_step_time, next_step_time)
+            wait = wake - clock()
+            # Śpimy do ~1 ms przed zdarzeniem, resztę dociągamy krótkimi drzemkami
+            if wait > 0.002:
+                time.sleep(wait - 0.001)
+            elif wait > 0:
+                time.sleep(0)
+
+    def _record_jitter(self, step, late_ms):
+        with self._lock:
+            samples = self._jitter.get(step)
+            if samples is None:
+                samples = self._jitter[step] = deque(maxlen=self.history)
+            samples.append(late_ms)
+
+    def jitter_stats(self):
+        """Opóźnienie wysyłki względem planu w ms: {krok: (p50, p99)}."""
+        with self._lock:
+            snapshot = {step: np.array(samples) for step, samples in self._jitter.items() if samples}
+        return {step: (float(np.percentile(values, 50)), float(np.percentile(values, 99)))
+                for step, values in sorted(snapshot.items())}
+
+
+def to_stereo_float(sound_array):
+    """int16 z pygame.sndarray -> float32 (n, 2) w zakresie [-1, 1]."""
+    data = np.asarray(sound_array, dtype=np.float32) / 32768.0
+    if data.ndim == 1:
+        data = np.repeat(data[:, None], 2, axis=1)
+    return np.ascontiguousarray(data[:, :2])
+
+
+ECHO_FEEDBACK = 10 ** (-10 / 20)  # każde powtórzenie echa o 10 dB ciszej
+NORMALIZE_PEAK = 10 ** (-0.1 / 20)  # jak pydub.effects.normalize (headroom 0.1 dB)
+
+
+def pitch_resample(data, ratio):
+    """Zmiana wysokości przez resampling liniowy (krótszy sample dla ratio > 1)."""
+    n = len(data)
+    new_n = max(1, int(n / ratio))
+    positions = np.arange(new_n, dtype=np.float64) * ratio
+    idx = np.minimum(positions.astype(np.int64), n - 1)
+    nxt = np.minimum(idx + 1, n - 1)
+    frac = (positions - idx).astype(np.float32)[:, None]
+    return data[idx] * (1 - frac) + data[nxt] * frac
+
+
+@lru_cache(maxsize=32)
+def reverb_impulse(amount, sample_rate):
+    """Odpowiedź impulsowa pogłosu: szum z wykładniczym zanikiem, RT60 = 0.3 s na jednostkę."""
+    rt60 = 0.3 * amount
+    length = max(1, int(rt60 * sample_rate))
+    t = np.arange(length, dtype=np.float32) / sample_rate
+    noise = np.random.default_rng(0).standard_normal(length).astype(np.float32)
+    ir = noise * np.exp(-6.9 * t / rt60).astype(np.float32)
+    ir /= np.sqrt(np.sum(ir ** 2))
+    ir.flags.writeable = False
+    return ir
+
+
+def apply_effect_chain(data, effects, sample_rate=44100):
+    """Łańcuch efektów na float32 (n, 2): gain, pitch, delay, pogłos, pan, normalizacja.
+
+    Parametry jak w słowniku `effects` aplikacji: volume w krokach 10 dB, pitch w półtonach,
+    echo = opóźnienie 200 ms na jednostkę, reverb = 300 ms zaniku na jednostkę, pan -1..1.
+    """
+    volume, pitch, echo, reverb, pan = (effects[k] for k in ('volume', 'pitch', 'echo', 'reverb', 'pan'))
+
+    if pitch != 0:
+        data = pitch_resample(data, 2 ** (pitch / 12))
+    n = len(data)
+    ir = reverb_impulse(round(reverb, 3), sample_rate) if reverb > 0 else None
+    tail = len(ir) - 1 if ir is not None else 0
+    out = np.zeros((n + tail, 2), dtype=np.float32)
+    out[:n] = data
+
+    if volume != 0:
+        # Gain przed normalizacją, z przesterem jak w int16
+        out[:n] *= np.float32(10 ** (volume * 10 / 20))
+        np.clip(out[:n], -1.0, 1.0, out=out[:n])
+
+    if echo > 0:
+        delay = int(sample_rate * 0.2 * echo)
+        dry = out[:n].copy()
+        gain = ECHO_FEEDBACK
+        position = delay
+        while 0 < position < n and gain > 1e-3:
+            out[position:n] += dry[:n - position] * np.float32(gain)
+            position += delay
+            gain *= ECHO_FEEDBACK
+
+    if ir is not None:
+        wet = fftconvolve(out[:n], ir[:, None], axes=0)
+        out *= np.float32(1 - min(0.5, 0.1 * reverb))
+        out += wet.astype(np.float32) * np.float32(min(0.5, 0.1 * reverb))
+
+    if pan != 0:
+        theta = (max(-1.0, min(1.0, pan)) + 1) * np.pi / 4
+        out *= np.array([np.cos(theta), np.sin(theta)], dtype=np.float32) * np.float32(np.sqrt(2))
+
+    peak = np.max(np.abs(out)) if len(out) else 0
+    if peak > 0:
+        out *= np.float32(NORMALIZE_PEAK / peak)
+    return out
+
+
+ADSR_CURVE_STEEPNESS = 5.0
+
+
+def _adsr_ramp(start, end, length, curve):
+    if curve == 'exponential':
+        x = np.linspace(0, 1, length, dtype=np.float32)
+        k = ADSR_CURVE_STEEPNESS
+        if end > start:
+            shape = (1 - np.exp(-k * x)) / (1 - np.exp(-k))
+        else:
+            shape = 1 - (np.exp(-k * x) - np.exp(-k)) / (1 - np.exp(-k))
+        return start + (end - start) * shape
+    return np.linspace(start, end, length)
+
+
+@lru_cache(maxsize=64)
+def adsr_envelope(attack, decay, sustain, release, total_samples, sample_rate=44100, curve='linear'):
+    """Obwiednia ADSR (float32, tylko do odczytu) trzymana w cache LRU."""
+    attack_samples = int(attack * sample_rate)
+    decay_samples = int(decay * sample_rate)
+    release_samples = int(release * sample_rate)
+    sustain_samples = total_samples - attack_samples - decay_samples - release_samples
+
+    if sustain_samples < 0:
+        excess = -sustain_samples
+        total_adsr = attack_samples + decay_samples + release_samples
+        scale_factor = (total_samples - excess) / total_adsr
+        attack_samples = int(attack_samples * scale_factor)
+        decay_samples = int(decay_samples * scale_factor)
+        release_samples = int(release_samples * scale_factor)
+        sustain_samples = total_samples - attack_samples - decay_samples - release_samples
+
+    envelope = np.zeros(total_samples, dtype=np.float32)
+    if attack_samples > 0:
+        envelope[:attack_samples] = _adsr_ramp(0, 1, min(attack_samples, total_samples), curve)
+    if decay_samples > 0 and attack_samples < total_samples:
+        decay_end = min(attack_samples + decay_samples, total_samples)
+        envelope[attack_samples:decay_end] = _adsr_ramp(1, sustain, decay_end - attack_samples, curve)
+    if sustain_samples > 0 and attack_samples + decay_samples < total_samples:
+        sustain_end = min(attack_samples + decay_samples + sustain_samples, total_samples)
+        envelope[attack_samples + decay_samples:sustain_end] = sustain
+    if release_samples > 0 and total_samples - release_samples > 0:
+        release_start = max(0, total_samples - release_samples)
+        envelope[release_start:] = _adsr_ramp(sustain, 0, total_samples - release_start, curve)
+
+    envelope.flags.writeable = False
+    return envelope
+
+
+def apply_adsr(data, adsr, sample_rate=44100, curve='linear', out=None):
+    """Mnoży float32 (n, 2) przez obwiednię jednym broadcastem; domyślnie w miejscu."""
+    envelope = adsr_envelope(adsr['attack'], adsr['decay'], adsr['sustain'], adsr['release'],
+                             len(data), sample_rate, curve)
+    if out is None:
+        out = data
+    np.multiply(data, envelope[:, None], out=out)
+    return out
+
+
+def apply_effect_chain_pydub(sound_array, effects, sample_rate=44100):
+    """Poprzedni łańcuch efektów oparty o pydub (int16); zostawiony do porównań w bench-effects."""
+    sample_width = sound_array.dtype.itemsize
+    channels = 1 if sound_array.ndim == 1 else 2
+    audio_segment = AudioSegment(
+        sound_array.tobytes(),
+        frame_rate=sample_rate,
+        sample_width=sample_width,
+        channels=channels
+    )
+    if effects['volume'] != 0:
+        audio_segment = audio_segment + (effects['volume'] * 10)
+    if effects['pitch'] != 0:
+        new_rate = int(audio_segment.frame_rate * (2 ** (effects['pitch'] / 12)))
+        audio_segment = audio_segment._spawn(audio_segment.raw_data, overrides={'frame_rate': new_rate})
+        audio_segment = audio_segment.set_frame_rate(sample_rate)
+    if effects['echo'] > 0:
+        delay_ms = int(200 * effects['echo'])
+        echo_segment = audio_segment - 10
+        audio_segment = audio_segment.overlay(echo_segment, position=delay_ms)
+    if effects['reverb'] > 0:
+        reverb_amount = effects['reverb'] * 300
+        audio_segment = audio_segment.fade_in(50).fade_out(int(reverb_amount))
+    if effects['pan'] != 0:
+        audio_segment = audio_segment.pan(effects['pan'])
+    audio_segment = normalize(audio_segment)
+    samples = np.array(audio_segment.get_array_of_samples())
+    if channels == 2:
+        samples = samples.reshape((-1, 2))
+    return samples
+
+
+def decode_sample(path, sample_rate):
+    """Dekoduje plik do float32 (n, 2) w zadanej częstotliwości."""
+    data, sr = sf.read(path, dtype='float32', always_2d=True)
+    if data.shape[1] == 1:
+        data = np.repeat(data, 2, axis=1)
+    data = data[:, :2]
+    if sr != sample_rate:
+        data = librosa.resample(np.ascontiguousarray(data.T), orig_sr=sr, target_sr=sample_rate).T
+    return np.ascontiguousarray(data, dtype=np.float32)
+
+
+class SampleStore:
+    """Sample zdekodowane raz do float32 stereo; wielokrotny odczyt tylko gdy zmieni się mtime pliku."""
+
+    def __init__(self, sample_rate=44100):
+        self.sample_rate = sample_rate
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.decodes = 0
+
+    def get(self, path, sample_rate=None):
+        """Zwraca tablicę tylko do odczytu; konsumenci kopiują ją przed modyfikacją."""
+        sample_rate = sample_rate or self.sample_rate
+        key = (os.path.abspath(path), sample_rate)
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        data = decode_sample(path, sample_rate)
+        data.flags.writeable = False
+        with self._lock:
+            self._entries[key] = (mtime, data)
+            self.decodes += 1
+        return data
+
+    def load(self, paths):
+        for path in paths:
+            self.get(path)
+
+    def evict(self, path=None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                path = os.path.abspath(path)
+                for key in [k for k in self._entries if k[0] == path]:
+                    del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._entries), 'decodes': self.decodes,
+                    'bytes': sum(data.nbytes for _, data in self._entries.values())}
+
+
+MIDI_PPQ = 480
+MIDI_VELOCITY = 100
+MIDI_ACCENT_VELOCITY = 120
+
+
+class Timeline:
+    """Zdarzenia wzorca skompilowane do tablic, posortowane po czasie.
+
+    Na zdarzenie: czas (s) i tick (względem `bpm` i `ppq`), instrument, kod rytmu, gain
+    odtwarzania, velocity MIDI, długość (s i ticki) oraz globalny numer kroku.
+    `step_times` to początki kroków (z końcem ostatniego).
+    """
+
+    FIELDS = ('time', 'tick', 'instrument', 'rhythm', 'gain', 'velocity', 'duration', 'duration_ticks', 'step')
+
+    def __init__(self, instruments, pattern_length, step_times, bpm, ppq, **fields):
+        self.instruments = list(instruments)
+        self.pattern_length = pattern_length
+        self.step_times = step_times
+        self.bpm = bpm
+        self.ppq = ppq
+        for name in self.FIELDS:
+            setattr(self, name, fields[name])
+
+    def __len__(self):
+        return len(self.time)
+
+    @property
+    def steps(self):
+        return len(self.step_times) - 1
+
+    @property
+    def duration_seconds(self):
+        return float(self.step_times[-1])
+
+    @property
+    def step_durations(self):
+        return np.diff(self.step_times)
+
+    def step_slice(self, step):
+        """Zakres zdarzeń kroku `step` (zdarzenia kroku leżą w jego oknie czasowym)."""
+        return slice(*np.searchsorted(self.step, [step, step + 1]))
+
+    def seconds_to_ticks(self, seconds):
+        return np.rint(np.asarray(seconds) * self.bpm / 60 * self.ppq).astype(np.int64)
+
+    def digest(self):
+        digest = hashlib.blake2b(digest_size=16)
+        for name in ('tick', 'instrument', 'velocity', 'duration_ticks'):
+            digest.update(np.ascontiguousarray(getattr(self, name)).tobytes())
+        return digest.hexdigest()
+
+
+def timeline_period(pattern_length, dynamic_bpm_count=0):
+    """Liczba kroków, po której wzorzec i lista dynamicznego BPM wracają do początku."""
+    if not dynamic_bpm_count:
+        return pattern_length
+    return int(np.lcm(pattern_length, STEPS_PER_BPM * dynamic_bpm_count))
+
+
+def compile_timeline(pattern, advanced, bpm, dynamic_bpm=None, steps=None, ppq=MIDI_PPQ, tick_bpm=None):
+    """Kompiluje wzorzec i mapę tempa do osi czasu zdarzeń (jak w sekwencerze).
+
+    Tempo zmienia się co STEPS_PER_BPM kroków według `dynamic_bpm` (bezwzględne BPM, cyklicznie);
+    w trybie prostym każdy aktywny krok to 'single'. Ticki liczone względem `tick_bpm` (domyślnie `bpm`).
+    """
+    steps = pattern.length if steps is None else steps
+    step_index = np.arange(steps)
+    if dynamic_bpm:
+        step_bpm = np.asarray(dynamic_bpm, dtype=np.float64)[(step_index // STEPS_PER_BPM) % len(dynamic_bpm)]
+    else:
+        step_bpm = np.full(steps, float(bpm))
+    step_durations = 60 / step_bpm / 4
+    step_times = np.concatenate([[0.0], np.cumsum(step_durations)])
+
+    source = step_index % max(pattern.length, 1)
+    active = pattern.active[:, source] if pattern.length else np.zeros((len(pattern.instruments), steps), dtype=bool)
+    rows, cols = np.nonzero(active)
+    codes = pattern.rhythm[rows, source[cols]] if advanced else np.zeros(len(rows), dtype=np.int8)
+    notes = RHYTHM_NOTES[codes]
+    speed = np.array([RHYTHM_TYPES[name]['speed'] for name in RHYTHM_NAMES])[codes]
+    swing = np.array([RHYTHM_TYPES[name]['swing'] for name in RHYTHM_NAMES])[codes]
+
+    # Rozwinięcie trafień na nuty; i-ta nuta przesunięta o i długości nut + swing po każdej nieparzystej
+    hit = np.repeat(np.arange(len(rows)), notes)
+    i = np.arange(len(hit)) - np.repeat(np.cumsum(notes) - notes, notes)
+    note_duration = step_durations[cols[hit]] * speed[hit] / notes[hit]
+    micro = pattern.timing[rows, source[cols]][hit] * step_durations[cols[hit]]
+    time = step_times[cols[hit]] + i * note_duration + (i // 2) * note_duration * swing[hit] + micro
+
+    accent = codes[hit] == RHYTHM_CODES['accent']
+    level = pattern.velocity[rows, source[cols]][hit]
+    gain = np.where(accent, ACCENT_GAIN, 1.0) * level
+    velocity = np.clip(np.rint(np.where(accent, MIDI_ACCENT_VELOCITY, MIDI_VELOCITY) * level), 1, 127)
+
+    order = np.lexsort((rows[hit], time))
+    tick_bpm = tick_bpm or bpm
+
+    def ticks(seconds):
+        return np.rint(seconds * tick_bpm / 60 * ppq).astype(np.int64)
+
+    return Timeline(pattern.instruments, pattern.length, step_times, tick_bpm, ppq,
+                    time=time[order], tick=ticks(time[order]), instrument=rows[hit][order].astype(np.int16),
+                    rhythm=codes[hit][order], gain=gain[order].astype(np.float32),
+                    velocity=velocity[order].astype(np.uint8), duration=note_duration[order],
+                    duration_ticks=np.maximum(ticks(note_duration[order]), 1), step=cols[hit][order])
+
+
+class TimelineCache:
+    """Ostatnio skompilowane osie czasu; klucz to odcisk wzorca, tryb i mapa tempa."""
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pattern, advanced, bpm, dynamic_bpm=None, steps=None, tick_bpm=None):
+        dynamic_bpm = tuple(dynamic_bpm or ())
+        key = (pattern.fingerprint(), advanced, bpm, dynamic_bpm, steps, tick_bpm)
+        with self._lock:
+            timeline = self._entries.pop(key, None)
+            if timeline is not None:
+                self._entries[key] = timeline
+                self.hits += 1
+                return timeline
+            self.misses += 1
+        timeline = compile_timeline(pattern, advanced, bpm, dynamic_bpm, steps, tick_bpm=tick_bpm)
+        with self._lock:
+            self._entries[key] = timeline
+            while len(self._entries) > self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+        return timeline
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'timelines': len(self._entries)}
+
+
+MIDI_NOTES = {'Talerz': 49, 'Stopa': 36, 'Werbel': 38, 'TomTom': 45}
+MIDI_DRUM_CHANNEL = 9
+
+
+class MidiTrack:
+    """Nuty jednej ścieżki MIDI jako tablice: tick startu, długość w tickach, wysokość, velocity."""
+
+    def __init__(self, name, channel, tick, duration, note, velocity):
+        self.name = name
+        self.channel = channel
+        self.tick = np.asarray(tick, dtype=np.int64)
+        self.duration = np.asarray(duration, dtype=np.int64)
+        self.note = np.asarray(note, dtype=np.uint8)
+        self.velocity = np.asarray(velocity, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.tick)
+
+    def digest(self):
+        digest = hashlib.blake2b(digest_size=16)
+        for values in (self.tick, self.duration, self.note, self.velocity):
+            digest.update(np.ascontiguousarray(values).tobytes())
+        return digest.hexdigest()
+
+
+def generate_structured_patterns(style, duration, bpm, unique=False, instruments=INSTRUMENTS, rng=None):
+    """Sekcje piosenki (perkusja, bas, lead) z długościami w taktach; `unique` losuje długości sekcji."""
+    rng = as_rng(rng)
+
+    def measures(low, high, fixed):
+        return int(rng.integers(low, high + 1)) if unique else fixed
+
+    structure = {
+        "intro": measures(4, 6, 4),
+        "verse1": measures(12, 14, 14),
+        "chorus1": measures(6, 8, 8),
+        "verse2": measures(12, 14, 14),
+        "chorus2": measures(6, 8, 8),
+        "development": measures(12, 14, 12),
+        "chorus3": measures(6, 8, 8),
+        "outro": measures(4, 6, 4)
+    }
+
+    total_measures = int(duration * bpm / 60 / 4)
+    total_structure_measures = sum(structure.values())
+    if total_structure_measures < total_measures:
+        structure["outro"] += total_measures - total_structure_measures
+    elif total_structure_measures > total_measures:
+        structure["outro"] = max(4, structure["outro"] - (total_structure_measures - total_measures))
+
+    patterns = {}
+    current_measure = 0
+
+    for section, section_measures in structure.items():
+        section_duration = section_measures * 4 * 60 / bpm
+        drum_pattern = generate_drum_pattern(style, section_duration, bpm, instruments, rng)
+        bass_pattern = generate_bass_pattern(style, section_duration, bpm, rng)
+        lead_pattern = generate_lead_pattern(style, section_duration, bpm, rng)
+
+        intensity = 0.3 if "intro" in section or "outro" in section else 0.7 if "development" in section else 0.5
+        drum_pattern = adjust_pattern_intensity(drum_pattern, intensity, rng)
+        bass_pattern = adjust_pattern_intensity(bass_pattern, intensity, rng)
+        lead_pattern = adjust_pattern_intensity(lead_pattern, intensity, rng)
+
+        patterns[section] = {
+            "drums": drum_pattern,
+            "bass": bass_pattern,
+            "lead": lead_pattern,
+            "start_measure": current_measure,
+            "duration": section_measures
+        }
+        current_measure += section_measures
+
+    return patterns
+
+
+def adjust_pattern_intensity(pattern, intensity, rng=None):
+    rng = as_rng(rng)
+    if isinstance(pattern, Pattern):
+        pattern.active &= rng.random(pattern.active.shape) < intensity
+    else:
+        keep = rng.random(len(pattern)) < intensity
+        pattern = [x if k else 0 for x, k in zip(pattern, keep)]
+    return pattern
+
+
+def generate_drum_pattern(style, duration, bpm, instruments=INSTRUMENTS, rng=None):
+    # Nowe style dodaje się w DRUM_STYLE_RULES
+    pattern_length = int(duration * bpm / 60 / 4)
+    return pattern_from_rules(DRUM_STYLE_RULES.get(style, {}), pattern_length, instruments, rng)
+
+
+def _note_line(notes, mask, rng):
+    return np.where(mask, rng.choice(notes, size=len(mask)), 0).tolist()
+
+
+def generate_bass_pattern(style, duration, bpm, rng=None):
+    rng = as_rng(rng)
+    pattern_length = int(duration * bpm / 60 / 4)
+    i = np.arange(pattern_length)
+
+    if style == "Techno":
+        return _note_line([36, 38, 41, 43], i % 4 == 0, rng)
+    elif style == "House":
+        return _note_line([36, 38, 41, 43], i % 2 == 0, rng)
+    # Możesz dodać więcej stylów według potrzeb
+    return [0] * pattern_length
+
+
+def generate_lead_pattern(style, duration, bpm, rng=None):
+    rng = as_rng(rng)
+    pattern_length = int(duration * bpm / 60 / 4)
+    i = np.arange(pattern_length)
+
+    if style == "Techno":
+        return _note_line([60, 62, 64, 65, 67], np.isin(i % 8, [0, 3, 5]), rng)
+    elif style == "House":
+        return _note_line([60, 62, 64, 65], np.isin(i % 4, [0, 2]), rng)
+    # Możesz dodać więcej stylów według potrzeb
+    return [0] * pattern_length
+
+
+def structured_song_tracks(structured_patterns, bpm, dynamic_bpm=None, midi_notes=MIDI_NOTES, ppq=MIDI_PPQ):
+    """Ścieżki Drums/Bass/Lead piosenki z sekcji; `dynamic_bpm` w procentach `bpm`, co 4 kroki."""
+    sections = list(structured_patterns.values())
+    section_steps = [section['duration'] * 4 for section in sections]
+    song = Pattern.concat(section['drums'].tile(steps) for section, steps in zip(sections, section_steps))
+    timeline = compile_timeline(song, True, bpm, [p * bpm / 100 for p in dynamic_bpm] if dynamic_bpm else None,
+                                ppq=ppq)
+    drum_notes = np.array([midi_notes[inst] for inst in song.instruments])
+    tracks = [MidiTrack("Drums", MIDI_DRUM_CHANNEL, timeline.tick, timeline.duration_ticks,
+                        drum_notes[timeline.instrument], timeline.velocity)]
+
+    # Bas i lead na początkach kroków z tej samej osi czasu
+    step_ticks = timeline.seconds_to_ticks(timeline.step_times[:-1])
+    for name, channel, key, beats, velocity in (("Bass", 0, 'bass', 0.5, 80), ("Lead", 1, 'lead', 0.25, 90)):
+        notes = np.concatenate([np.asarray(section[key], dtype=np.int64)[np.arange(steps) % len(section[key])]
+                                for section, steps in zip(sections, section_steps)] or [np.zeros(0, np.int64)])
+        steps = np.flatnonzero(notes)
+        tracks.append(MidiTrack(name, channel, step_ticks[steps], np.full(len(steps), int(beats * ppq)),
+                                notes[steps], np.full(len(steps), velocity)))
+    return tracks
+
+
+def add_midi_tracks(midi, tracks, ppq=MIDI_PPQ):
+    """Dopisuje ścieżki do MIDIFile nuta po nucie (ścieżka i = i-ta ścieżka MIDIUtil)."""
+    for index, track in enumerate(tracks):
+        midi.addTrackName(index, 0, track.name)
+        for tick, duration, note, velocity in zip(track.tick.tolist(), track.duration.tolist(),
+                                                  track.note.tolist(), track.velocity.tolist()):
+            midi.addNote(index, track.channel, note, tick / ppq, duration / ppq, velocity)
+
+
+def _vlq(value):
+    """Liczba o zmiennej długości (delta czasu, długość meta) w zapisie SMF."""
+    data = [value & 0x7F]
+    value >>= 7
+    while value:
+        data.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(data))
+
+
+def encode_midi_track(track):
+    """Zdarzenia note-on/off ścieżki jako bajty MTrk w jednym przebiegu.
+
+    Note-off zapisane jako note-on z velocity 0, więc cała ścieżka ma jeden bajt statusu
+    (running status). Nakładające się uderzenia tej samej nuty są skracane do następnego.
+    """
+    tick, duration, note = track.tick, track.duration, track.note
+    order = np.lexsort((tick, note))
+    same_note = note[order][1:] == note[order][:-1]
+    gap = np.diff(tick[order])
+    limit = np.full(len(tick), np.iinfo(np.int64).max)
+    limit[order[:-1][same_note]] = gap[same_note]
+    duration = np.maximum(np.minimum(duration, limit), 1)
+
+    times = np.concatenate([tick, tick + duration])
+    notes = np.concatenate([note, note])
+    velocities = np.concatenate([track.velocity, np.zeros(len(tick), dtype=np.uint8)])
+    is_on = np.concatenate([np.ones(len(tick), dtype=bool), np.zeros(len(tick), dtype=bool)])
+    order = np.lexsort((is_on, times))  # w tym samym ticku najpierw note-off
+    times = times[order]
+    delta = np.diff(times, prepend=0)
+
+    delta_bytes = 1 + (delta >= 1 << 7) + (delta >= 1 << 14) + (delta >= 1 << 21)
+    sizes = delta_bytes + 2
+    if len(sizes):
+        sizes[0] += 1  # status tylko przy pierwszym zdarzeniu
+    start = np.cumsum(sizes) - sizes
+    data = np.empty(int(sizes.sum()), dtype=np.uint8)
+    for k in range(4):
+        has = delta_bytes > k
+        remaining = delta_bytes[has] - 1 - k
+        data[start[has] + k] = ((delta[has] >> (7 * remaining)) & 0x7F) | np.where(remaining > 0, 0x80, 0)
+    position = start + delta_bytes
+    if len(position):
+        data[position[0]] = 0x90 | track.channel
+        position[0] += 1
+    data[position] = notes[order]
+    data[position + 1] = velocities[order]
+    return data.tobytes()
+
+
+def _midi_chunk(kind, body):
+    return kind + len(body).to_bytes(4, 'big') + body
+
+
+def smf_bytes(tracks, bpm, ppq=MIDI_PPQ):
+    """Plik SMF formatu 1: ścieżka tempa, potem po jednym MTrk na ścieżkę."""
+    end_of_track = b'\x00\xff\x2f\x00'
+    tempo = int(round(60_000_000 / bpm)).to_bytes(3, 'big')
+    chunks = [_midi_chunk(b'MThd', (1).to_bytes(2, 'big') + (len(tracks) + 1).to_bytes(2, 'big')
+                          + ppq.to_bytes(2, 'big')),
+              _midi_chunk(b'MTrk', b'\x00\xff\x51\x03' + tempo + end_of_track)]
+    for track in tracks:
+        name = track.name.encode('latin-1', 'replace')
+        chunks.append(_midi_chunk(b'MTrk', b'\x00\xff\x03' + _vlq(len(name)) + name
+                                  + encode_midi_track(track) + end_of_track))
+    return b''.join(chunks)
+
+
+def write_smf(path, tracks, bpm, ppq=MIDI_PPQ):
+    with open(path, 'wb') as f:
+        f.write(smf_bytes(tracks, bpm, ppq))
+
+
+def render_pattern(patterns, advanced, samples, steps, bpm, dynamic_bpm=None, effects=None, adsr=None,
+                   adsr_curve='linear', sample_rate=44100, store=None, instruments=INSTRUMENTS):
+    """Renderuje wzorzec offline do float32 (n, 2), z ogonem wybrzmienia ostatnich uderzeń."""
+    store = store or SampleStore(sample_rate)
+    timeline = compile_timeline(patterns, advanced, bpm, dynamic_bpm, steps)
+
+    voices = {}
+    for inst in instruments:
+        if inst not in samples:
+            continue
+        data = store.get(samples[inst], sample_rate)
+        data = apply_adsr(data, (adsr or NOMINAL_ADSR)[inst], sample_rate, adsr_curve, out=np.empty_like(data))
+        inst_effects = (effects or {}).get(inst, {'volume': 0, 'pitch': 0, 'echo': 0, 'reverb': 0, 'pan': 0})
+        voices[inst] = apply_effect_chain(data, inst_effects, sample_rate)
+
+    tail = max((len(v) for v in voices.values()), default=0)
+    out = np.zeros((int(timeline.duration_seconds * sample_rate) + tail, 2), dtype=np.float32)
+    starts = np.rint(timeline.time * sample_rate).astype(np.int64)
+    for row, start, gain in zip(timeline.instrument, starts, timeline.gain):
+        voice = voices.get(timeline.instruments[row])
+        if voice is not None:
+            out[start:start + len(voice)] += voice * gain
+
+    peak = np.max(np.abs(out)) if len(out) else 0
+    if peak > 1.0:
+        out *= np.float32(NORMALIZE_PEAK / peak)
+    return out
+
+
+def overlap_add(length, starts, kernel):
+    """Wstawia kernel w każdym starcie: splot ciągu impulsów z samplem, przycięty do length."""
+    starts = np.asarray(starts, dtype=np.int64)
+    starts = starts[(starts >= 0) & (starts < length)]
+    if len(starts) == 0 or len(kernel) == 0:
+        return np.zeros(length, dtype=np.float32)
+    impulses = np.bincount(starts, minlength=length).astype(np.float32)
+    return oaconvolve(impulses, kernel)[:length].astype(np.float32)
+
+
+DRUMMER_SR = 22050
+STEPS_PER_BEAT = 4
+BEATS_PER_MEASURE = 4
+
+
+def enhanced_output_paths(audio_path):
+    """Ścieżki wyników dla dowolnego formatu wejścia (nie tylko .mp3)."""
+    base = os.path.splitext(audio_path)[0]
+    return base + "_enhanced_drums.wav", base + "_combined.wav"
+
+
+class AnalysisContext:
+    """Jednorazowa analiza sygnału współdzielona przez etapy Add Drummer to Audio.
+
+    STFT liczony raz; obwiednia onsetów (mel w dB jak w librosa), onsety, beaty i RMS
+    są z niego wyprowadzane, a cechy per takt agregowane z tych samych ramek.
+    """
+
+    def __init__(self, y, sr, hop_length=512, n_fft=2048):
+        self.y = y
+        self.sr = sr
+        self.hop_length = hop_length
+        self.n_fft = n_fft
+        self.n_samples = len(y)
+        self.signal_rms = float(np.sqrt(np.mean(np.square(y, dtype=np.float64)))) if len(y) else 0.0
+        self.timings = {}
+
+        start = time.perf_counter()
+        self.S = np.abs(librosa.stft(y, n_fft=n_fft, hop_length=hop_length))
+        self.timings['stft'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        mel_db = librosa.power_to_db(librosa.feature.melspectrogram(S=self.S ** 2, sr=sr))
+        self.onset_env = librosa.onset.onset_strength(S=mel_db, sr=sr, hop_length=hop_length)
+        self.onset_frames = librosa.onset.onset_detect(onset_envelope=self.onset_env, sr=sr, hop_length=hop_length)
+        self.timings['onsets'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.rms = librosa.feature.rms(S=self.S, frame_length=n_fft, hop_length=hop_length)[0]
+        self.timings['rms'] = time.perf_counter() - start
+
+        self._tempo = None
+        self._beat_frames = None
+        self._labels = None
+        self._chroma = None
+        self._mood = None
+
+    # Pola zapisywane w AnalysisCache; STFT i sygnał są pomijane (odtwarzalne, duże)
+    CACHED_FIELDS = ('n_samples', 'signal_rms', 'onset_env', 'onset_frames', 'rms')
+
+    def to_cache(self):
+        """Kompaktowy zestaw cech do zapisu w .npz (wymusza policzenie leniwych pól)."""
+        tempo, beat_frames = self.beats()
+        mood = self.mood()
+        entry = {name: np.asarray(getattr(self, name)) for name in self.CACHED_FIELDS}
+        entry.update(sr=self.sr, hop_length=self.hop_length, n_fft=self.n_fft, tempo=tempo,
+                     beat_frames=beat_frames, onset_labels=self.onset_labels(),
+                     chroma=self.chroma().astype(np.float16), is_minor=mood['is_minor'],
+                     mood=mood['mood'], spectral_complexity=mood['spectral_complexity'])
+        return entry
+
+    @classmethod
+    def from_cache(cls, entry):
+        """Kontekst z zapisanych cech, bez sygnału i STFT."""
+        context = cls.__new__(cls)
+        context.y = None
+        context.S = None
+        context.sr = int(entry['sr'])
+        context.hop_length = int(entry['hop_length'])
+        context.n_fft = int(entry['n_fft'])
+        context.n_samples = int(entry['n_samples'])
+        context.signal_rms = float(entry['signal_rms'])
+        context.onset_env = entry['onset_env']
+        context.onset_frames = entry['onset_frames']
+        context.rms = entry['rms']
+        context.timings = {}
+        context._tempo = float(entry['tempo'])
+        context._beat_frames = entry['beat_frames']
+        context._labels = entry['onset_labels']
+        context._chroma = entry['chroma'].astype(np.float32)
+        context._mood = {'is_minor': bool(entry['is_minor']), 'mood': str(entry['mood']),
+                         'spectral_complexity': float(entry['spectral_complexity'])}
+        return context
+
+    def beats(self):
+        """Tempo i ramki beatów z tej samej obwiedni onsetów (liczone przy pierwszym użyciu)."""
+        if self._tempo is None:
+            start = time.perf_counter()
+            tempo, self._beat_frames = librosa.beat.beat_track(onset_envelope=self.onset_env, sr=self.sr,
+                                                               hop_length=self.hop_length)
+            self._tempo = float(np.atleast_1d(tempo)[0])
+            self.timings['beats'] = time.perf_counter() - start
+        return self._tempo, self._beat_frames
+
+    def onset_labels(self):
+        """Instrument dla każdego onsetu (klasyfikacja pasmowa kolumn STFT, liczona raz)."""
+        if self._labels is None:
+            start = time.perf_counter()
+            frames = self.onset_frames[self.onset_frames < self.S.shape[1]]
+            freqs = librosa.fft_frequencies(sr=self.sr, n_fft=self.n_fft)
+            self._labels = classify_percussion(self.S[:, frames] ** 2, freqs)
+            self.timings['classify'] = time.perf_counter() - start
+        return self._labels
+
+    def chroma(self):
+        """Chromagram z tego samego STFT (12 x ramki)."""
+        if self._chroma is None:
+            self._chroma = librosa.feature.chroma_stft(S=self.S ** 2, sr=self.sr, n_fft=self.n_fft,
+                                                       hop_length=self.hop_length)
+        return self._chroma
+
+    def mood(self):
+        """Tryb i nastrój utworu (jak detect_mood_and_modality w 7.4C, ale z chromy STFT)."""
+        if self._mood is None:
+            freqs = librosa.fft_frequencies(sr=self.sr, n_fft=self.n_fft)
+            centroid = librosa.feature.spectral_centroid(S=self.S, freq=freqs)[0]
+            bandwidth = librosa.feature.spectral_bandwidth(S=self.S, freq=freqs, centroid=centroid[None, :])[0]
+            is_minor = bool(np.argmax(np.mean(self.chroma(), axis=1)) < 6)
+            brightness = float(np.mean(centroid))
+            if is_minor:
+                mood = 'melancholic' if brightness < 1500 else 'dramatic'
+            else:
+                mood = 'energetic' if brightness > 2000 else 'calm'
+            self._mood = {'is_minor': is_minor, 'mood': mood, 'spectral_complexity': float(np.mean(bandwidth))}
+        return self._mood
+
+    @property
+    def onset_times(self):
+        return librosa.frames_to_time(self.onset_frames, sr=self.sr, hop_length=self.hop_length)
+
+    def measure_features(self, tempo, start_sample=0, end_sample=None):
+        """RMS i średnia siła onsetów per takt, agregowane z ramek w [start_sample, end_sample)."""
+        end_sample = self.n_samples if end_sample is None else end_sample
+        samples_per_measure = self.sr * BEATS_PER_MEASURE / (tempo / 60)
+        measures = max(1, int(np.ceil((end_sample - start_sample) / samples_per_measure)))
+        frames = min(len(self.rms), len(self.onset_env))
+        frame_samples = np.arange(frames) * self.hop_length
+        inside = (frame_samples >= start_sample) & (frame_samples < end_sample)
+        index = ((frame_samples[inside] - start_sample) // samples_per_measure).astype(np.int64)
+        counts = np.maximum(np.bincount(index, minlength=measures), 1)
+        rms = np.sqrt(np.bincount(index, weights=self.rms[:frames][inside] ** 2, minlength=measures) / counts)
+        onset = np.bincount(index, weights=self.onset_env[:frames][inside], minlength=measures) / counts
+        return rms, onset
+
+
+# Pasma do klasyfikacji uderzeń (Hz): stopa w sub, werbel/tom w low-mid, talerze w górze
+PERCUSSION_BANDS = {'sub': (20, 150), 'mid': (150, 2000), 'high': (2000, None)}
+SNARE_HIGH_RATIO = 0.2  # werbel ma szum sprężyn: energia high >= 20% energii mid
+
+
+def classify_percussion(power, freqs):
+    """Przypisuje instrument każdej kolumnie widma mocy (F x N) na podstawie energii w pasmach."""
+    masks = np.stack([(freqs >= low) & (freqs < (high if high is not None else np.inf))
+                      for low, high in PERCUSSION_BANDS.values()]).astype(power.dtype)
+    sub, mid, high = masks @ power
+    dominant = np.argmax(np.stack([sub, mid, high]), axis=0)
+    labels = np.where(dominant == 0, 'Stopa', np.where(dominant == 2, 'Talerz',
+                      np.where(high >= SNARE_HIGH_RATIO * mid, 'Werbel', 'TomTom')))
+    return labels
+
+
+def detect_existing_percussion(context, offset=0.0):
+    """Wykrywa istniejące elementy perkusyjne; czasy w sekundach od `offset`.
+
+    Okna wokół wszystkich onsetów to kolumny współdzielonego STFT (n_fft ~ 93 ms przy 22.05 kHz),
+    klasyfikowane jednym mnożeniem macierzy, deterministycznie.
+    """
+    percussion_events = {'Stopa': [], 'Werbel': [], 'Talerz': [], 'TomTom': []}
+    labels = context.onset_labels()
+    if len(labels) == 0:
+        return percussion_events
+
+    frames = context.onset_frames[:len(labels)]
+    times = offset + librosa.frames_to_time(frames, sr=context.sr, hop_length=context.hop_length)
+    for inst in percussion_events:
+        percussion_events[inst] = times[labels == inst].tolist()
+    return percussion_events
+
+
+ANALYSIS_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "drum-sampler", "analysis")
+ANALYSIS_CACHE_VERSION = 1
+
+
+class AnalysisCache:
+    """Cechy analizy na dysku (.npz), adresowane hashem zawartości pliku i parametrami analizy.
+
+    Rozmiar katalogu ograniczony do max_bytes; usuwane są najdawniej używane wpisy (mtime).
+    """
+
+    def __init__(self, directory=ANALYSIS_CACHE_DIR, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(path, sr, hop_length=512, n_fft=2048, chunk_size=1 << 20):
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        digest.update(f"|sr={sr}|hop={hop_length}|n_fft={n_fft}|v{ANALYSIS_CACHE_VERSION}".encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+        """AnalysisContext z cache albo None."""
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                context = AnalysisContext.from_cache(entry)
+            os.utime(path)
+        except (OSError, KeyError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Pomijam uszkodzony wpis cache {path}: {e}")
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return context
+
+    def store(self, key, context):
+        """Zapis atomowy; błąd zapisu tylko pomija cache (to optymalizacja, nie wynik analizy)."""
+        path = self._path(key)
+        # Nazwa tymczasowa spoza globu "*.npz" i osobna dla procesu: evict() w innym procesie
+        # nie policzy ani nie usunie pliku w trakcie zapisu
+        tmp_path = f"{path}.{os.getpid()}.part"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(f, **context.to_cache())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Pomijam zapis do cache {path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def evict(self):
+        """Usuwa najdawniej używane wpisy, aż katalog zmieści się w max_bytes."""
+        with self._lock:
+            entries = []
+            for path in glob.glob(os.path.join(self.directory, "*.npz")):
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def normalize_feature(values, low=None, high=None):
+    values = np.asarray(values, dtype=np.float64)
+    low = np.min(values) if low is None else low
+    high = np.max(values) if high is None else high
+    return (values - low) / (high - low + 1e-6)
+
+
+def build_percussion_track(percussion_events, tempo, total_steps, rms_normalized, onset_normalized, style,
+                           first_measure=0, instruments=INSTRUMENTS, rng=None):
+    """Wzbogaca perkusję z wykrywaniem complexity_factor i mniej gęstym rytmem.
+
+    Czasy zdarzeń i kroki są liczone od początku fragmentu, a `first_measure` to numer jego
+    pierwszego taktu w całym utworze; cechy są per takt tego fragmentu.
+    Losowania dla całego fragmentu pobierane z `rng` naraz: wiersz na werbel, talerz i tom/stopę.
+    """
+    chance = as_rng(rng).random((3, total_steps))
+    beats_per_second = tempo / 60
+    steps_per_measure = BEATS_PER_MEASURE * STEPS_PER_BEAT
+    percussion_track = Pattern(instruments, total_steps)
+    active, rhythm = percussion_track.active, percussion_track.rhythm
+    row = percussion_track.index
+
+    # Mapuj istniejące zdarzenia na kroki
+    for inst, times in percussion_events.items():
+        steps = (np.asarray(times, dtype=np.float64) * beats_per_second * STEPS_PER_BEAT).astype(np.int64)
+        steps = steps[(steps >= 0) & (steps < total_steps)]
+        active[row(inst), steps] = True
+        rhythm[row(inst), steps] = RHYTHM_CODES['single']
+
+    stopa, werbel, talerz, tomtom = row('Stopa'), row('Werbel'), row('Talerz'), row('TomTom')
+
+    measures = total_steps // steps_per_measure
+    for local_measure in range(measures):
+        measure = first_measure + local_measure
+        measure_start = local_measure * steps_per_measure
+        measure_end = min((local_measure + 1) * steps_per_measure, total_steps)
+
+        # Oblicz complexity_factor
+        rms_factor = rms_normalized[min(local_measure, len(rms_normalized) - 1)]
+        onset_factor = onset_normalized[min(local_measure, len(onset_normalized) - 1)]
+        complexity_factor = min(0.7, (rms_factor + onset_factor) / 2)
+
+        # Stabilna podstawa rytmiczna z większymi odstępami
+        for step in range(measure_start, measure_end, STEPS_PER_BEAT):  # Krok co beat, nie co step
+            beat_in_measure = (step % steps_per_measure) // STEPS_PER_BEAT
+            if beat_in_measure == 0 and not active[stopa, step]:
+                active[stopa, step] = True
+                rhythm[stopa, step] = RHYTHM_CODES['single']
+            if beat_in_measure == 2 and not active[werbel, step] and chance[0, step] < 0.5 * (1 + complexity_factor):
+                active[werbel, step] = True
+                rhythm[werbel, step] = RHYTHM_CODES['single']
+
+        # Subtelna ewolucja z mniejszą gęstością
+        if complexity_factor > 0.3:  # Dodajemy elementy tylko w bardziej intensywnych sekcjach
+            for step in range(measure_start, measure_end, STEPS_PER_BEAT * 2):  # Co 2 beaty
+                if style == "Techno":
+                    if measure % 4 == 0 and chance[1, step] < complexity_factor * 0.08 and not active[talerz, step]:
+                        active[talerz, step] = True
+                        rhythm[talerz, step] = RHYTHM_CODES['double']
+                    if measure % 8 == 7 and chance[2, step] < complexity_factor * 0.1 and not active[tomtom, step]:
+                        active[tomtom, step] = True
+                        rhythm[tomtom, step] = RHYTHM_CODES['accent']
+                elif style == "House":
+                    if measure % 4 == 2 and chance[1, step] < complexity_factor * 0.08 and not active[talerz, step]:
+                        active[talerz, step] = True
+                        rhythm[talerz, step] = RHYTHM_CODES['swing']
+                    if measure % 8 == 4 and chance[2, step] < complexity_factor * 0.05 and not active[stopa, step]:
+                        active[stopa, step] = True
+                        rhythm[stopa, step] = RHYTHM_CODES['single']
+
+    return percussion_track
+
+
+def drummer_step_duration(sr, tempo):
+    return int(sr / (tempo / 60 * STEPS_PER_BEAT))
+
+
+def drummer_note_duration(rhythm, step_duration, sr, tempo):
+    # Dłuższe trwanie nuty, minimum połowa beatu
+    return max(int(step_duration * 2 * rhythm['speed'] / rhythm['notes']), int(sr / (tempo / 60) / 2))
+
+
+def synthesize_percussion(percussion_track, sample_arrays, sr, tempo, length):
+    """Syntetyzuje perkusję (mono, bez skalowania) do bufora o długości `length` próbek."""
+    step_duration = drummer_step_duration(sr, tempo)
+    audio = np.zeros(length, dtype=np.float32)
+
+    # Zbieramy starty nut per instrument i długość nuty, potem jeden splot na grupę
+    for inst, sample_array in sample_arrays.items():
+        row = percussion_track.index(inst)
+        active_steps = np.flatnonzero(percussion_track.active[row])
+        codes = percussion_track.rhythm[row, active_steps]
+        starts_by_duration = {}
+        for code in np.unique(codes):
+            rhythm = RHYTHM_TYPES[RHYTHM_NAMES[code]]
+            steps = active_steps[codes == code]
+            note_duration = drummer_note_duration(rhythm, step_duration, sr, tempo)
+            starts = (steps[:, None] * step_duration + np.arange(rhythm['notes']) * note_duration).ravel()
+            starts_by_duration.setdefault(note_duration, []).append(starts)
+        for note_duration, starts in starts_by_duration.items():
+            kernel = np.zeros(note_duration, dtype=np.float32)
+            kernel[:min(note_duration, len(sample_array))] = sample_array[:note_duration] * 0.5
+            audio += overlap_add(length, np.concatenate(starts), kernel)
+
+    return audio
+
+
+def enhance_percussion_track(percussion_events, tempo, context, style, rng=None):
+    """Ścieżka perkusji dla całego utworu z cech per takt współdzielonego kontekstu."""
+    total_steps = int(context.n_samples / context.sr * tempo / 60 * STEPS_PER_BEAT)
+    rms, onset_env = context.measure_features(tempo)
+    return build_percussion_track(percussion_events, tempo, total_steps,
+                                  normalize_feature(rms), normalize_feature(onset_env), style, rng=rng)
+
+
+def synthesize_enhanced_audio(percussion_track, sample_arrays, sr, tempo, original_rms):
+    """Syntetyzuje perkusję i skaluje ją do 30% RMS oryginału."""
+    length = percussion_track.length * drummer_step_duration(sr, tempo)
+    audio = synthesize_percussion(percussion_track, sample_arrays, sr, tempo, length)
+    percussion_rms = np.sqrt(np.mean(audio**2))
+    if percussion_rms > 0:
+        audio *= (original_rms / percussion_rms) * 0.3
+    return audio
+
+
+def save_enhanced_tracks(audio_path, original_audio, sr, percussion_audio, output_dir=None):
+    """Zapisuje samą perkusję i miks z oryginałem; zwraca obie ścieżki."""
+    percussion_audio = librosa.util.fix_length(percussion_audio, size=len(original_audio))
+    combined_audio = librosa.util.normalize(original_audio * 0.4 + percussion_audio * 0.5)
+    percussion_path, combined_path = enhanced_output_paths(audio_path)
+    if output_dir:
+        percussion_path = os.path.join(output_dir, os.path.basename(percussion_path))
+        combined_path = os.path.join(output_dir, os.path.basename(combined_path))
+    sf.write(percussion_path, percussion_audio, sr)
+    sf.write(combined_path, combined_audio, sr)
+    return percussion_path, combined_path
+
+
+def enhance_audio_file(audio_path, samples, style="Techno", cache=None, store=None, output_dir=None,
+                       progress=None, stage=None, seed=None):
+    """Pełny potok Add Drummer to Audio dla jednego pliku; zwraca podsumowanie.
+
+    Każdy etap jest mierzony; `stage(name, func, *args)` opakowuje wywołania etapów (np. dla GUI),
+    `progress(fraction, message)` raportuje postęp. Ziarno trafia do podsumowania, więc ten sam
+    plik z tym samym `seed` daje tę samą ścieżkę.
+    """
+    timings = {}
+    seed = new_seed() if seed is None else seed
+
+    def timed(name, func, *args):
+        start = time.perf_counter()
+        result = stage(name, func, *args) if stage else func(*args)
+        timings[name] = time.perf_counter() - start
+        return result
+
+    progress = progress or (lambda fraction, message: None)
+    store = store or SampleStore(DRUMMER_SR)
+
+    def load_audio():
+        return librosa.load(audio_path, sr=DRUMMER_SR)
+
+    started = time.perf_counter()
+    context = None
+    cache_key = None
+    if cache is not None:
+        progress(0.05, "Checking analysis cache...")
+        cache_key = timed("Cache lookup", cache.key, audio_path, DRUMMER_SR)
+        context = cache.load(cache_key)
+    cache_hit = context is not None
+    y = None
+    if context is None:
+        progress(0.1, "Loading audio...")
+        y, sr = timed("Load", load_audio)
+        progress(0.2, "Analyzing audio (STFT, onsets, RMS)...")
+        context = timed("Analysis", AnalysisContext, y, sr)
+    sr = context.sr
+    tempo, beat_frames = timed("Beat tracking", context.beats)
+
+    progress(0.3, "Detecting existing percussion...")
+    percussion_events = timed("Percussion detection", detect_existing_percussion, context)
+    if cache is not None and not cache_hit:
+        timed("Cache store", cache.store, cache_key, context)
+
+    progress(0.5, "Enhancing percussion track...")
+    percussion_track = timed("Enhancement", enhance_percussion_track, percussion_events, tempo, context, style,
+                             seed)
+
+    progress(0.7, "Synthesizing enhanced audio...")
+    sample_arrays = {inst: store.get(samples[inst], sr).mean(axis=1) for inst in percussion_track}
+    percussion_audio = timed("Synthesis", synthesize_enhanced_audio, percussion_track, sample_arrays, sr,
+                             tempo, context.signal_rms)
+
+    progress(0.9, "Saving tracks...")
+    if y is None:
+        # Miks z oryginałem wymaga próbek; analiza pochodzi z cache
+        y, _ = timed("Load (mix)", load_audio)
+    outputs = timed("Save", save_enhanced_tracks, audio_path, y, sr, percussion_audio, output_dir)
+
+    return {
+        'file': audio_path,
+        'tempo': tempo,
+        'duration': context.n_samples / sr,
+        'detected_events': {inst: len(times) for inst, times in percussion_events.items()},
+        'generated_events': {inst: int(n) for inst, n in zip(percussion_track.instruments,
+                                                              percussion_track.active.sum(axis=1))},
+        'mood': context.mood()['mood'],
+        'cache_hit': cache_hit,
+        'seed': seed,
+        'outputs': list(outputs),
+        'timings': timings,
+        'wall_time': time.perf_counter() - started,
+    }
+
+
+class StreamingDrummer:
+    """Add Drummer to Audio dla długich plików: bloki taktów, stan niesiony między blokami.
+
+    Wejście czytane blokami przez soundfile i resamplowane strumieniowo (soxr). Tempo i faza
+    beatu są szacowane na nowo w każdym bloku (z kontekstem poprzedniego bloku i wyprzedzeniem):
+    tempo wygładzane wykładniczo (`tempo_half_life`), a granica bloku przesuwana na wykryty beat,
+    więc siatka kroków podąża za zmianami tempa miksu i nie dryfuje. Ogony uderzeń przenoszone
+    do następnego bloku. Szczytowe zużycie pamięci zależy od rozmiaru bloku, nie od długości pliku.
+    """
+
+    def __init__(self, samples, style="Techno", sr=DRUMMER_SR, block_measures=4, context=1.0,
+                 lookahead=0.5, tempo_window=60.0, tempo_half_life=10.0, read_block=65536, store=None,
+                 seed=None):
+        self.samples = samples
+        self.style = style
+        self.rng = as_rng(seed)
+        self.sr = sr
+        self.block_measures = block_measures
+        self.context = int(context * sr)
+        self.lookahead = int(lookahead * sr)
+        self.tempo_window = int(tempo_window * sr)
+        self.tempo_half_life = tempo_half_life
+        self.read_block = read_block
+        self.store = store or SampleStore(sr)
+
+    def process(self, audio_path, progress=None):
+        import soxr
+        percussion_path, combined_path = enhanced_output_paths(audio_path)
+        partial_path = combined_path + ".part.wav"
+        self.sample_arrays = {inst: self.store.get(path, self.sr).mean(axis=1) for inst, path in self.samples.items()}
+
+        with sf.SoundFile(audio_path) as source, \
+                sf.SoundFile(percussion_path, 'w', self.sr, 1) as percussion_out, \
+                sf.SoundFile(partial_path, 'w', self.sr, 1, subtype='FLOAT') as combined_out:
+            expected = max(1, int(source.frames * self.sr / source.samplerate))
+            resampler = soxr.ResampleStream(source.samplerate, self.sr, 1, dtype='float32')
+            self._reset()
+            finished = False
+            while not finished:
+                native = source.read(self.read_block, dtype='float32', always_2d=True)
+                finished = len(native) < self.read_block
+                chunk = resampler.resample_chunk(native.mean(axis=1), last=finished)
+                self.pending = np.concatenate([self.pending, chunk.astype(np.float32)])
+
+                if self.tempo is None:
+                    if len(self.pending) < self.tempo_window and not finished:
+                        continue
+                    if len(self.pending) == 0:
+                        break
+                    self._start(self.pending[:self.tempo_window])
+
+                while len(self.pending) >= self._block_span() + self.lookahead or (finished and len(self.pending) > 0):
+                    self._process_block(percussion_out, combined_out)
+                    if progress:
+                        progress(min(0.95, self.position / expected),
+                                 f"Streaming: {self.position / self.sr / 60:.1f} min processed")
+
+        # Drugi przebieg: normalizacja szczytowa miksu blokami, jak librosa.util.normalize
+        gain = 1.0 / self.peak if self.peak > 0 else 1.0
+        with sf.SoundFile(partial_path) as partial, sf.SoundFile(combined_path, 'w', self.sr, 1) as combined:
+            for block in partial.blocks(blocksize=self.read_block, dtype='float32'):
+                combined.write(block * gain)
+        os.remove(partial_path)
+        return percussion_path, combined_path
+
+    def _reset(self):
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.history = np.zeros(0, dtype=np.float32)
+        self.spill = np.zeros(0, dtype=np.float32)
+        self.position = 0
+        self.tempo = None
+        self.downbeat = 0  # próbka pierwszego taktu siatki; od niej bloki zaczynają się na takcie
+        self.measure = 0
+        self.rms_range = [np.inf, -np.inf]
+        self.onset_range = [np.inf, -np.inf]
+        self.original_energy = 0.0
+        self.percussion_energy = 0.0
+        self.peak = 0.0
+
+    def _start(self, window):
+        """Tempo i pierwszy beat z początkowego okna; dźwięk przed tym beatem idzie bez perkusji."""
+        context = AnalysisContext(window, self.sr)
+        tempo, beat_frames = context.beats()
+        beats = librosa.frames_to_samples(beat_frames, hop_length=context.hop_length)
+        period = self._beat_period(beats)
+        self.tempo = 60 * self.sr / period if period else (tempo or 120.0)
+        if len(beats):
+            self.downbeat = int(beats[0] % (STEPS_PER_BEAT * drummer_step_duration(self.sr, self.tempo)))
+
+    @staticmethod
+    def _beat_period(beats):
+        """Okres beatu w próbkach z prostej dopasowanej do czasów beatów (pominięte beaty liczone
+        jako wielokrotności mediany odstępu); None przy zbyt małej liczbie beatów."""
+        if len(beats) < 4:
+            return None
+        intervals = np.diff(beats)
+        median = np.median(intervals)
+        if median <= 0:
+            return None
+        index = np.concatenate(([0], np.cumsum(np.maximum(np.round(intervals / median), 1))))
+        return float(np.polyfit(index, beats, 1)[0])
+
+    def _block_span(self):
+        """Próbki bieżącego bloku na siatce: wstęp do pierwszego beatu albo `block_measures` taktów."""
+        if self.position < self.downbeat:
+            return self.downbeat - self.position
+        return self.block_measures * BEATS_PER_MEASURE * STEPS_PER_BEAT * drummer_step_duration(self.sr, self.tempo)
+
+    def _track_tempo(self, beats, duration):
+        """Wygładza tempo wykładniczo w kierunku tempa z beatów bloku (`duration` sekund)."""
+        period = self._beat_period(beats)
+        if period is None:
+            return
+        # Beat tracker może złapać połowę lub dwukrotność tempa: sprowadzamy do oktawy bieżącego
+        local = 60 * self.sr / period
+        while local > self.tempo * np.sqrt(2):
+            local /= 2
+        while local < self.tempo / np.sqrt(2):
+            local *= 2
+        self.tempo += (1 - 0.5 ** (duration / self.tempo_half_life)) * (local - self.tempo)
+
+    @staticmethod
+    def _beat_offset(beats, boundary, beat_len):
+        """Przesunięcie `boundary` (koniec siatki bloku) na fazę beatów wykrytych wokół niego:
+        mediana odchyłek ostatniego taktu i wyprzedzenia, w granicach pół beatu."""
+        near = beats[beats >= boundary - BEATS_PER_MEASURE * beat_len]
+        if len(near) == 0:
+            return 0
+        residual = (near - boundary + beat_len // 2) % beat_len - beat_len // 2
+        return int(np.median(residual))
+
+    def _process_block(self, percussion_out, combined_out):
+        sr = self.sr
+        lead_in = self.position < self.downbeat
+        span = self._block_span()
+        nominal = min(span, len(self.pending))
+        segment = np.concatenate([self.history, self.pending[:nominal + self.lookahead]])
+        segment_start = self.position - len(self.history)
+        context = AnalysisContext(segment, sr)
+
+        # Siatka bloku w tempie poprawionym o beaty tego bloku, a jej koniec (następny takt)
+        # przesunięty na wykryty beat; blok kończący plik zostaje w dotychczasowym tempie
+        n = nominal
+        if lead_in:
+            total_steps = 0
+        elif len(self.pending) >= span + self.lookahead:
+            beats = segment_start + librosa.frames_to_samples(context.beats()[1], hop_length=context.hop_length)
+            self._track_tempo(beats, len(segment) / sr)
+            step_duration = drummer_step_duration(sr, self.tempo)
+            total_steps = self.block_measures * BEATS_PER_MEASURE * STEPS_PER_BEAT
+            grid = total_steps * step_duration
+            n = grid + self._beat_offset(beats, self.position + grid, STEPS_PER_BEAT * step_duration)
+            n = min(n, span + self.lookahead)  # dalej nie ma przeanalizowanego dźwięku
+        else:
+            total_steps = n // drummer_step_duration(sr, self.tempo)
+        tempo = self.tempo
+        step_duration = drummer_step_duration(sr, tempo)
+        block = self.pending[:n]
+        block_start = self.position / sr
+
+        events = detect_existing_percussion(context, offset=segment_start / sr - block_start)
+        events = {inst: [t for t in times if 0 <= t < n / sr] for inst, times in events.items()}
+
+        # Normalizacja cech bieżącym min/max całego dotychczasowego nagrania
+        rms, onset_env = context.measure_features(tempo, len(self.history), len(self.history) + n)
+        self.rms_range = [min(self.rms_range[0], rms.min()), max(self.rms_range[1], rms.max())]
+        self.onset_range = [min(self.onset_range[0], onset_env.min()), max(self.onset_range[1], onset_env.max())]
+        rms_normalized = normalize_feature(rms, *self.rms_range)
+        onset_normalized = normalize_feature(onset_env, *self.onset_range)
+
+        track = build_percussion_track(events, tempo, total_steps, rms_normalized, onset_normalized,
+                                       self.style, first_measure=self.measure, rng=self.rng)
+        max_note = max(drummer_note_duration(r, step_duration, sr, tempo)
+                       for r in RHYTHM_TYPES.values()) * max(r['notes'] for r in RHYTHM_TYPES.values())
+        length = max(n, total_steps * step_duration, len(self.spill)) + max_note
+        percussion = synthesize_percussion(track, self.sample_arrays, sr, tempo, length)
+        percussion[:len(self.spill)] += self.spill
+        self.spill = percussion[n:].copy()
+        percussion = percussion[:n]
+
+        # Skalowanie do RMS oryginału jak w synthesize_enhanced_audio, liczone narastająco
+        self.original_energy += float(np.sum(block ** 2))
+        self.percussion_energy += float(np.sum(percussion ** 2))
+        if self.percussion_energy > 0:
+            percussion = percussion * np.float32(np.sqrt(self.original_energy / self.percussion_energy) * 0.3)
+        combined = block * 0.4 + percussion * 0.5
+        self.peak = max(self.peak, float(np.max(np.abs(combined))) if n else 0.0)
+        percussion_out.write(percussion)
+        combined_out.write(combined)
+
+        self.history = block[-self.context:].copy()
+        self.pending = self.pending[n:]
+        self.position += n
+        self.measure += total_steps // (BEATS_PER_MEASURE * STEPS_PER_BEAT)
+
+
+def render_project(project_path, output_path, bars=4, mode=None, bpm=None, dynamic_bpm=None, sample_rate=44100):
+    """Renderuje projekt .drsmp do WAV/FLAC (format wg rozszerzenia) bez GUI i karty dźwiękowej."""
+    with open(project_path, 'r') as f:
+        project = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(project_path))
+    samples = {}
+    for inst, path in project.get("samples", {}).items():
+        if not os.path.isfile(path) and os.path.isfile(os.path.join(base_dir, path)):
+            path = os.path.join(base_dir, path)
+        samples[inst] = path
+
+    advanced = project.get("advanced_sequencer_mode", False) if mode is None else mode == "advanced"
+    patterns = Pattern.from_project(project)
+    bpm = bpm or project.get("absolute_bpm", 120)
+    if dynamic_bpm is None:
+        dynamic_bpm = project.get("dynamic_bpm_list", [])
+    else:
+        dynamic_bpm = [bpm * p / 100 for p in dynamic_bpm]
+
+    audio = render_pattern(patterns, advanced, samples, bars * 16, bpm, dynamic_bpm,
+                           project.get("effects"), project.get("adsr"), project.get("adsr_curve", 'linear'),
+                           sample_rate)
+    sf.write(output_path, audio, sample_rate)
+    return len(audio) / sample_rate
+
+
+class BlockMixer:
+    """Programowy mikser: sumuje aktywne głosy blokami do jednego bufora float32.
+
+    Wynik trafia do jednego zarezerwowanego kanału pygame (kolejka bloków), więc
+    polifonia jest ograniczona przez `max_voices`, a nie przez kanały miksera.
+
+    Głos zaczyna się od próbki odpowiadającej jego czasowi `at` (time.perf_counter), także
+    w środku bloku: próbka p gra w chwili epoch + p / sample_rate, a wszystko jest przesunięte
+    o stałe `latency` (dwa bloki: grający i zakolejkowany, plus zapas), żeby zdarzenie wysłane punktualnie
+    nie trafiało do już wyrenderowanego bloku.
+    """
+
+    def __init__(self, sample_rate=44100, block_size=1024, max_voices=32, steal_policy='oldest'):
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.max_voices = max_voices
+        self.steal_policy = steal_policy
+        self.latency = 2 * block_size / sample_rate + 0.005
+        self.epoch = time.perf_counter()
+        self.position = 0  # pierwsza próbka następnego bloku
+        self._voices = []
+        self._serial = 0
+        self._lock = threading.Lock()
+        self._out = np.zeros((block_size, 2), dtype=np.float32)
+        self.cpu_load = 0.0
+        self.stolen = 0
+        self.running = False
+        self.thread = None
+        self.channel = None
+
+    def sample_at(self, at):
+        """Numer próbki wyjściowej, która zagra `latency` po chwili `at`."""
+        return int(round((at + self.latency - self.epoch) * self.sample_rate))
+
+    def play(self, data, gain=1.0, pan=0.0, at=None):
+        """Dodaje głos; `data` to float32 (n, 2), tylko do odczytu, `at` to czas startu (domyślnie teraz)."""
+        theta = (max(-1.0, min(1.0, pan)) + 1) * np.pi / 4
+        gains = np.array([np.cos(theta), np.sin(theta)], dtype=np.float32) * np.float32(np.sqrt(2) * gain)
+        start = self.sample_at(time.perf_counter() if at is None else at)
+        with self._lock:
+            if len(self._voices) >= self.max_voices:
+                self._steal()
+            # Spóźniony głos (blok już wyrenderowany) zaczyna się od następnego bloku
+            self._voices.append([data, max(start, self.position), gains, self._serial])
+            self._serial += 1
+
+    def _steal(self):
+        if self.steal_policy == 'quietest':
+            victim = min(self._voices, key=lambda v: float(v[2].max()))
+        else:
+            victim = min(self._voices, key=lambda v: v[3])
+        self._voices.remove(victim)
+        self.stolen += 1
+
+    @property
+    def voice_count(self):
+        with self._lock:
+            return len(self._voices)
+
+    def render_block(self):
+        """Callback audio: zwraca blok float32 (block_size, 2)."""
+        out = self._out
+        out.fill(0)
+        n = self.block_size
+        with self._lock:
+            block_start = self.position
+            alive = []
+            for voice in self._voices:
+                data, start, gains, _ = voice
+                if start >= block_start + n:
+                    alive.append(voice)  # zaczyna się w jednym z kolejnych bloków
+                    continue
+                offset = max(start - block_start, 0)
+                chunk = data[block_start + offset - start:block_start + n - start]
+                out[offset:offset + len(chunk)] += chunk * gains
+                if start + len(data) > block_start + n:
+                    alive.append(voice)
+            self._voices = alive
+            self.position = block_start + n
+        np.clip(out, -1.0, 1.0, out=out)
+        return out
+
+    def start(self):
+        if self.running:
+            return
+        pygame.mixer.set_reserved(1)
+        self.channel = pygame.mixer.Channel(0)
+        with self._lock:
+            self.epoch = time.perf_counter() - self.position / self.sample_rate
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self._lock:
+            self._voices = []
+
+    def _run(self):
+        block_time = self.block_size / self.sample_rate
+        while self.running:
+            if self.channel.get_queue() is None:
+                started = time.perf_counter()
+                busy = self.channel.get_busy()
+                if not busy:
+                    # Przerwa w odtwarzaniu (niedobór): nowy blok gra od razu, więc zegar
+                    # próbek przesuwa się na teraz, żeby czasy głosów dalej się zgadzały
+                    with self._lock:
+                        self.epoch = started - self.position / self.sample_rate
+                block = (self.render_block() * 32767).astype(np.int16)
+                sound = pygame.sndarray.make_sound(block)
+                if busy:
+                    self.channel.queue(sound)
+                else:
+                    self.channel.play(sound)
+                load = (time.perf_counter() - started) / block_time
+                self.cpu_load = 0.9 * self.cpu_load + 0.1 * load
+            # Częste sprawdzanie kolejki: czasy głosów są w próbkach, więc moment renderu
+            # nie przesuwa dźwięku, wystarczy nie dopuścić do niedoboru
+            time.sleep(0.002)
+
+
+class DrumSamplerApp(Gtk.Window if Gtk is not None else object):
     def __init__(self):
         Gtk.Window.__init__(self, title="Drum Sampler")
         self.set_border_width(10)
@@ -26,6 +2184,8 @@ class DrumSamplerApp(Gtk.Window):
         self.scale_factor = 1.0
 
         pygame.mixer.init()
+        self.mixer = BlockMixer()
+        self.mixer.start()
 
         # Main container
         scroll_window = Gtk.ScrolledWindow()
@@ -38,28 +2198,24 @@ class DrumSamplerApp(Gtk.Window):
         self.base_bpm = 80
         self.absolute_bpm = 120
         self.genre_bpm = {"House": 125, "Techno": 130, "Drum and Bass": 165, "Ambient": 80}
-        self.instruments = ['Talerz', 'Stopa', 'Werbel', 'TomTom']
+        self.instruments = list(INSTRUMENTS)
         self.advanced_sequencer_mode = False
         self.performer_mode = False  # Nowy tryb Performer
-        self.simple_patterns = {inst: [0] * 16 for inst in self.instruments}
-        self.advanced_patterns = {
-            inst: [{'active': False, 'rhythm_type': 'single'} for _ in range(16)]
-            for inst in self.instruments
-        }
-        self.patterns = self.simple_patterns
+        # Jeden wzorzec dla obu trybów; tryb prosty czyta z niego tylko aktywność kroków
+        self.patterns = Pattern(self.instruments, 16)
         self.colors = ['red', 'green', 'blue', 'orange']
-        self.midi_notes = {'Talerz': 49, 'Stopa': 36, 'Werbel': 38, 'TomTom': 45}
+        self.midi_notes = dict(MIDI_NOTES)
         self.buttons = {}
         self.samples = {}
+        self.sample_store = SampleStore()
+        self.analysis_cache = AnalysisCache()
+        self.voice_cache = VoiceCache()
+        self.timeline_cache = TimelineCache()
+        self.last_generation = None  # jak odtworzyć ostatni wygenerowany wzorzec, zapisywane w projekcie
+        self.reseed()
         self.effects = {inst: {'volume': 0, 'pitch': 0, 'echo': 0, 'reverb': 0, 'pan': 0} for inst in self.instruments}
         self.last_button_pressed = None
-        self.rhythm_types = {
-            'single': {'notes': 1, 'speed': 1.0, 'swing': 0.0},  # Pojedyncza nuta
-            'double': {'notes': 2, 'speed': 0.5, 'swing': 0.0},  # Dwie nuty w kroku
-            'burst': {'notes': 3, 'speed': 0.25, 'swing': 0.0},  # Szybki burst (trzy nuty)
-            'swing': {'notes': 2, 'speed': 0.5, 'swing': 0.2},   # Dwie nuty ze swingiem
-            'accent': {'notes': 1, 'speed': 1.0, 'swing': 0.0}   # Pojedyncza nuta z akcentem
-        }
+        self.rhythm_types = RHYTHM_TYPES
 
         # Load samples
         self.load_samples_from_directory()
@@ -92,9 +2248,11 @@ class DrumSamplerApp(Gtk.Window):
 
         self.loop_playing = False
         self.play_thread = None
+        self.scheduler = None
+        self.scheduler_lookahead = 0.1
         self.dynamic_bpm_list = []
         self.current_bpm_index = 0
-        self.steps_per_bpm = 4
+        self.steps_per_bpm = STEPS_PER_BPM
 
         # Connect scaling
         self.connect("size-allocate", self.scale_interface)
@@ -377,9 +2535,8 @@ class DrumSamplerApp(Gtk.Window):
 
         self.preset_combo = Gtk.ComboBoxText()
         self.preset_combo.append_text("None")
-        self.preset_combo.append_text("Basic Techno")
-        self.preset_combo.append_text("Minimal Techno")
-        self.preset_combo.append_text("Hard Techno")
+        for preset in PRESET_RULES:
+            self.preset_combo.append_text(preset)
         self.preset_combo.set_active(0)
         preset_box.pack_start(self.preset_combo, False, False, 0)
 
@@ -464,13 +2621,9 @@ class DrumSamplerApp(Gtk.Window):
         sample_box.set_hexpand(True)
         self.main_box.pack_start(sample_box, False, False, int(10 * self.scale_factor))
 
-        self.nominal_adsr = {
-            'Talerz': {'attack': 0.01, 'decay': 0.1, 'sustain': 0.8, 'release': 0.6},
-            'Stopa': {'attack': 0.01, 'decay': 0.2, 'sustain': 0.3, 'release': 0.1},
-            'Werbel': {'attack': 0.02, 'decay': 0.2, 'sustain': 0.4, 'release': 0.3},
-            'TomTom': {'attack': 0.03, 'decay': 0.3, 'sustain': 0.5, 'release': 0.4}
-        }
+        self.nominal_adsr = NOMINAL_ADSR
         self.current_adsr = {inst: self.nominal_adsr[inst].copy() for inst in self.instruments}
+        self.adsr_curve = 'linear'
         self.preview_active = {inst: False for inst in self.instruments}
 
         self.adsr_entries = {}
@@ -541,6 +2694,16 @@ class DrumSamplerApp(Gtk.Window):
         export_btn.connect("clicked", self.export_sample_bank)
         bank_box.pack_start(export_btn, False, False, 0)
 
+        curve_label = Gtk.Label(label="Curve:")
+        bank_box.pack_start(curve_label, False, False, 0)
+
+        self.adsr_curve_combo = Gtk.ComboBoxText()
+        self.adsr_curve_combo.append_text("linear")
+        self.adsr_curve_combo.append_text("exponential")
+        self.adsr_curve_combo.set_active(0)
+        self.adsr_curve_combo.connect("changed", self.on_adsr_curve_changed)
+        bank_box.pack_start(self.adsr_curve_combo, False, False, 0)
+
         sample_box.pack_end(bank_box, False, False, 0)
 
         if not self.samples:
@@ -571,41 +2734,20 @@ class DrumSamplerApp(Gtk.Window):
 
     # Event Handlers and Helper Methods
     def on_button_toggled(self, button, instrument, step):
-        if self.advanced_sequencer_mode:
-            is_active = button.get_active()
-            step_data = self.patterns[instrument][step]
-            step_data['active'] = is_active
-            if is_active and step_data['rhythm_type'] == 'single':
-                step_data['rhythm_type'] = 'single'
-            self.update_button_visual(button, instrument, step)
-        else:
-            self.patterns[instrument][step] = int(button.get_active())
+        self.patterns[instrument][step]['active'] = button.get_active()
+        self.update_button_visual(button, instrument, step)
 
     def update_buttons(self):
         pattern_length = int(self.length_spinbutton.get_value())
-        for inst in self.instruments:
-            if self.advanced_sequencer_mode:
-                if len(self.patterns[inst]) < pattern_length:
-                    self.patterns[inst].extend([{'active': False, 'rhythm_type': 'single'} for _ in range(pattern_length - len(self.patterns[inst]))])
-                elif len(self.patterns[inst]) > pattern_length:
-                    self.patterns[inst] = self.patterns[inst][:pattern_length]
-            else:
-                if len(self.patterns[inst]) < pattern_length:
-                    self.patterns[inst].extend([0] * (pattern_length - len(self.patterns[inst])))
-                elif len(self.patterns[inst]) > pattern_length:
-                    self.patterns[inst] = self.patterns[inst][:pattern_length]
+        if self.patterns.length != pattern_length:
+            self.patterns.resize(pattern_length)
     
         for inst in self.instruments:
             for i in range(pattern_length):
                 try:
                     button = self.buttons[inst][i]
-                    if self.advanced_sequencer_mode:
-                        step_data = self.patterns[inst][i]
-                        button.set_active(step_data['active'])
-                        self.update_button_visual(button, inst, i)
-                    else:
-                        button.set_active(bool(self.patterns[inst][i]))
-                        button.set_label("")
+                    button.set_active(self.patterns[inst][i]['active'])
+                    self.update_button_visual(button, inst, i)
                 except IndexError:
                     self.reinitialize_buttons()
                     return
@@ -659,8 +2801,8 @@ class DrumSamplerApp(Gtk.Window):
         self.update_button_visual(widget, instrument, step)
 
     def on_sequencer_mode_switch(self, switch, gparam):
+        # Te same dane w obu trybach: przełączenie zmienia tylko interpretację typu rytmu
         self.advanced_sequencer_mode = switch.get_active()
-        self.patterns = self.advanced_patterns if self.advanced_sequencer_mode else self.simple_patterns
         self.update_buttons()
 
     def on_performer_mode_switch(self, switch, gparam):
@@ -678,16 +2820,11 @@ class DrumSamplerApp(Gtk.Window):
         self.update_dynamic_bpm()
 
     def calculate_pattern_density(self):
-        total_active_steps = 0
-        total_steps = len(self.instruments) * len(self.patterns[self.instruments[0]])
+        total_steps = self.patterns.active.size
         if self.advanced_sequencer_mode:
-            for inst in self.instruments:
-                for step in self.patterns[inst]:
-                    if step['active']:
-                        total_active_steps += self.rhythm_types[step['rhythm_type']]['notes']
+            total_active_steps = int(self.patterns.note_counts().sum())
         else:
-            for inst in self.instruments:
-                total_active_steps += sum(self.patterns[inst])
+            total_active_steps = int(self.patterns.active.sum())
         return total_active_steps / total_steps if total_steps > 0 else 0
 
     def matched_bpm(self, widget):
@@ -727,87 +2864,49 @@ class DrumSamplerApp(Gtk.Window):
         if self.dynamic_bpm_list:
             self.current_bpm_index = (self.current_bpm_index + 1) % len(self.dynamic_bpm_list)
 
+    def reseed(self, seed=None):
+        """Ziarno sesji; z niego pochodzą ziarna generatorów i losowość odtwarzania (groove, humanizacja)."""
+        self.seed = new_seed() if seed is None else int(seed)
+        self.seed_sequence = np.random.SeedSequence(self.seed)
+        self.playback_rng = np.random.default_rng(spawn_seed(self.seed_sequence))
+
+    def next_seed(self, generator=None, **params):
+        """Ziarno dla kolejnego generatora; z nazwą z PATTERN_GENERATORS zapamiętuje, jak odtworzyć wynik."""
+        seed = spawn_seed(self.seed_sequence)
+        if generator:
+            self.last_generation = {'generator': generator, 'params': params, 'seed': seed}
+        return seed
+
+    def next_rng(self):
+        return np.random.default_rng(self.next_seed())
+
     def generate_custom_pattern(self, widget):
-        genre = self.custom_genre_entry.get_text() or "Generic"
-        progression = self.progression_combo.get_active_text()
-        occurrences = int(self.occurrences_spin.get_value())
-        intensity = self.intensity_spin.get_value()
-        pattern_length = int(self.length_spinbutton.get_value())
-        mod = self.mod_combo.get_active_text()
-        
-        rhythm_styles = {
-            "Techno": {'Stopa': ['single'], 'Werbel': ['swing'], 'Talerz': ['burst'], 'TomTom': ['accent']},
-            "House": {'Stopa': ['double'], 'Werbel': ['single'], 'Talerz': ['swing'], 'TomTom': ['single']},
-            "Drum and Bass": {'Stopa': ['burst'], 'Werbel': ['swing'], 'Talerz': ['double'], 'TomTom': ['accent']},
-            "Ambient": {'Stopa': ['single'], 'Werbel': ['double'], 'Talerz': ['swing'], 'TomTom': ['single']},
-            "Trap": {'Stopa': ['double'], 'Werbel': ['burst'], 'Talerz': ['single'], 'TomTom': ['accent']},
-            "Dubstep": {'Stopa': ['single'], 'Werbel': ['swing'], 'Talerz': ['burst'], 'TomTom': ['double']},
-            "Jazz": {'Stopa': ['swing'], 'Werbel': ['double'], 'Talerz': ['single'], 'TomTom': ['accent']},
-            "Breakbeat": {'Stopa': ['burst'], 'Werbel': ['swing'], 'Talerz': ['double'], 'TomTom': ['single']}
+        params = {
+            'genre': self.custom_genre_entry.get_text() or "Generic",
+            'progression': self.progression_combo.get_active_text(),
+            'occurrences': int(self.occurrences_spin.get_value()),
+            'intensity': self.intensity_spin.get_value(),
+            'modification': self.mod_combo.get_active_text(),
+            'length': int(self.length_spinbutton.get_value()),
         }
-        rules = rhythm_styles.get(genre, {'Stopa': ['single'], 'Werbel': ['single'], 'Talerz': ['single'], 'TomTom': ['single']})
-        
-        if self.advanced_sequencer_mode:
-            for inst in self.instruments:
-                self.patterns[inst] = [{'active': False, 'rhythm_type': 'single'} for _ in range(pattern_length)]
-        else:
-            for inst in self.instruments:
-                self.patterns[inst] = [0] * pattern_length
-        
-        if progression == "Linear":
-            for inst in self.instruments:
-                step_interval = pattern_length // occurrences
-                for i in range(0, pattern_length, step_interval):
-                    if random.random() < intensity:
-                        self.patterns = {inst: [{ 'active': False } for _ in range(num_steps)] for inst in instruments}
-                        self.patterns[inst][i]['rhythm_type'] = random.choice(rules[inst])
-        elif progression == "Dense":
-            for inst in self.instruments:
-                for i in range(pattern_length):
-                    if random.random() < intensity * 0.8:
-                        self.patterns = {inst: [{ 'active': False } for _ in range(num_steps)] for inst in instruments}
-                        self.patterns[inst][i]['rhythm_type'] = random.choice(rules[inst])
-        elif progression == "Sparse":
-            for inst in self.instruments:
-                for i in range(pattern_length):
-                    if random.random() < intensity * 0.3:
-                        self.patterns = {inst: [{ 'active': False } for _ in range(num_steps)] for inst in instruments}
-                        self.patterns[inst][i]['rhythm_type'] = random.choice(rules[inst])
-        elif progression == "Random":
-            for inst in self.instruments:
-                for i in range(pattern_length):
-                    if random.random() < intensity:
-                        self.patterns = {inst: [{ 'active': False } for _ in range(num_steps)] for inst in instruments}
-                        self.patterns[inst][i]['rhythm_type'] = random.choice(rules[inst])
-        
-        if mod == "Simplify":
-            for inst in self.instruments:
-                for i in range(pattern_length):
-                    if self.advanced_sequencer_mode:
-                        if self.patterns[inst][i]['active'] and random.random() < 0.5:
-                            self.patterns[inst][i]['active'] = False
-                    else:
-                        if self.patterns[inst][i] == 1 and random.random() < 0.5:
-                            self.patterns[inst][i] = 0
-        elif mod == "More Complex":
-            for inst in self.instruments:
-                for i in range(pattern_length):
-                    if random.random() < intensity * 0.2:
-                        self.patterns = {inst: [{ 'active': False } for _ in range(num_steps)] for inst in instruments}
-                        self.patterns[inst][i]['rhythm_type'] = random.choice(rules[inst])
-        
+        self.apply_generated('custom', params)
+
+    def apply_generated(self, generator, params):
+        """Wzorzec z generatora PATTERN_GENERATORS z nowym ziarnem, zbudowany z tego samego zapisu,
+        który trafia do projektu (z odciskiem wyniku do sprawdzenia przy wczytaniu)."""
+        self.next_seed(generator, **params)
+        pattern = regenerate_pattern(self.last_generation, self.instruments)
+        self.last_generation['fingerprint'] = pattern.fingerprint()
+        self.patterns.assign(pattern)
         self.update_buttons()
 
     def on_pattern_length_changed(self, spinbutton):
         new_length = int(spinbutton.get_value())
-        current_length = len(self.patterns[self.instruments[0]])
+        current_length = self.patterns.length
+        self.patterns.resize(new_length)
 
         for instrument in self.instruments:
             if new_length > current_length:
-                if self.advanced_sequencer_mode:
-                    self.patterns[instrument].extend([{'active': False, 'rhythm_type': 'single'} for _ in range(new_length - current_length)])
-                else:
-                    self.patterns[instrument].extend([0] * (new_length - current_length))
                 for i in range(current_length, new_length):
                     button = Gtk.ToggleButton()
                     button.set_size_request(30, 30)
@@ -819,7 +2918,6 @@ class DrumSamplerApp(Gtk.Window):
                     self.grid.attach(button, i + 1, self.instruments.index(instrument) + 1, 1, 1)
                     self.buttons[instrument].append(button)
             elif new_length < current_length:
-                self.patterns[instrument] = self.patterns[instrument][:new_length]
                 for button in self.buttons[instrument][new_length:]:
                     self.grid.remove(button)
                 self.buttons[instrument] = self.buttons[instrument][:new_length]
@@ -842,105 +2940,32 @@ class DrumSamplerApp(Gtk.Window):
     def randomize_instruments(self, widget):
         probability = self.randomize_probability_spin.get_value() / 100
         pattern_length = int(self.length_spinbutton.get_value())
-
-        for step in range(pattern_length):
-            if random.random() < probability:
-                inst1, inst2 = random.sample(self.instruments, 2)
-                self.patterns[inst1][step], self.patterns[inst2][step] = self.patterns[inst2][step], self.patterns[inst1][step]
-
+        shuffle_instruments(self.patterns, probability, self.next_rng(), pattern_length)
         self.update_buttons()
 
     def autofill_pattern(self):
         pattern_length = int(self.length_spinbutton.get_value())
         genre = self.custom_genre_entry.get_text() or self.preset_genre_combo.get_active_text() or "Generic"
-        rhythm_styles = {
-            "Techno": {'Stopa': ['single'], 'Werbel': ['swing'], 'Talerz': ['burst'], 'TomTom': ['accent']},
-            "House": {'Stopa': ['double'], 'Werbel': ['single'], 'Talerz': ['swing'], 'TomTom': ['single']}
-        }
-        rules = rhythm_styles.get(genre, {'Stopa': ['single'], 'Werbel': ['single'], 'Talerz': ['single'], 'TomTom': ['single']})
-    
-        for instrument in self.instruments:
-            if self.advanced_sequencer_mode:
-                active_steps = [i for i, step in enumerate(self.patterns[instrument]) if step['active']]
-                for i in range(pattern_length):
-                    if i not in active_steps and random.random() < 0.3:
-                        self.patterns[instrument][i]['active'] = True
-                        self.patterns[instrument][i]['rhythm_type'] = random.choice(rules[instrument])
-            else:
-                active_steps = [i for i, step in enumerate(self.patterns[instrument]) if step == 1]
-                for i in range(pattern_length):
-                    if i not in active_steps and random.random() < 0.3:
-                        self.patterns[instrument][i] = 1
-    
+        autofill_pattern(self.patterns, genre, self.next_rng(), pattern_length)
         self.update_buttons()
 
     def apply_preset(self, widget):
         preset = self.preset_combo.get_active_text()
-        if preset == "Basic Techno":
-            self.generate_basic_techno()
-        elif preset == "Minimal Techno":
-            self.generate_minimal_techno()
-        elif preset == "Hard Techno":
-            self.generate_hard_techno()
+        if preset in PRESET_RULES:
+            # Jak dawne set_row: tylko wiersze z tabeli i pierwsze `length` kroków
+            length = min(int(self.length_spinbutton.get_value()), self.patterns.length)
+            rules = PRESET_RULES[preset]
+            active, rhythm = evaluate_rules(rules, length, self.instruments)
+            rows = [self.patterns.index(inst) for inst in rules if inst in self.patterns]
+            self.patterns.active[rows, :length] = active[rows]
+            self.patterns.rhythm[rows, :length] = rhythm[rows]
         self.update_buttons()
 
-    def generate_basic_techno(self):
-        pattern_length = int(self.length_spinbutton.get_value())
-        for i in range(pattern_length):
-            if self.advanced_sequencer_mode:
-                self.patterns['Stopa'][i]['active'] = True if i % 4 == 0 else False
-                self.patterns['Stopa'][i]['rhythm_type'] = 'single'
-                self.patterns['Werbel'][i]['active'] = True if i % 8 == 4 else False
-                self.patterns['Werbel'][i]['rhythm_type'] = 'swing'
-                self.patterns['Talerz'][i]['active'] = True if i % 4 == 2 else False
-                self.patterns['Talerz'][i]['rhythm_type'] = 'burst'
-                self.patterns['TomTom'][i]['active'] = True if i % 16 == 14 else False
-                self.patterns['TomTom'][i]['rhythm_type'] = 'accent'
-            else:
-                self.patterns['Stopa'][i] = 1 if i % 4 == 0 else 0
-                self.patterns['Werbel'][i] = 1 if i % 8 == 4 else 0
-                self.patterns['Talerz'][i] = 1 if i % 4 == 2 else 0
-                self.patterns['TomTom'][i] = 1 if i % 16 == 14 else 0
-
-    def generate_minimal_techno(self):
-        pattern_length = int(self.length_spinbutton.get_value())
-        for i in range(pattern_length):
-            if self.advanced_sequencer_mode:
-                self.patterns['Stopa'][i]['active'] = True if i % 4 == 0 or i % 16 == 14 else False
-                self.patterns['Stopa'][i]['rhythm_type'] = 'single'
-                self.patterns['Werbel'][i]['active'] = True if i % 8 == 4 else False
-                self.patterns['Werbel'][i]['rhythm_type'] = 'swing'
-                self.patterns['Talerz'][i]['active'] = True if i % 2 == 0 else False
-                self.patterns['Talerz'][i]['rhythm_type'] = 'double'
-                self.patterns['TomTom'][i]['active'] = True if i % 16 == 10 else False
-                self.patterns['TomTom'][i]['rhythm_type'] = 'accent'
-            else:
-                self.patterns['Stopa'][i] = 1 if i % 4 == 0 or i % 16 == 14 else 0
-                self.patterns['Werbel'][i] = 1 if i % 8 == 4 else 0
-                self.patterns['Talerz'][i] = 1 if i % 2 == 0 else 0
-                self.patterns['TomTom'][i] = 1 if i % 16 == 10 else 0
-
-    def generate_hard_techno(self):
-        pattern_length = int(self.length_spinbutton.get_value())
-        for i in range(pattern_length):
-            if self.advanced_sequencer_mode:
-                self.patterns['Stopa'][i]['active'] = True if i % 2 == 0 else False
-                self.patterns['Stopa'][i]['rhythm_type'] = 'burst'
-                self.patterns['Werbel'][i]['active'] = True if i % 8 == 4 or i % 8 == 6 else False
-                self.patterns['Werbel'][i]['rhythm_type'] = 'swing'
-                self.patterns['Talerz'][i]['active'] = True if i % 4 == 0 else False
-                self.patterns['Talerz'][i]['rhythm_type'] = 'double'
-                self.patterns['TomTom'][i]['active'] = True if i % 8 == 7 else False
-                self.patterns['TomTom'][i]['rhythm_type'] = 'accent'
-            else:
-                self.patterns['Stopa'][i] = 1 if i % 2 == 0 else 0
-                self.patterns['Werbel'][i] = 1 if i % 8 == 4 or i % 8 == 6 else 0
-                self.patterns['Talerz'][i] = 1 if i % 4 == 0 else 0
-                self.patterns['TomTom'][i] = 1 if i % 8 == 7 else 0
-
     def on_effect_changed(self, slider, instrument, effect):
         value = slider.get_value()
-        self.effects[instrument][effect] = value
+        if self.effects[instrument][effect] != value:
+            self.effects[instrument][effect] = value
+            self.refresh_voices(instrument)
 
     def reset_effect(self, button, slider, instrument, effect):
         slider.set_value(0)
@@ -949,107 +2974,62 @@ class DrumSamplerApp(Gtk.Window):
     def reset_all_effects(self, widget):
         for instrument in self.instruments:
             for effect in self.effects[instrument]:
-                self.effects[instrument][effect] = 0
                 if effect in self.effect_sliders[instrument]:
                     self.effect_sliders[instrument][effect].set_value(0)
+                self.effects[instrument][effect] = 0
 
     def reset_genre_fx(self, widget):
         for instrument in self.instruments:
             for effect in self.effects[instrument]:
-                self.effects[instrument][effect] = 0
                 if effect in self.effect_sliders[instrument]:
                     self.effect_sliders[instrument][effect].set_value(0)
+                self.effects[instrument][effect] = 0
 
-    def apply_effects(self, sound, instrument):
-        sound = self.apply_adsr_to_sound(sound, instrument)
-        effects = self.effects[instrument]
-        sound_array = pygame.sndarray.array(sound)
-        sample_width = sound_array.dtype.itemsize
-        channels = 1 if sound_array.ndim == 1 else 2
-
-        audio_segment = AudioSegment(
-            sound_array.tobytes(),
-            frame_rate=44100,
-            sample_width=sample_width,
-            channels=channels
-        )
-
-        if effects['volume'] != 0:
-            audio_segment = audio_segment + (effects['volume'] * 10)
-
-        if effects['pitch'] != 0:
-            new_rate = int(audio_segment.frame_rate * (2 ** (effects['pitch'] / 12)))
-            audio_segment = audio_segment._spawn(audio_segment.raw_data, overrides={'frame_rate': new_rate})
-            audio_segment = audio_segment.set_frame_rate(44100)
-
-        if effects['echo'] > 0:
-            delay_ms = int(200 * effects['echo'])
-            echo_segment = audio_segment - 10
-            audio_segment = audio_segment.overlay(echo_segment, position=delay_ms)
-
-        if effects['reverb'] > 0:
-            reverb_amount = effects['reverb'] * 300
-            audio_segment = audio_segment.fade_in(50).fade_out(int(reverb_amount))
-
-        if effects['pan'] != 0:
-            audio_segment = audio_segment.pan(effects['pan'])
-
-        audio_segment = normalize(audio_segment)
-
-        samples = np.array(audio_segment.get_array_of_samples())
-        if channels == 2:
-            samples = samples.reshape((-1, 2))
-
-        return pygame.sndarray.make_sound(samples)
-
-    def apply_adsr_to_sound(self, sound, instrument):
-        sound_array = pygame.sndarray.array(sound)
-        sample_rate = 44100
-        total_samples = len(sound_array)
+    def voice_key(self, instrument):
         adsr = self.current_adsr[instrument]
-        is_stereo = sound_array.ndim == 2
-    
-        if is_stereo:
-            channels = sound_array.shape[1]
-        else:
-            channels = 1
-            sound_array = sound_array.reshape(-1, 1)
-    
-        attack_samples = int(adsr['attack'] * sample_rate)
-        decay_samples = int(adsr['decay'] * sample_rate)
-        release_samples = int(adsr['release'] * sample_rate)
-        sustain_samples = total_samples - attack_samples - decay_samples - release_samples
-    
-        if sustain_samples < 0:
-            excess = -sustain_samples
-            total_adsr = attack_samples + decay_samples + release_samples
-            scale_factor = (total_samples - excess) / total_adsr
-            attack_samples = int(attack_samples * scale_factor)
-            decay_samples = int(decay_samples * scale_factor)
-            release_samples = int(release_samples * scale_factor)
-            sustain_samples = total_samples - attack_samples - decay_samples - release_samples
-    
-        envelope = np.zeros(total_samples, dtype=np.float32)
-        if attack_samples > 0:
-            envelope[:attack_samples] = np.linspace(0, 1, min(attack_samples, total_samples))
-        if decay_samples > 0 and attack_samples < total_samples:
-            decay_end = min(attack_samples + decay_samples, total_samples)
-            envelope[attack_samples:decay_end] = np.linspace(1, adsr['sustain'], decay_end - attack_samples)
-        if sustain_samples > 0 and attack_samples + decay_samples < total_samples:
-            sustain_end = min(attack_samples + decay_samples + sustain_samples, total_samples)
-            envelope[attack_samples + decay_samples:sustain_end] = adsr['sustain']
-        if release_samples > 0 and total_samples - release_samples > 0:
-            release_start = max(0, total_samples - release_samples)
-            envelope[release_start:] = np.linspace(adsr['sustain'], 0, total_samples - release_start)
-    
-        if is_stereo:
-            sound_array[:, 0] = sound_array[:, 0] * envelope
-            sound_array[:, 1] = sound_array[:, 1] * envelope
-        else:
-            sound_array[:, 0] = sound_array[:, 0] * envelope
-            sound_array = np.hstack((sound_array, sound_array))
-    
-        return pygame.sndarray.make_sound(sound_array.astype(np.int16))
+        return (self.samples[instrument],
+                tuple(adsr[p] for p in ('attack', 'decay', 'sustain', 'release')) + (self.adsr_curve,),
+                tuple(sorted(self.effects[instrument].items())),
+                'fx')
+
+    def render_voice(self, key):
+        """ADSR + łańcuch efektów na kopii sampla ze SampleStore, wyłącznie z ustawień w kluczu
+        (wątek pomocniczy nie czyta ustawień zmienianych w tym czasie przez GUI)."""
+        path, adsr, effects, _ = key
+        envelope = dict(zip(('attack', 'decay', 'sustain', 'release'), adsr))
+        data = self.sample_store.get(path)
+        data = apply_adsr(data, envelope, curve=adsr[-1], out=np.empty_like(data))
+        voice = apply_effect_chain(data, dict(effects))
+        voice.flags.writeable = False
+        return voice
+
+    def render_raw_voice(self, key):
+        return self.sample_store.get(key[0])
+
+    def get_voice(self, instrument, stale=True):
+        """Zwraca przetworzony głos (float32 stereo) z cache; po zmianie ustawień poprzedni, dopóki
+        nowy renderuje się w tle (`stale=False` renderuje od razu, np. podgląd w GUI)."""
+        return self.voice_cache.get(instrument, self.voice_key(instrument), self.render_voice, stale)
+
+    def get_raw_voice(self, instrument):
+        """Surowy sample bez efektów (wypełnienia TomTom, groove echo)."""
+        return self.voice_cache.get(instrument, (self.samples[instrument], 'raw'), self.render_raw_voice)
+
+    def refresh_voices(self, instrument=None, raw=False):
+        """Zleca render głosów instrumentu (lub wszystkich) w tle po zmianie ustawień lub sampla;
+        odtwarzanie gra poprzedni głos aż do podmiany."""
+        for inst in [instrument] if instrument is not None else self.instruments:
+            if inst in self.samples:
+                self.voice_cache.refresh(inst, self.voice_key(inst), self.render_voice)
+                if raw:
+                    self.voice_cache.refresh(inst, (self.samples[inst], 'raw'), self.render_raw_voice)
+
+    def prime_voices(self):
+        """Renderuje brakujące głosy przed startem pętli, żeby harmonogram zawsze dostał gotowy głos."""
+        for inst in self.instruments:
+            if inst in self.samples:
+                self.get_voice(inst)
+                self.get_raw_voice(inst)
 
     def apply_auto_fx_for_style(self, style):
         fx_settings = {
@@ -1065,9 +3045,9 @@ class DrumSamplerApp(Gtk.Window):
         settings = fx_settings.get(style, {})
         for instrument in self.instruments:
             for effect, value in settings.items():
-                self.effects[instrument][effect] = value
                 if effect in self.effect_sliders[instrument]:
                     self.effect_sliders[instrument][effect].set_value(value)
+                self.effects[instrument][effect] = value
 
     def apply_auto_fx_for_selected_style(self, widget):
         selected_style = self.preset_genre_combo.get_active_text()
@@ -1082,45 +3062,45 @@ class DrumSamplerApp(Gtk.Window):
         self.groove_type = 'simple'
         self.groove_combo.set_active(0)
 
-    def apply_groove_effects(self, sound, instrument, step):
+    def apply_groove_effects(self, voice, instrument, step):
+        """Zwraca (głos, głośność) po zastosowaniu groove; dodatkowe uderzenia idą prosto do miksera."""
         if self.groove_type == "simple":
-            return self.apply_simple_groove(sound, instrument, step)
+            return self.apply_simple_groove(voice, instrument, step)
         elif self.groove_type == "stretch":
-            return self.apply_stretch_groove(sound, instrument, step)
+            return self.apply_stretch_groove(voice, instrument, step)
         elif self.groove_type == "echoes":
-            return self.apply_echoes_groove(sound, instrument, step)
+            return self.apply_echoes_groove(voice, instrument, step)
         elif self.groove_type == "bouncy":
-            return self.apply_bouncy_groove(sound, instrument, step)
+            return self.apply_bouncy_groove(voice, instrument, step)
         elif self.groove_type == "relax":
-            return self.apply_relax_groove(sound, instrument, step)
-        return sound
+            return self.apply_relax_groove(voice, instrument, step)
+        return voice, 1.0
 
-    def apply_simple_groove(self, sound, instrument, step):
-        repeat_chance = random.randint(1, 3)
+    def apply_simple_groove(self, voice, instrument, step):
+        repeat_chance = self.playback_rng.integers(1, 4)
         if repeat_chance == 2:
-            sound.play()
-        return sound
+            self.mixer.play(voice)
+        return voice, 1.0
 
-    def apply_stretch_groove(self, sound, instrument, step):
-        stretched_bpm = self.get_next_bpm() * random.uniform(0.9, 1.1)
+    def apply_stretch_groove(self, voice, instrument, step):
+        stretched_bpm = self.get_next_bpm() * self.playback_rng.uniform(0.9, 1.1)
         self.advance_bpm()
-        return sound
+        return voice, 1.0
 
-    def apply_echoes_groove(self, sound, instrument, step):
-        return self.apply_effects_with_echo(sound, instrument)
+    def apply_echoes_groove(self, voice, instrument, step):
+        return self.apply_effects_with_echo(voice, instrument)
 
-    def apply_bouncy_groove(self, sound, instrument, step):
-        volume_factor = random.choice([0.8, 1.2])
-        sound.set_volume(volume_factor)
-        return sound
+    def apply_bouncy_groove(self, voice, instrument, step):
+        volume_factor = float(self.playback_rng.choice([0.8, 1.2]))
+        return voice, volume_factor
 
-    def apply_relax_groove(self, sound, instrument, step):
-        return self.apply_effects_with_echo(sound, instrument)
+    def apply_relax_groove(self, voice, instrument, step):
+        return self.apply_effects_with_echo(voice, instrument)
 
-    def apply_effects_with_echo(self, sound, instrument):
-        effect_sound = pygame.mixer.Sound(self.samples[instrument])
-        effect_sound.play(maxtime=500)
-        return sound
+    def apply_effects_with_echo(self, voice, instrument):
+        # Surowy sample ucięty do 500 ms, jak wcześniej play(maxtime=500)
+        self.mixer.play(self.get_raw_voice(instrument)[:self.mixer.sample_rate // 2])
+        return voice, 1.0
 
     def advanced_generate_drum_track(self, audio_path, tempo, beat_frames):
         y, sr = librosa.load(audio_path, sr=22050)
@@ -1130,22 +3110,20 @@ class DrumSamplerApp(Gtk.Window):
         beats_per_second = tempo / 60
         total_steps = int(float(total_duration) * beats_per_second * steps_per_beat)
 
-        percussion_track = {inst: [{'active': False, 'rhythm_type': 'single'} for _ in range(total_steps)] for inst in self.instruments}
+        percussion_track = Pattern(self.instruments, total_steps)
 
-        beat_steps = [int(float(frame) * steps_per_beat * beats_per_second * sr / 22050) for frame in beat_frames]
+        beat_steps = (np.asarray(beat_frames, dtype=np.float64) * steps_per_beat * beats_per_second * sr / 22050).astype(np.int64)
 
-        for i in range(total_steps):
-            if i in beat_steps:
-                percussion_track['Stopa'][i]['active'] = True
-                percussion_track['Stopa'][i]['rhythm_type'] = 'single'
-                percussion_track['Werbel'][i]['active'] = True if i % (steps_per_beat * 4) == steps_per_beat else False
-                percussion_track['Werbel'][i]['rhythm_type'] = 'swing'
-            if random.random() < 0.3:
-                percussion_track['Talerz'][i]['active'] = True
-                percussion_track['Talerz'][i]['rhythm_type'] = 'double'
-            if i % (steps_per_beat * 2) == steps_per_beat * 1 and random.random() < 0.2:
-                percussion_track['TomTom'][i]['active'] = True
-                percussion_track['TomTom'][i]['rhythm_type'] = 'accent'
+        i = np.arange(total_steps)
+        on_beat = np.isin(i, beat_steps)
+        percussion_track.set_row('Stopa', on_beat, 'single')
+        werbel = percussion_track.index('Werbel')
+        percussion_track.active[werbel, on_beat] = i[on_beat] % (steps_per_beat * 4) == steps_per_beat
+        percussion_track.rhythm[werbel, on_beat] = RHYTHM_CODES['swing']
+        chance = self.next_rng().random((2, total_steps))
+        percussion_track.set_row('Talerz', chance[0] < 0.3, 'double')
+        tomtom = (i % (steps_per_beat * 2) == steps_per_beat * 1) & (chance[1] < 0.2)
+        percussion_track.set_row('TomTom', tomtom, 'accent')
 
         return percussion_track, y, sr
 
@@ -1158,35 +3136,48 @@ class DrumSamplerApp(Gtk.Window):
         progress_bar = Gtk.ProgressBar()
         progress_bar.set_show_text(True)
         progress_dialog.get_content_area().pack_start(progress_bar, True, True, 0)
+        timing_label = Gtk.Label(label="")
+        progress_dialog.get_content_area().pack_start(timing_label, False, False, 0)
         progress_dialog.show_all()
     
         def update_progress(fraction, message):
             GLib.idle_add(progress_bar.set_fraction, fraction)
             GLib.idle_add(progress_bar.set_text, message)
     
+        streaming_check = Gtk.CheckButton(label="Streaming mode (long files, bounded memory)")
+        file_dialog.set_extra_widget(streaming_check)
+
+        def stream_drums_thread(audio_path):
+            try:
+                style = self.preset_genre_combo.get_active_text() or "Techno"
+                drummer = StreamingDrummer(dict(self.samples), style, seed=self.next_seed())
+                percussion_path, combined_path = drummer.process(audio_path, progress=update_progress)
+                GLib.idle_add(progress_dialog.destroy)
+                GLib.idle_add(self.show_save_confirmation, percussion_path, combined_path)
+            except Exception as e:
+                GLib.idle_add(progress_dialog.destroy)
+                GLib.idle_add(self.show_error_dialog, str(e))
+
         def enhance_drums_thread(audio_path):
+            timings = []
+
+            def stage(name, func, *args):
+                start = time.perf_counter()
+                result = func(*args)
+                timings.append((name, time.perf_counter() - start))
+                GLib.idle_add(timing_label.set_text, "\n".join(f"{n}: {t:.2f} s" for n, t in timings))
+                return result
+
             try:
-                update_progress(0.1, "Loading and analyzing audio...")
-                y, sr = librosa.load(audio_path, sr=22050)
-                tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr)
-    
-                update_progress(0.3, "Detecting existing percussion...")
-                percussion_events = self.detect_existing_percussion(y, sr, beat_frames)
-    
-                update_progress(0.5, "Enhancing percussion track...")
-                # Przekazujemy audio_path bezpośrednio zamiast polegać na self.current_audio_path
-                percussion_track = self.enhance_percussion_track(percussion_events, tempo, len(y) / sr, audio_path, y, sr)
-    
-                update_progress(0.7, "Synthesizing enhanced audio...")
-                percussion_audio = self.synthesize_enhanced_audio(percussion_track, sr, y, tempo)
-    
-                update_progress(0.9, "Saving tracks...")
-                self.save_generated_tracks(audio_path, percussion_track, y, sr, percussion_audio)
+                style = self.preset_genre_combo.get_active_text() or "Techno"
+                summary = enhance_audio_file(audio_path, dict(self.samples), style, cache=self.analysis_cache,
+                                             store=self.sample_store, progress=update_progress, stage=stage,
+                                             seed=self.next_seed())
+                print(f"Mood: {summary['mood']}, analysis cache: {self.analysis_cache.stats()}")
+                print("Drummer stages: " + ", ".join(f"{n} {t:.2f} s" for n, t in timings))
     
                 GLib.idle_add(progress_dialog.destroy)
-                GLib.idle_add(self.show_save_confirmation,
-                              audio_path.replace(".mp3", "_enhanced_drums.wav"),
-                              audio_path.replace(".mp3", "_combined.wav"))
+                GLib.idle_add(self.show_save_confirmation, *summary['outputs'])
             except Exception as e:
                 GLib.idle_add(progress_dialog.destroy)
                 GLib.idle_add(self.show_error_dialog, str(e))
@@ -1194,155 +3185,29 @@ class DrumSamplerApp(Gtk.Window):
         response = file_dialog.run()
         if response == Gtk.ResponseType.OK:
             audio_path = file_dialog.get_filename()
+            worker = stream_drums_thread if streaming_check.get_active() else enhance_drums_thread
             file_dialog.destroy()
-            threading.Thread(target=enhance_drums_thread, args=(audio_path,), daemon=True).start()
+            threading.Thread(target=worker, args=(audio_path,), daemon=True).start()
         else:
             file_dialog.destroy()
     
-    def detect_existing_percussion(self, y, sr, beat_frames):
+    def detect_existing_percussion(self, context):
         """Wykrywa istniejące elementy perkusyjne w audio."""
-        onset_env = librosa.onset.onset_strength(y=y, sr=sr)
-        onsets = librosa.onset.onset_detect(onset_envelope=onset_env, sr=sr)
-        onset_times = librosa.frames_to_time(onsets, sr=sr)
-    
-        percussion_events = {'Stopa': [], 'Werbel': [], 'Talerz': [], 'TomTom': []}
-        for onset_time in onset_times:
-            start_sample = int(max(0, onset_time * sr - 0.05 * sr))
-            end_sample = int(min(len(y), onset_time * sr + 0.05 * sr))
-            segment = y[start_sample:end_sample]
-            freqs = np.abs(librosa.stft(segment))
-            mean_freq = np.mean(np.argmax(freqs, axis=0))
+        return detect_existing_percussion(context)
     
-            if mean_freq < 100:
-                percussion_events['Stopa'].append(onset_time)
-            elif 100 <= mean_freq < 500:
-                percussion_events['Werbel'].append(onset_time) if random.random() < 0.7 else percussion_events['TomTom'].append(onset_time)
-            else:
-                percussion_events['Talerz'].append(onset_time)
-    
-        return percussion_events
-    
-    def enhance_percussion_track(self, percussion_events, tempo, total_duration, audio_path, y, sr):
+    def enhance_percussion_track(self, percussion_events, tempo, context):
         """Wzbogaca perkusję z wykrywaniem complexity_factor i mniej gęstym rytmem."""
-        beats_per_second = tempo / 60
-        steps_per_beat = 4
-        total_steps = int(total_duration * beats_per_second * steps_per_beat)
-        percussion_track = {inst: [{'active': False, 'rhythm_type': 'single'} for _ in range(total_steps)] for inst in self.instruments}
-    
-        # Mapuj istniejące zdarzenia na kroki
-        for inst, times in percussion_events.items():
-            for t in times:
-                step = int(t * beats_per_second * steps_per_beat)
-                if step < total_steps:
-                    percussion_track[inst][step]['active'] = True
-                    percussion_track[inst][step]['rhythm_type'] = 'single'
-    
-        # Analiza audio do wykrycia complexity_factor
-        if not audio_path or not os.path.exists(audio_path):
-            raise ValueError("Brak poprawnej ścieżki audio (audio_path)")
-    
-        beats_per_measure = 4
-        measures = total_steps // (beats_per_measure * steps_per_beat)
-        samples_per_measure = int(sr * beats_per_measure / beats_per_second)
-    
-        rms = librosa.feature.rms(y=y, frame_length=samples_per_measure, hop_length=samples_per_measure)
-        onset_env = librosa.onset.onset_strength(y=y, sr=sr, hop_length=samples_per_measure)
-        onset_density = [np.sum(onset_env[i:i+1]) for i in range(0, len(onset_env), 1)]
-    
-        rms_normalized = (rms[0] - np.min(rms)) / (np.max(rms) - np.min(rms) + 1e-6)
-        onset_normalized = [(d - min(onset_density)) / (max(onset_density) - min(onset_density) + 1e-6) for d in onset_density]
-    
         style = self.preset_genre_combo.get_active_text() or "Techno"
-        for measure in range(measures):
-            measure_start = measure * beats_per_measure * steps_per_beat
-            measure_end = min((measure + 1) * beats_per_measure * steps_per_beat, total_steps)
-    
-            # Oblicz complexity_factor
-            rms_factor = rms_normalized[min(measure, len(rms_normalized) - 1)]
-            onset_factor = onset_normalized[min(measure, len(onset_normalized) - 1)]
-            complexity_factor = min(0.7, (rms_factor + onset_factor) / 2)
-    
-            # Stabilna podstawa rytmiczna z większymi odstępami
-            for step in range(measure_start, measure_end, steps_per_beat):  # Krok co beat, nie co step
-                beat_in_measure = (step % (beats_per_measure * steps_per_beat)) // steps_per_beat
-                if beat_in_measure == 0 and not percussion_track['Stopa'][step]['active']:
-                    percussion_track['Stopa'][step]['active'] = True
-                    percussion_track['Stopa'][step]['rhythm_type'] = 'single'
-                if beat_in_measure == 2 and not percussion_track['Werbel'][step]['active'] and random.random() < 0.5 * (1 + complexity_factor):
-                    percussion_track['Werbel'][step]['active'] = True
-                    percussion_track['Werbel'][step]['rhythm_type'] = 'single'
+        return enhance_percussion_track(percussion_events, tempo, context, style, self.next_rng())
     
-            # Subtelna ewolucja z mniejszą gęstością
-            if complexity_factor > 0.3:  # Dodajemy elementy tylko w bardziej intensywnych sekcjach
-                for step in range(measure_start, measure_end, steps_per_beat * 2):  # Co 2 beaty
-                    offbeat = step % (steps_per_beat * 2) != 0
-                    if style == "Techno":
-                        if measure % 4 == 0 and random.random() < complexity_factor * 0.08 and not percussion_track['Talerz'][step]['active']:
-                            percussion_track['Talerz'][step]['active'] = True
-                            percussion_track['Talerz'][step]['rhythm_type'] = 'double'
-                        if measure % 8 == 7 and random.random() < complexity_factor * 0.1 and not percussion_track['TomTom'][step]['active']:
-                            percussion_track['TomTom'][step]['active'] = True
-                            percussion_track['TomTom'][step]['rhythm_type'] = 'accent'
-                    elif style == "House":
-                        if measure % 4 == 2 and random.random() < complexity_factor * 0.08 and not percussion_track['Talerz'][step]['active']:
-                            percussion_track['Talerz'][step]['active'] = True
-                            percussion_track['Talerz'][step]['rhythm_type'] = 'swing'
-                        if measure % 8 == 4 and random.random() < complexity_factor * 0.05 and not percussion_track['Stopa'][step]['active']:
-                            percussion_track['Stopa'][step]['active'] = True
-                            percussion_track['Stopa'][step]['rhythm_type'] = 'single'
-    
-        return percussion_track
-    
-    def synthesize_enhanced_audio(self, percussion_track, sr, original_audio, tempo):
+    def synthesize_enhanced_audio(self, percussion_track, sr, original_rms, tempo):
         """Syntetyzuje perkusję z dłuższym wybrzmieniem i mniejszą gęstością."""
-        beats_per_second = tempo / 60
-        steps_per_beat = 4
-        step_duration = int(sr / (beats_per_second * steps_per_beat))
-        total_length = len(percussion_track['Stopa'])
-        audio = np.zeros(total_length * step_duration, dtype=np.float32)
+        sample_arrays = {inst: self.sample_store.get(self.samples[inst], sr).mean(axis=1) for inst in self.instruments}
+        return synthesize_enhanced_audio(percussion_track, sample_arrays, sr, tempo, original_rms)
     
-        for inst in self.instruments:
-            for step in range(total_length):
-                step_data = percussion_track[inst][step]
-                if step_data['active']:
-                    rhythm = self.rhythm_types[step_data['rhythm_type']]
-                    sample = pygame.mixer.Sound(self.samples[inst])
-                    sample_array = pygame.sndarray.array(sample)
-                    if sample_array.ndim > 1:
-                        sample_array = sample_array.mean(axis=1)
-                    
-                    # Dłuższe trwanie nuty, minimum połowa beatu
-                    note_duration = max(int(step_duration * 2 * rhythm['speed'] / rhythm['notes']), int(sr / beats_per_second / 2))
-                    for i in range(rhythm['notes']):
-                        start = int(step * step_duration + i * note_duration)
-                        end = min(start + note_duration, len(audio))
-                        if len(sample_array) > note_duration:
-                            sample_array_adj = sample_array[:note_duration]
-                        else:
-                            sample_array_adj = np.pad(sample_array, (0, note_duration - len(sample_array)))
-                        if end <= len(audio):
-                            audio[start:end] += sample_array_adj * 0.5
-                        else:
-                            audio[start:] += sample_array_adj[:len(audio) - start] * 0.5
-    
-        original_rms = np.sqrt(np.mean(original_audio**2))
-        percussion_rms = np.sqrt(np.mean(audio**2))
-        if percussion_rms > 0:
-            audio *= (original_rms / percussion_rms) * 0.3
-    
-        return audio
-    
-    def save_generated_tracks(self, audio_path, percussion_track, original_audio, sr, percussion_audio):
+    def save_generated_tracks(self, audio_path, original_audio, sr, percussion_audio):
         """Zapisuje wzbogacone ścieżki."""
-        max_length = len(original_audio)
-        percussion_audio = librosa.util.fix_length(percussion_audio, size=max_length)
-        combined_audio = original_audio * 0.4 + percussion_audio * 0.5
-        combined_audio = librosa.util.normalize(combined_audio)
-    
-        percussion_path = audio_path.replace(".mp3", "_enhanced_drums.wav")
-        combined_path = audio_path.replace(".mp3", "_combined.wav")
-        sf.write(percussion_path, percussion_audio, sr)
-        sf.write(combined_path, combined_audio, sr)
+        return save_enhanced_tracks(audio_path, original_audio, sr, percussion_audio)
 
     def show_save_confirmation(self, percussion_path, combined_path):
         dialog = Gtk.MessageDialog(
@@ -1378,6 +3243,7 @@ class DrumSamplerApp(Gtk.Window):
             file_path = os.path.join(sample_dir, f"{instrument}.wav")
             if os.path.isfile(file_path):
                 self.samples[instrument] = file_path
+                self.sample_store.get(file_path)
                 print(f"Załadowano sample dla {instrument}: {file_path}")
 
     def toggle_fullscreen(self, button):
@@ -1392,13 +3258,14 @@ class DrumSamplerApp(Gtk.Window):
 
     def init_audio(self):
         selected_backend = self.backend_combo.get_active_text()
-        if selected_backend == "PipeWire":
-            pygame.mixer.quit()
-            pygame.mixer.init()
-        elif selected_backend == "JACK":
+        if selected_backend not in ("PipeWire", "JACK"):
+            return
+        self.mixer.stop()
+        if selected_backend == "JACK":
             os.environ['SDL_AUDIODRIVER'] = 'jack'
-            pygame.mixer.quit()
-            pygame.mixer.init()
+        pygame.mixer.quit()
+        pygame.mixer.init()
+        self.mixer.start()
 
     def prepare_performance_play(self):
         """Przygotowuje wzorce dla trybu Performer, symulując ograniczenia ludzkiego perkusisty."""
@@ -1406,62 +3273,59 @@ class DrumSamplerApp(Gtk.Window):
             return self.patterns
 
         pattern_length = int(self.length_spinbutton.get_value())
-        performance_patterns = {
-            inst: [{'active': False, 'rhythm_type': 'single'} for _ in range(pattern_length)]
-            for inst in self.instruments
-        }
-
-        # Priorytety instrumentów: Stopa i Werbel jako podstawa rytmu, potem Talerz i TomTom
-        priority_order = ['Stopa', 'Werbel', 'Talerz', 'TomTom']
-
-        for step in range(pattern_length):
-            active_instruments = [
-                inst for inst in self.instruments if self.patterns[inst][step]['active']
-            ]
-            
-            # Ograniczamy do maksymalnie 4 instrumentów jednocześnie
-            if len(active_instruments) > 4:
-                active_instruments = active_instruments[:4]
-            elif len(active_instruments) == 0:
-                continue
-
-            # Przypisanie instrumentów do "rąk" i "nóg"
-            hands = 2
-            feet = 2
-            assigned = []
-
-            # Najpierw przypisujemy Stopę i TomTom do nóg
-            for inst in ['Stopa', 'TomTom']:
-                if inst in active_instruments and feet > 0:
-                    performance_patterns[inst][step] = self.patterns[inst][step].copy()
-                    assigned.append(inst)
-                    feet -= 1
-
-            # Następnie przypisujemy Werbel i Talerz do rąk
-            for inst in ['Werbel', 'Talerz']:
-                if inst in active_instruments and inst not in assigned and hands > 0:
-                    performance_patterns[inst][step] = self.patterns[inst][step].copy()
-                    assigned.append(inst)
-                    hands -= 1
-
-            # Jeśli zostały miejsca, przypisujemy pozostałe instrumenty
-            for inst in active_instruments:
-                if inst not in assigned and (hands > 0 or feet > 0):
-                    performance_patterns[inst][step] = self.patterns[inst][step].copy()
-                    if hands > 0:
-                        hands -= 1
-                    else:
-                        feet -= 1
-
-        return performance_patterns
+        source = self.patterns.steps(0, pattern_length)
+        active = source.active
+
+        # Ograniczamy do maksymalnie 4 instrumentów jednocześnie (w kolejności instrumentów)
+        active = active & (np.cumsum(active, axis=0) <= 4)
+        kept = np.zeros_like(active)
+
+        # Przypisanie instrumentów do "rąk" i "nóg": wolne kończyny liczone dla wszystkich kroków naraz
+        hands = np.full(pattern_length, 2)
+        feet = np.full(pattern_length, 2)
+
+        # Najpierw przypisujemy Stopę i TomTom do nóg
+        for inst in ['Stopa', 'TomTom']:
+            if inst in source:
+                row = source.index(inst)
+                take = active[row] & (feet > 0)
+                kept[row] |= take
+                feet -= take
+
+        # Następnie przypisujemy Werbel i Talerz do rąk
+        for inst in ['Werbel', 'Talerz']:
+            if inst in source:
+                row = source.index(inst)
+                take = active[row] & ~kept[row] & (hands > 0)
+                kept[row] |= take
+                hands -= take
+
+        # Jeśli zostały miejsca, przypisujemy pozostałe instrumenty
+        for row in range(len(source.instruments)):
+            take = active[row] & ~kept[row] & ((hands > 0) | (feet > 0))
+            kept[row] |= take
+            use_hand = take & (hands > 0)
+            hands -= use_hand
+            feet -= take & ~use_hand
+
+        source.active = kept
+        return source
 
     def play_pattern(self, widget):
         self.init_audio()
         if not self.loop_playing:
             self.loop_playing = True
+            self.voice_cache.reset_stats()
+            self.prime_voices()
             self.performance_patterns = self.prepare_performance_play()
-            self.play_thread = threading.Thread(target=self.loop_play)
-            self.play_thread.start()
+            self.loop_pattern_length = int(self.length_spinbutton.get_value())
+            self.loop_active_patterns = self.performance_patterns if self.performer_mode and self.advanced_sequencer_mode else self.patterns
+            self.intensity_tracker = 0
+            self.scheduler = StepScheduler(self.plan_step, self.dispatch_events,
+                                           lookahead=self.scheduler_lookahead,
+                                           steps_per_cycle=self.loop_pattern_length)
+            self.scheduler.start()
+            self.play_thread = self.scheduler.thread
 
     def blink_button(self, instrument, step):
         button = self.buttons[instrument][step]
@@ -1469,71 +3333,78 @@ class DrumSamplerApp(Gtk.Window):
         context.add_class("blink")
         GLib.timeout_add(500, lambda: context.remove_class("blink"))
 
-    def loop_play(self):
-        pattern_length = int(self.length_spinbutton.get_value())
-        step_counter = 0
-        intensity_tracker = 0
-
-        active_patterns = self.performance_patterns if self.performer_mode and self.advanced_sequencer_mode else self.patterns
-
-        while self.loop_playing:
-            current_bpm = self.get_next_bpm()
-            base_step_duration = 60 / current_bpm / 4
+    def get_timeline(self, pattern=None, steps=None):
+        """Oś czasu wzorca dla bieżącego trybu i tempa; kompilowana ponownie tylko po zmianie."""
+        pattern = self.patterns if pattern is None else pattern
+        steps = steps or timeline_period(pattern.length, len(self.dynamic_bpm_list))
+        return self.timeline_cache.get(pattern, self.advanced_sequencer_mode, self.absolute_bpm,
+                                       self.dynamic_bpm_list, steps)
 
-            for _ in range(self.steps_per_bpm):
-                if step_counter >= pattern_length:
-                    step_counter = 0
-                    intensity_tracker = 0
+    def plan_step(self, n):
+        """Planuje zdarzenia n-tego kroku pętli jako offsety względem początku kroku."""
+        timeline = self.get_timeline(self.loop_active_patterns)
+        k = n % timeline.steps
+        step_start = timeline.step_times[k]
+        base_step_duration = timeline.step_times[k + 1] - step_start
 
-                start_time = time.time()
-
-                for inst in self.instruments:
-                    if self.advanced_sequencer_mode:
-                        step_data = active_patterns[inst][step_counter]
-                        if step_data['active'] and inst in self.samples:
-                            rhythm = self.rhythm_types[step_data['rhythm_type']]
-                            original_sound = pygame.mixer.Sound(self.samples[inst])
-                            modified_sound = self.apply_effects(original_sound, inst)
-                            
-                            intensity_tracker += rhythm['notes']
-                            note_duration = base_step_duration * rhythm['speed'] / rhythm['notes']
-                            
-                            for i in range(rhythm['notes']):
-                                swing_offset = note_duration * rhythm['swing'] if i % 2 == 1 else 0
-                                volume = 1.2 if step_data['rhythm_type'] == 'accent' else 1.0
-                                modified_sound.set_volume(volume)
-                                if self.performer_mode:
-                                    human_delay = random.uniform(0, 0.01)
-                                    time.sleep(human_delay)
-                                modified_sound.play()
-                                time.sleep(note_duration + swing_offset)
-                            
-                            if inst != 'TomTom' and intensity_tracker > 3 and step_counter % 4 == 3:
-                                tomtom_sound = pygame.mixer.Sound(self.samples['TomTom'])
-                                tomtom_sound.set_volume(1.2)
-                                tomtom_sound.play()
-                                intensity_tracker = 0
-                            
-                            GLib.idle_add(self.blink_button, inst, step_counter)
-                    else:
-                        if active_patterns[inst][step_counter] == 1 and inst in self.samples:
-                            original_sound = pygame.mixer.Sound(self.samples[inst])
-                            modified_sound = self.apply_effects(original_sound, inst)
-                            modified_sound = self.apply_groove_effects(modified_sound, inst, step_counter)
-                            modified_sound.play()
-                            GLib.idle_add(self.blink_button, inst, step_counter)
-
-                elapsed_time = time.time() - start_time
-                sleep_time = max(0, base_step_duration - elapsed_time)
-                time.sleep(sleep_time)
-
-                step_counter += 1
-            self.advance_bpm()
+        if self.dynamic_bpm_list:
+            self.current_bpm_index = (k // self.steps_per_bpm) % len(self.dynamic_bpm_list)
+
+        step_counter = k % timeline.pattern_length
+        if step_counter == 0:
+            self.intensity_tracker = 0
+
+        events = []
+        span = timeline.step_slice(k)
+        rows = timeline.instrument[span]
+        offsets = timeline.time[span] - step_start
+        for row, inst in enumerate(timeline.instruments):
+            hits = rows == row
+            if inst not in self.samples or not hits.any():
+                continue
+            if self.advanced_sequencer_mode:
+                rhythm_type = RHYTHM_NAMES[timeline.rhythm[span][hits][0]]
+                self.intensity_tracker += int(hits.sum())
+                for offset, gain in zip(offsets[hits], timeline.gain[span][hits]):
+                    human_delay = self.playback_rng.uniform(0, 0.01) if self.performer_mode else 0.0
+                    events.append((offset + human_delay, ('note', inst, rhythm_type, float(gain))))
+
+                if inst != 'TomTom' and self.intensity_tracker > 3 and step_counter % 4 == 3:
+                    events.append((0.0, ('fill', 'TomTom', None, 1.2)))
+                    self.intensity_tracker = 0
+            else:
+                events.append((0.0, ('groove', inst, step_counter, 1.0)))
+            events.append((0.0, ('blink', inst, step_counter, None)))
+
+        return base_step_duration, events
+
+    def dispatch_events(self, events, due_time=None):
+        """Odtwarza zdarzenia przypadające na tę samą chwilę (wątek harmonogramu)."""
+        for kind, inst, arg, volume in events:
+            if kind == 'note':
+                self.mixer.play(self.get_voice(inst), gain=volume, at=due_time)
+            elif kind == 'fill':
+                self.mixer.play(self.get_raw_voice(inst), gain=volume, at=due_time)
+            elif kind == 'groove':
+                voice, groove_gain = self.apply_groove_effects(self.get_voice(inst), inst, arg)
+                self.mixer.play(voice, gain=volume * groove_gain, at=due_time)
+            elif kind == 'blink':
+                GLib.idle_add(self.blink_button, inst, arg)
 
     def stop_pattern(self, widget):
         self.loop_playing = False
-        if self.play_thread is not None:
-            self.play_thread.join()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            for step, (p50, p99) in self.scheduler.jitter_stats().items():
+                print(f"Step {step + 1}: jitter p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+        stats = self.voice_cache.stats()
+        print(f"Voice cache: {stats['hits']} hits, {stats['misses']} misses, {stats['stale']} stale, "
+              f"{stats['renders']} background renders, {stats['voices']} voices")
+        print(f"Mixer: {self.mixer.voice_count} voices, CPU load {self.mixer.cpu_load * 100:.1f}%, {self.mixer.stolen} stolen")
+        timelines = self.timeline_cache.stats()
+        print(f"Timeline cache: {timelines['hits']} hits, {timelines['misses']} compiles")
+        store = self.sample_store.stats()
+        print(f"Sample store: {store['files']} files, {store['decodes']} decodes, {store['bytes'] / 1024:.0f} KiB")
 
     def load_samples(self, widget):
         for inst in self.instruments:
@@ -1546,6 +3417,8 @@ class DrumSamplerApp(Gtk.Window):
             if response == Gtk.ResponseType.OK:
                 filename = file_dialog.get_filename()
                 self.samples[inst] = filename
+                self.sample_store.get(filename)
+                self.refresh_voices(inst, raw=True)
                 print(f"Loaded sample for {inst}: {filename}")
             file_dialog.destroy() 
         self.analyze_sample_volume()
@@ -1556,8 +3429,9 @@ class DrumSamplerApp(Gtk.Window):
 
         for instrument, sample_path in self.samples.items():
             if sample_path:
-                audio = AudioSegment.from_file(sample_path)
-                volume = audio.dBFS
+                data = self.sample_store.get(sample_path)
+                rms = float(np.sqrt(np.mean(np.square(data)))) if data.size else 0.0
+                volume = 20 * np.log10(rms) if rms > 0 else -float("inf")
                 total_volume += volume
                 sample_count += 1
 
@@ -1588,13 +3462,20 @@ class DrumSamplerApp(Gtk.Window):
         if response == Gtk.ResponseType.OK:
             filename = dialog.get_filename()
             project_data = {
-                "simple_patterns": self.simple_patterns,
-                "advanced_patterns": self.advanced_patterns,
+                "pattern": self.patterns.to_dict(),
+                # Starsze wersje czytają osobne modele trybów
+                "simple_patterns": self.patterns.to_simple(),
+                "advanced_patterns": self.patterns.to_dict(),
                 "advanced_sequencer_mode": self.advanced_sequencer_mode,
                 "performer_mode": self.performer_mode,
                 "samples": self.samples,
                 "absolute_bpm": self.absolute_bpm,
-                "dynamic_bpm_list": self.dynamic_bpm_list
+                "dynamic_bpm_list": self.dynamic_bpm_list,
+                "effects": self.effects,
+                "adsr": self.current_adsr,
+                "adsr_curve": self.adsr_curve,
+                "seed": self.seed,
+                "generation": self.last_generation
             }
 
             with open(filename, 'w') as f:
@@ -1617,18 +3498,34 @@ class DrumSamplerApp(Gtk.Window):
             with open(filename, 'r') as f:
                 project_data = json.load(f)
 
-            self.simple_patterns = project_data.get("simple_patterns", {inst: [0] * 16 for inst in self.instruments})
-            self.advanced_patterns = project_data.get("advanced_patterns", {inst: [{'active': False, 'rhythm_type': 'single'} for _ in range(16)] for inst in self.instruments})
+            self.patterns = Pattern.from_project(project_data, self.instruments)
+            self.reseed(project_data.get("seed"))
+            self.last_generation = project_data.get("generation")
+            status = check_generation(project_data, self.instruments)
+            if status is not None:
+                print(f"Pattern generation record ({self.last_generation['generator']}, "
+                      f"seed {self.last_generation['seed']}): {status}")
             self.advanced_sequencer_mode = project_data.get("advanced_sequencer_mode", False)
             self.performer_mode = project_data.get("performer_mode", False)
-            self.patterns = self.advanced_patterns if self.advanced_sequencer_mode else self.simple_patterns
             self.sequencer_mode_switch.set_active(self.advanced_sequencer_mode)
             self.performer_mode_switch.set_active(self.performer_mode)
             self.samples = project_data["samples"]
+            self.sample_store.load(path for path in self.samples.values() if os.path.isfile(path))
             self.absolute_bpm = project_data.get("absolute_bpm", 120)
             self.dynamic_bpm_list = project_data.get("dynamic_bpm_list", [])
             self.bpm_entry.set_text(str(self.absolute_bpm))
             self.dynamic_bpm_entry.set_text(','.join(map(str, [bpm * 100 / self.absolute_bpm for bpm in self.dynamic_bpm_list])))
+            for inst, settings in project_data.get("effects", {}).items():
+                for effect, value in settings.items():
+                    self.effect_sliders[inst][effect].set_value(value)
+                    self.effects[inst][effect] = value
+            if "adsr" in project_data:
+                self.current_adsr = project_data["adsr"]
+                for inst in self.instruments:
+                    for param, entry in self.adsr_entries[inst].items():
+                        entry.set_text(f"{self.current_adsr[inst][param]:.2f}")
+            self.adsr_curve_combo.set_active(["linear", "exponential"].index(project_data.get("adsr_curve", "linear")))
+            self.refresh_voices(raw=True)
             self.update_buttons()
 
         dialog.destroy()
@@ -1643,24 +3540,12 @@ class DrumSamplerApp(Gtk.Window):
         pattern_length = int(self.length_spinbutton.get_value())
         active_patterns = self.prepare_performance_play() if self.performer_mode and self.advanced_sequencer_mode else self.patterns
 
-        for step in range(pattern_length):
-            current_bpm = self.get_next_bpm()
-            step_duration = 60 / current_bpm / 4
-
-            for inst in self.instruments:
-                if self.advanced_sequencer_mode:
-                    step_data = active_patterns[inst][step]
-                    if step_data['active']:
-                        rhythm = self.rhythm_types[step_data['rhythm_type']]
-                        note_duration = step_duration * rhythm['speed'] / rhythm['notes']
-                        for _ in range(rhythm['notes']):
-                            midi.addNote(track, 9, self.midi_notes[inst], time, note_duration, 100 if step_data['rhythm_type'] != 'accent' else 120)
-                            time += note_duration
-                else:
-                    if active_patterns[inst][step] == 1:
-                        midi.addNote(track, 9, self.midi_notes[inst], time, 0.25, 100)
-            if not self.advanced_sequencer_mode:
-                time += step_duration
+        timeline = self.get_timeline(active_patterns, steps=pattern_length)
+        beats_per_tick = 1 / timeline.ppq
+        for row, tick, duration, velocity in zip(timeline.instrument, timeline.tick, timeline.duration_ticks,
+                                                 timeline.velocity):
+            midi.addNote(track, 9, self.midi_notes[self.instruments[row]], float(tick * beats_per_tick),
+                         float(duration * beats_per_tick), int(velocity))
 
         file_dialog = Gtk.FileChooserDialog(
             title="Export MIDI",
@@ -1717,199 +3602,42 @@ class DrumSamplerApp(Gtk.Window):
             target_bpm = float(bpm_entry.get_text())
             dynamic_bpm = [float(x) for x in dynamic_bpm_entry.get_text().split(',')]
 
-            midi = MIDIFile(3)
-            for i, name in enumerate(["Drums", "Bass", "Lead"]):
-                midi.addTrackName(i, 0, name)
-            midi.addTempo(0, 0, target_bpm)
-
             duration = 720
             patterns = self.generate_structured_patterns(style, duration, target_bpm, unique=True)
-            self.add_structured_notes(midi, patterns, dynamic_bpm)
-
-            with open(filename, "wb") as output_file:
-                midi.writeFile(output_file)
+            tracks = structured_song_tracks(patterns, target_bpm, dynamic_bpm, self.midi_notes)
+            write_smf(filename, tracks, target_bpm)
 
         dialog.destroy()
 
     def generate_structured_patterns(self, style, duration, bpm, unique=False):
-        structure = {
-            "intro": random.randint(4, 6) if unique else 4,
-            "verse1": random.randint(12, 14) if unique else 14,
-            "chorus1": random.randint(6, 8) if unique else 8,
-            "verse2": random.randint(12, 14) if unique else 14,
-            "chorus2": random.randint(6, 8) if unique else 8,
-            "development": random.randint(12, 14) if unique else 12,
-            "chorus3": random.randint(6, 8) if unique else 8,
-            "outro": random.randint(4, 6) if unique else 4
-        }
-
-        total_measures = int(duration * bpm / 60 / 4)
-        total_structure_measures = sum(structure.values())
-        if total_structure_measures < total_measures:
-            structure["outro"] += total_measures - total_structure_measures
-        elif total_structure_measures > total_measures:
-            structure["outro"] = max(4, structure["outro"] - (total_structure_measures - total_measures))
-
-        patterns = {}
-        current_measure = 0
-
-        for section, section_measures in structure.items():
-            section_duration = section_measures * 4 * 60 / bpm
-            drum_pattern = self.generate_drum_pattern(style, section_duration, bpm)
-            bass_pattern = self.generate_bass_pattern(style, section_duration, bpm)
-            lead_pattern = self.generate_lead_pattern(style, section_duration, bpm)
-
-            intensity = 0.3 if "intro" in section or "outro" in section else 0.7 if "development" in section else 0.5
-            drum_pattern = self.adjust_pattern_intensity(drum_pattern, intensity)
-            bass_pattern = self.adjust_pattern_intensity(bass_pattern, intensity)
-            lead_pattern = self.adjust_pattern_intensity(lead_pattern, intensity)
-
-            patterns[section] = {
-                "drums": drum_pattern,
-                "bass": bass_pattern,
-                "lead": lead_pattern,
-                "start_measure": current_measure,
-                "duration": section_measures
-            }
-            current_measure += section_measures
-
-        return patterns
+        return generate_structured_patterns(style, duration, bpm, unique, self.instruments, self.next_rng())
 
     def adjust_pattern_intensity(self, pattern, intensity):
-        if isinstance(pattern, dict):
-            for inst in pattern:
-                for step in pattern[inst]:
-                    step['active'] = step['active'] and random.random() < intensity
-        else:
-            pattern = [x if random.random() < intensity else 0 for x in pattern]
-        return pattern
+        return adjust_pattern_intensity(pattern, intensity, self.next_rng())
 
     def generate_drum_pattern(self, style, duration, bpm):
-        pattern_length = int(duration * bpm / 60 / 4)
-        pattern = {inst: [{'active': False, 'rhythm_type': 'single'} for _ in range(pattern_length)] for inst in self.instruments}
-
-        if style == "Techno":
-            for i in range(pattern_length):
-                pattern['Stopa'][i]['active'] = True if i % 4 == 0 else False
-                pattern['Stopa'][i]['rhythm_type'] = 'single'
-                pattern['Werbel'][i]['active'] = True if i % 8 == 4 else False
-                pattern['Werbel'][i]['rhythm_type'] = 'swing'
-                pattern['Talerz'][i]['active'] = True if i % 4 == 2 and random.random() < 0.3 else False
-                pattern['Talerz'][i]['rhythm_type'] = 'burst'
-                pattern['TomTom'][i]['active'] = True if i % 16 == 14 and random.random() < 0.3 else False
-                pattern['TomTom'][i]['rhythm_type'] = 'accent'
-        elif style == "House":
-            for i in range(pattern_length):
-                pattern['Stopa'][i]['active'] = True if i % 4 in [0, 2] else False
-                pattern['Stopa'][i]['rhythm_type'] = 'double'
-                pattern['Werbel'][i]['active'] = True if i % 8 == 4 else False
-                pattern['Werbel'][i]['rhythm_type'] = 'single'
-                pattern['Talerz'][i]['active'] = True if i % 8 == 4 and random.random() < 0.25 else False
-                pattern['Talerz'][i]['rhythm_type'] = 'swing'
-                pattern['TomTom'][i]['active'] = True if i % 16 == 12 else False
-                pattern['TomTom'][i]['rhythm_type'] = 'single'
-        # Możesz dodać więcej stylów według potrzeb
-        return pattern
+        return generate_drum_pattern(style, duration, bpm, self.instruments, self.next_rng())
 
     def generate_bass_pattern(self, style, duration, bpm):
-        pattern_length = int(duration * bpm / 60 / 4)
-        pattern = [0] * pattern_length
-
-        if style == "Techno":
-            for i in range(pattern_length):
-                pattern[i] = random.choice([36, 38, 41, 43]) if i % 4 == 0 else 0
-        elif style == "House":
-            for i in range(pattern_length):
-                pattern[i] = random.choice([36, 38, 41, 43]) if i % 2 == 0 else 0
-        # Możesz dodać więcej stylów według potrzeb
-        return pattern
+        return generate_bass_pattern(style, duration, bpm, self.next_rng())
 
     def generate_lead_pattern(self, style, duration, bpm):
-        pattern_length = int(duration * bpm / 60 / 4)
-        pattern = [0] * pattern_length
-
-        if style == "Techno":
-            for i in range(pattern_length):
-                pattern[i] = random.choice([60, 62, 64, 65, 67]) if i % 8 in [0, 3, 5] else 0
-        elif style == "House":
-            for i in range(pattern_length):
-                pattern[i] = random.choice([60, 62, 64, 65]) if i % 4 in [0, 2] else 0
-        # Możesz dodać więcej stylów według potrzeb
-        return pattern
-
-    def add_structured_notes(self, midi, structured_patterns, dynamic_bpm):
-        time = 0
-        current_bpm_index = 0
-        steps_per_bpm = 4
-
-        for section, patterns in structured_patterns.items():
-            drum_pattern = patterns['drums']
-            bass_pattern = patterns['bass']
-            lead_pattern = patterns['lead']
-            section_duration = patterns['duration'] * 4
-
-            for step in range(section_duration):
-                if step % steps_per_bpm == 0:
-                    current_bpm = dynamic_bpm[current_bpm_index] * self.absolute_bpm / 100
-                    current_bpm_index = (current_bpm_index + 1) % len(dynamic_bpm)
-
-                step_duration = 60 / current_bpm / 4
-                for inst in self.instruments:
-                    step_data = drum_pattern[inst][step % len(drum_pattern[inst])]
-                    if step_data['active']:
-                        rhythm = self.rhythm_types[step_data['rhythm_type']]
-                        note_duration = step_duration * rhythm['speed'] / rhythm['notes']
-                        for _ in range(rhythm['notes']):
-                            midi.addNote(0, 9, self.midi_notes[inst], time, note_duration, 100 if step_data['rhythm_type'] != 'accent' else 120)
-                            time += note_duration
-
-                bass_note = bass_pattern[step % len(bass_pattern)]
-                if bass_note != 0:
-                    midi.addNote(1, 0, bass_note, time, 0.5, 80)
-
-                lead_note = lead_pattern[step % len(lead_pattern)]
-                if lead_note != 0:
-                    midi.addNote(2, 1, lead_note, time, 0.25, 90)
-
-                time += step_duration
+        return generate_lead_pattern(style, duration, bpm, self.next_rng())
 
     def randomize_pattern(self, widget):
-        pattern_length = int(self.length_spinbutton.get_value())
-        for inst in self.instruments:
-            if self.advanced_sequencer_mode:
-                for i in range(pattern_length):
-                    step_data = self.patterns[inst][i]
-                    if inst == 'Stopa':
-                        step_data['active'] = random.choice([True, False]) if i % 4 == 0 else False
-                        step_data['rhythm_type'] = random.choice(['single', 'double']) if step_data['active'] else 'single'
-                    elif inst == 'Werbel':
-                        step_data['active'] = True if i % 4 == 2 else False
-                        step_data['rhythm_type'] = 'swing' if step_data['active'] and random.random() < 0.3 else 'single'
-                    elif inst == 'Talerz':
-                        step_data['active'] = random.choice([True, False]) if i % 2 == 0 else False
-                        step_data['rhythm_type'] = random.choice(['single', 'burst']) if step_data['active'] else 'single'
-                    elif inst == 'TomTom':
-                        step_data['active'] = True if i % 8 == 7 and random.random() < 0.5 else False
-                        step_data['rhythm_type'] = 'accent' if step_data['active'] else 'single'
-            else:
-                for i in range(pattern_length):
-                    if inst == 'Stopa':
-                        self.patterns[inst][i] = random.choice([1, 0]) if i % 4 == 0 else 0
-                    elif inst == 'Werbel':
-                        self.patterns[inst][i] = 1 if i % 4 == 2 else 0
-                    elif inst == 'Talerz':
-                        self.patterns[inst][i] = random.choice([0, 1]) if i % 2 == 0 else 0
-                    elif inst == 'TomTom':
-                        self.patterns[inst][i] = random.choice([0, 1]) if i % 8 == 7 else 0
-    
-        self.randomize_instruments(None)
-        self.update_buttons()
+        params = {
+            'length': int(self.length_spinbutton.get_value()),
+            'swap_probability': self.randomize_probability_spin.get_value() / 100,
+        }
+        self.apply_generated('random', params)
 
     # Sample Manipulation Handlers
     def on_adsr_entry_changed(self, entry, instrument, param):
         try:
-            value = float(entry.get_text())
-            self.current_adsr[instrument][param] = max(0.0, min(value, 1.0 if param == 'sustain' else 5.0))
+            value = max(0.0, min(float(entry.get_text()), 1.0 if param == 'sustain' else 5.0))
+            if self.current_adsr[instrument][param] != value:
+                self.current_adsr[instrument][param] = value
+                self.refresh_voices(instrument)
             entry.set_text(f"{self.current_adsr[instrument][param]:.2f}")
             if self.preview_active[instrument]:
                 self.preview_sample(instrument)
@@ -1919,25 +3647,39 @@ class DrumSamplerApp(Gtk.Window):
     def adjust_adsr(self, button, instrument, param, step):
         current_value = self.current_adsr[instrument][param]
         new_value = max(0.0, min(current_value + step, 1.0 if param == 'sustain' else 5.0))
-        self.current_adsr[instrument][param] = new_value
+        if new_value != current_value:
+            self.current_adsr[instrument][param] = new_value
+            self.refresh_voices(instrument)
         self.adsr_entries[instrument][param].set_text(f"{new_value:.2f}")
         if self.preview_active[instrument]:
             self.preview_sample(instrument)
 
+    def on_adsr_curve_changed(self, combo):
+        curve = combo.get_active_text()
+        if curve and curve != self.adsr_curve:
+            self.adsr_curve = curve
+            self.refresh_voices()
+            for inst in self.instruments:
+                if self.preview_active[inst]:
+                    self.preview_sample(inst)
+
     def reset_adsr(self, button, instrument):
         self.current_adsr[instrument] = self.nominal_adsr[instrument].copy()
+        self.refresh_voices(instrument)
         for param, entry in self.adsr_entries[instrument].items():
             entry.set_text(f"{self.current_adsr[instrument][param]:.2f}")
         if self.preview_active[instrument]:
             self.preview_sample(instrument)
 
     def randomize_adsr(self, button, instrument):
+        rng = self.next_rng()
         for param in ['attack', 'decay', 'sustain', 'release']:
             if param == 'sustain':
-                self.current_adsr[instrument][param] = random.uniform(0.1, 1.0)
+                self.current_adsr[instrument][param] = float(rng.uniform(0.1, 1.0))
             else:
-                self.current_adsr[instrument][param] = random.uniform(0.01, 2.0)
+                self.current_adsr[instrument][param] = float(rng.uniform(0.01, 2.0))
             self.adsr_entries[instrument][param].set_text(f"{self.current_adsr[instrument][param]:.2f}")
+        self.refresh_voices(instrument)
         if self.preview_active[instrument]:
             self.preview_sample(instrument)
 
@@ -1948,25 +3690,24 @@ class DrumSamplerApp(Gtk.Window):
 
     def preview_sample(self, instrument):
         if instrument in self.samples:
-            sound = pygame.mixer.Sound(self.samples[instrument])
-            sound = self.apply_effects(sound, instrument)
-            sound.play()
+            self.mixer.play(self.get_voice(instrument, stale=False))
 
     def generate_default_samples(self):
         sample_rate = 44100
         duration = 0.5
+        rng = np.random.default_rng(0)  # domyślne sample są zawsze takie same
         for inst in self.instruments:
             if inst not in self.samples:
                 t = np.linspace(0, duration, int(sample_rate * duration), False)
                 if inst == 'Talerz':
                     base = np.sin(2 * np.pi * 2000 * t) * np.exp(-3 * t)
-                    noise = np.random.normal(0, 0.3, len(t)) * np.exp(-2 * t)
+                    noise = rng.normal(0, 0.3, len(t)) * np.exp(-2 * t)
                     sound = base + noise
                 elif inst == 'Stopa':
                     sound = np.sin(2 * np.pi * 60 * t) * np.exp(-10 * t)
                 elif inst == 'Werbel':
                     base = np.sin(2 * np.pi * 300 * t) * np.exp(-6 * t)
-                    noise = np.random.normal(0, 0.1, len(t)) * np.exp(-4 * t)
+                    noise = rng.normal(0, 0.1, len(t)) * np.exp(-4 * t)
                     sound = base * 0.7 + noise * 0.3
                 elif inst == 'TomTom':
                     base = np.sin(2 * np.pi * 100 * t) * np.exp(-4 * t)
@@ -1976,6 +3717,7 @@ class DrumSamplerApp(Gtk.Window):
                 sound = (sound / np.max(np.abs(sound)) * 32767).astype(np.int16)
                 self.samples[inst] = f"{inst}_default.wav"
                 sf.write(self.samples[inst], sound, sample_rate)
+                self.sample_store.get(self.samples[inst])
 
     def export_sample_bank(self, widget):
         dialog = Gtk.FileChooserDialog(
@@ -2014,6 +3756,7 @@ class DrumSamplerApp(Gtk.Window):
                         sample_path = f"sample_bank_temp/{inst}.wav"
                         if os.path.exists(sample_path):
                             self.samples[inst] = sample_path
+                            self.sample_store.get(sample_path)
                     adsr_file = "sample_bank_temp/adsr_settings.json"
                     if os.path.exists(adsr_file):
                         with open(adsr_file, 'r') as f:
@@ -2021,13 +3764,361 @@ class DrumSamplerApp(Gtk.Window):
                         for inst in self.instruments:
                             for param, entry in self.adsr_entries[inst].items():
                                 entry.set_text(str(self.current_adsr[inst][param]))
+                    # Pliki banku nadpisują się pod tą samą ścieżką, więc renderujemy wszystko od nowa
+                    self.refresh_voices(raw=True)
             except Exception as e:
                 self.show_error_dialog(f"Error loading bank: {str(e)}")
         dialog.destroy()
 
-# Main execution
-if __name__ == "__main__":
+def bench_effects(sample_dir="sample", repeat=20):
+    """Porównuje czas renderu jednego głosu: łańcuch pydub vs NumPy."""
+    settings = {
+        "dry": {'volume': 0, 'pitch': 0, 'echo': 0, 'reverb': 0, 'pan': 0},
+        "full": {'volume': 0.5, 'pitch': 1.0, 'echo': 1.0, 'reverb': 1.0, 'pan': 0.3},
+    }
+    paths = sorted(glob.glob(os.path.join(sample_dir, "*.wav")))
+    if not paths:
+        print(f"No WAV files in {sample_dir}")
+        return 1
+    for path in paths:
+        data, sr = sf.read(path, dtype='int16', always_2d=True)
+        if data.shape[1] == 1:
+            data = np.repeat(data, 2, axis=1)
+        data = np.ascontiguousarray(data[:, :2])
+        voice = to_stereo_float(data)
+        for name, effects in settings.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                apply_effect_chain_pydub(data, effects, sr)
+            old_ms = (time.perf_counter() - start) / repeat * 1000
+            start = time.perf_counter()
+            for _ in range(repeat):
+                apply_effect_chain(voice, effects, sr)
+            new_ms = (time.perf_counter() - start) / repeat * 1000
+            print(f"{os.path.basename(path):12s} {name:5s} pydub {old_ms:8.3f} ms  numpy {new_ms:8.3f} ms  x{old_ms / new_ms:6.1f}")
+    return 0
+
+
+def bench_midi(minutes=(10, 60, 600), style="Techno", bpm=128, dynamic_bpm=(100, 110, 90, 105), seed=0):
+    """Porównuje eksport piosenki strukturalnej: MIDIUtil nuta po nucie vs bezpośredni zapis SMF."""
+    for length in minutes:
+        patterns = generate_structured_patterns(style, length * 60, bpm, unique=True, rng=seed)
+        start = time.perf_counter()
+        tracks = structured_song_tracks(patterns, bpm, dynamic_bpm)
+        build_ms = (time.perf_counter() - start) * 1000
+        notes = sum(len(track) for track in tracks)
+
+        start = time.perf_counter()
+        midi = MIDIFile(len(tracks), ticks_per_quarternote=MIDI_PPQ)
+        midi.addTempo(0, 0, bpm)
+        add_midi_tracks(midi, tracks)
+        buffer = io.BytesIO()
+        midi.writeFile(buffer)
+        midiutil_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        data = smf_bytes(tracks, bpm)
+        smf_ms = (time.perf_counter() - start) * 1000
+        print(f"{length:6g} min {notes:8d} notes  events {build_ms:8.1f} ms  midiutil {midiutil_ms:9.1f} ms "
+              f"({len(buffer.getvalue()) / 1024:7.0f} KiB)  smf {smf_ms:7.1f} ms ({len(data) / 1024:7.0f} KiB)  "
+              f"x{midiutil_ms / smf_ms:6.1f}")
+    return 0
+
+
+def check_mixer_timing(spacing=0.010, sample_rate=44100, block_size=1024):
+    """Sprawdza, że dwa uderzenia odległe o `spacing` s w tym samym bloku zostają w tej odległości."""
+    mixer = BlockMixer(sample_rate, block_size)
+    mixer.epoch = 0.0
+    click = np.zeros((64, 2), dtype=np.float32)
+    click[0] = 0.5
+    click.flags.writeable = False
+    # Pierwsze uderzenie w środku trzeciego bloku, drugie w tym samym bloku
+    first = (2 * block_size + 100) / sample_rate - mixer.latency
+    mixer.play(click, at=first)
+    mixer.play(click, at=first + spacing)
+    out = np.concatenate([mixer.render_block()[:, 0].copy() for _ in range(4)])
+    onsets = np.flatnonzero(out)
+    expected = round(spacing * sample_rate)
+    measured = int(onsets[-1] - onsets[0]) if len(onsets) == 2 else None
+    ok = measured == expected and onsets[0] == 2 * block_size + 100
+    print(f"Mixer timing: onsets at samples {onsets.tolist()}, spacing {measured} (expected {expected}): "
+          f"{'OK' if ok else 'FAIL'}")
+    return 0 if ok else 1
+
+
+BATCH_AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3', '.ogg', '.oga', '.aif', '.aiff', '.m4a')
+
+
+def collect_audio_files(source):
+    """Pliki audio z katalogu lub wzorca glob, bez wyników wcześniejszych przebiegów."""
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+    else:
+        paths = glob.glob(source, recursive=True)
+    outputs = tuple(os.path.basename(p) for p in enhanced_output_paths(""))
+    return sorted(p for p in paths if os.path.isfile(p)
+                  and os.path.splitext(p)[1].lower() in BATCH_AUDIO_EXTENSIONS and not p.endswith(outputs))
+
+
+def _batch_enhance_file(audio_path, samples, style, output_dir, cache_dir, seed=None):
+    """Zadanie procesu roboczego: wyjątek trafia do podsumowania zamiast przerywać wsad."""
+    started = time.perf_counter()
+    try:
+        cache = AnalysisCache(cache_dir) if cache_dir else None
+        return enhance_audio_file(audio_path, samples, style, cache=cache, output_dir=output_dir, seed=seed)
+    except Exception as e:
+        return {'file': audio_path, 'seed': seed, 'error': f"{type(e).__name__}: {e}",
+                'traceback': traceback.format_exc(), 'wall_time': time.perf_counter() - started}
+
+
+def batch_enhance(source, samples, style="Techno", output_dir=None, jobs=None, cache_dir=ANALYSIS_CACHE_DIR,
+                  summary_path=None, seed=None):
+    """Add Drummer to Audio dla całego katalogu/globu w puli procesów; zapisuje podsumowanie JSON.
+
+    Ziarno każdego pliku pochodzi z `seed` w kolejności plików, niezależnie od liczby procesów.
+    """
+    files = collect_audio_files(source)
+    if not files:
+        raise FileNotFoundError(f"No audio files match {source}")
+    seed = new_seed() if seed is None else seed
+    seed_sequence = np.random.SeedSequence(seed)
+    seeds = {path: spawn_seed(seed_sequence) for path in files}
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(files)))
+    started = time.perf_counter()
+    results = {}
+
+    def report(path, result):
+        results[path] = result
+        status = f"FAILED {result['error']}" if 'error' in result else f"{result['tempo']:.1f} BPM"
+        print(f"[{len(results)}/{len(files)}] {os.path.basename(path)}: {status} ({result['wall_time']:.1f} s)")
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(_batch_enhance_file, path, samples, style, output_dir, cache_dir, seeds[path]): path
+                   for path in files}
+        try:
+            for future in as_completed(futures):
+                report(futures[future], future.result())
+        except BrokenProcessPool:
+            for future, path in futures.items():
+                if path not in results and future.done() and future.exception() is None:
+                    report(path, future.result())
+
+    # Awaria procesu (np. w dekoderze) psuje całą pulę; pozostałe pliki osobno, żeby wskazać winny
+    for path in files:
+        if path in results:
+            continue
+        retry_start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            try:
+                result = pool.submit(_batch_enhance_file, path, samples, style, output_dir, cache_dir,
+                                     seeds[path]).result()
+            except BrokenProcessPool:
+                result = {'file': path, 'seed': seeds[path], 'error': "Worker process crashed",
+                          'wall_time': time.perf_counter() - retry_start}
+        report(path, result)
+
+    ordered = [results[path] for path in files]
+    summary = {
+        'source': source,
+        'style': style,
+        'seed': seed,
+        'jobs': jobs,
+        'wall_time': time.perf_counter() - started,
+        'processed': sum('error' not in r for r in ordered),
+        'failed': [r['file'] for r in ordered if 'error' in r],
+        'files': ordered,
+    }
+    if summary_path is None:
+        base_dir = output_dir or (source if os.path.isdir(source) else os.path.dirname(files[0]))
+        summary_path = os.path.join(base_dir, "drummer_batch_summary.json")
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    summary['summary_path'] = summary_path
+    return summary
+
+
+def _bulk_song(seed, style, bpm, dynamic_bpm, duration):
+    """Zadanie procesu roboczego: jedna unikalna piosenka z własnym ziarnem losowania."""
+    try:
+        patterns = generate_structured_patterns(style, duration, bpm, unique=True, rng=seed)
+        tracks = structured_song_tracks(patterns, bpm, dynamic_bpm)
+        return {'digest': tracks[0].digest(), 'notes': sum(len(track) for track in tracks),
+                'sections': {name: section['duration'] for name, section in patterns.items()},
+                'data': smf_bytes(tracks, bpm)}
+    except Exception as e:
+        return {'error': f"{type(e).__name__}: {e}", 'traceback': traceback.format_exc()}
+
+
+def bulk_export_midi(output_dir, count, styles=("Techno", "House"), bpm_range=(120, 135),
+                     dynamic_bpm=(100, 110, 90, 105), duration=720, seed=0, jobs=None, max_attempts=None):
+    """Generuje `count` unikalnych piosenek MIDI w puli procesów i zapisuje manifest JSON.
+
+    Parametry i ziarno każdej próby wynikają z `seed`, więc wynik nie zależy od liczby procesów.
+    Piosenki o identycznej osi czasu perkusji są pomijane i zastępowane kolejnymi próbami.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    max_attempts = max_attempts or count * 4
+    seeds = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seeds.spawn(1)[0])
+    jobs = max(1, min(jobs or os.cpu_count() or 1, count))
+    started = time.perf_counter()
+    songs, duplicates, failed = [], [], []
+    seen = {}
+    attempts = 0
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        while len(songs) < count and attempts < max_attempts:
+            batch = []
+            for _ in range(min(count - len(songs), max_attempts - attempts)):
+                song_seed = spawn_seed(seeds)
+                batch.append({'attempt': attempts, 'seed': song_seed, 'style': str(rng.choice(styles)),
+                              'bpm': int(rng.integers(bpm_range[0], bpm_range[1] + 1)),
+                              'dynamic_bpm': list(dynamic_bpm)})
+                attempts += 1
+            futures = [pool.submit(_bulk_song, song['seed'], song['style'], song['bpm'], song['dynamic_bpm'],
+                                   duration) for song in batch]
+
+            # Kolejność prób, nie ukończenia: ta sama piosenka zawsze wygrywa z duplikatem
+            for song, future in zip(batch, futures):
+                result = future.result()
+                if 'error' in result:
+                    failed.append({**song, 'error': result['error'], 'traceback': result['traceback']})
+                    print(f"[{song['attempt']}] FAILED {result['error']}")
+                    continue
+                if result['digest'] in seen:
+                    duplicates.append({**song, 'duplicate_of': seen[result['digest']]})
+                    continue
+                name = f"{len(songs):04d}_{song['style'].replace(' ', '_')}_{song['bpm']}bpm.mid"
+                with open(os.path.join(output_dir, name), 'wb') as f:
+                    f.write(result['data'])
+                seen[result['digest']] = name
+                songs.append({'file': name, **song, 'digest': result['digest'], 'notes': result['notes'],
+                              'sections': result['sections']})
+                print(f"[{len(songs)}/{count}] {name}: {result['notes']} notes")
+
+    manifest = {
+        'seed': seed,
+        'count': count,
+        'styles': list(styles),
+        'bpm_range': list(bpm_range),
+        'dynamic_bpm': list(dynamic_bpm),
+        'duration': duration,
+        'jobs': jobs,
+        'attempts': attempts,
+        'wall_time': time.perf_counter() - started,
+        'songs': songs,
+        'duplicates': duplicates,
+        'failed': failed,
+    }
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    manifest['manifest_path'] = manifest_path
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drum Sampler")
+    subparsers = parser.add_subparsers(dest="command")
+
+    bench_parser = subparsers.add_parser("bench-effects", help="Benchmark the per-voice effect chain")
+    bench_parser.add_argument("--samples", default="sample", help="Directory with WAV samples")
+    bench_parser.add_argument("--repeat", type=int, default=20)
+
+    midi_bench_parser = subparsers.add_parser("bench-midi", help="Benchmark structured song MIDI export")
+    midi_bench_parser.add_argument("--minutes", type=float, nargs="+", default=[10, 60, 600])
+    midi_bench_parser.add_argument("--style", default="Techno")
+    midi_bench_parser.add_argument("--bpm", type=float, default=128)
+    midi_bench_parser.add_argument("--dynamic-bpm", default="100,110,90,105", help="Comma-separated BPM percentages")
+
+    subparsers.add_parser("check-mixer", help="Check that the block mixer keeps sub-block note timing")
+
+    generation_parser = subparsers.add_parser("check-generation",
+                                              help="Rebuild a project's generated pattern from its saved seed")
+    generation_parser.add_argument("project", help="Project file written by Save Project")
+
+    render_parser = subparsers.add_parser("render", help="Render a .drsmp project to WAV/FLAC without a display")
+    render_parser.add_argument("project", help="Project file written by Save Project")
+    render_parser.add_argument("output", help="Output file (.wav or .flac)")
+    render_parser.add_argument("--bars", type=int, default=4, help="Number of 16-step bars")
+    render_parser.add_argument("--mode", choices=["simple", "advanced"], help="Sequencer mode (default: from project)")
+    render_parser.add_argument("--bpm", type=float, help="Absolute BPM (default: from project)")
+    render_parser.add_argument("--dynamic-bpm", help="Comma-separated BPM percentages, e.g. 100,110,90,105")
+    render_parser.add_argument("--sample-rate", type=int, default=44100)
+
+    batch_parser = subparsers.add_parser("batch-enhance", help="Add Drummer to Audio for a folder or glob of tracks")
+    batch_parser.add_argument("source", help="Directory or glob pattern (quote it), e.g. 'album/**/*.flac'")
+    batch_parser.add_argument("--samples", default="sample", help="Directory with <Instrument>.wav samples")
+    batch_parser.add_argument("--style", default="Techno", help="Genre style, as in the preset combo")
+    batch_parser.add_argument("--output-dir", help="Write results here instead of next to each input")
+    batch_parser.add_argument("--jobs", type=int, help="Worker processes (default: CPU count)")
+    batch_parser.add_argument("--summary", help="JSON summary path (default: drummer_batch_summary.json)")
+    batch_parser.add_argument("--no-cache", action="store_true", help="Do not use the analysis cache")
+    batch_parser.add_argument("--seed", type=int, help="Seed for the generated drums (default: random, saved in the summary)")
+
+    bulk_parser = subparsers.add_parser("bulk-midi", help="Generate a library of unique structured MIDI songs")
+    bulk_parser.add_argument("output_dir", help="Directory for the MIDI files and manifest.json")
+    bulk_parser.add_argument("--count", type=int, default=10, help="Number of unique songs")
+    bulk_parser.add_argument("--styles", default="Techno,House", help="Comma-separated styles to draw from")
+    bulk_parser.add_argument("--bpm-range", type=int, nargs=2, default=[120, 135], metavar=("MIN", "MAX"))
+    bulk_parser.add_argument("--dynamic-bpm", default="100,110,90,105", help="Comma-separated BPM percentages")
+    bulk_parser.add_argument("--duration", type=float, default=720, help="Song length in seconds")
+    bulk_parser.add_argument("--seed", type=int, default=0, help="Master seed; same seed gives the same library")
+    bulk_parser.add_argument("--jobs", type=int, help="Worker processes (default: CPU count)")
+
+    args = parser.parse_args(argv)
+    if args.command == "bench-effects":
+        return bench_effects(args.samples, args.repeat)
+    if args.command == "bench-midi":
+        return bench_midi(args.minutes, args.style, args.bpm, [float(x) for x in args.dynamic_bpm.split(',')])
+    if args.command == "check-mixer":
+        return check_mixer_timing()
+    if args.command == "check-generation":
+        with open(args.project, 'r') as f:
+            project = json.load(f)
+        status = check_generation(project)
+        print(f"Pattern generation record: {status or 'none'}")
+        return 1 if status in ('mismatch', 'unverified') else 0
+    if args.command == "render":
+        dynamic_bpm = [float(x) for x in args.dynamic_bpm.split(',')] if args.dynamic_bpm else None
+        start = time.perf_counter()
+        seconds = render_project(args.project, args.output, args.bars, args.mode, args.bpm, dynamic_bpm, args.sample_rate)
+        elapsed = time.perf_counter() - start
+        print(f"Rendered {seconds:.1f} s of audio to {args.output} in {elapsed:.2f} s ({seconds / elapsed:.0f}x real time)")
+        return 0
+    if args.command == "batch-enhance":
+        samples = {inst: os.path.join(args.samples, f"{inst}.wav") for inst in INSTRUMENTS}
+        missing = [path for path in samples.values() if not os.path.isfile(path)]
+        if missing:
+            print(f"Missing samples: {', '.join(missing)}")
+            return 1
+        summary = batch_enhance(args.source, samples, args.style, args.output_dir, args.jobs,
+                                None if args.no_cache else ANALYSIS_CACHE_DIR, args.summary, args.seed)
+        print(f"Processed {summary['processed']}/{len(summary['files'])} files in {summary['wall_time']:.1f} s "
+              f"with {summary['jobs']} workers; summary: {summary['summary_path']}")
+        return 1 if summary['failed'] else 0
+
+    if args.command == "bulk-midi":
+        manifest = bulk_export_midi(args.output_dir, args.count, [s.strip() for s in args.styles.split(',')],
+                                    args.bpm_range, [float(x) for x in args.dynamic_bpm.split(',')],
+                                    args.duration, args.seed, args.jobs)
+        print(f"Wrote {len(manifest['songs'])}/{args.count} songs in {manifest['wall_time']:.1f} s "
+              f"({len(manifest['duplicates'])} duplicates skipped); manifest: {manifest['manifest_path']}")
+        return 0 if len(manifest['songs']) == args.count and not manifest['failed'] else 1
+
+    if Gtk is None:
+        print("The GUI needs PyGObject with GTK 3 (python3-gi); headless commands: "
+              + ", ".join(subparsers.choices))
+        return 1
     win = DrumSamplerApp()
     win.connect("destroy", Gtk.main_quit)
     win.show_all()
     Gtk.main()
+    return 0
+
+
+# Main execution
+if __name__ == "__main__":
+    sys.exit(main())